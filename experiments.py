@@ -1,60 +1,34 @@
 from quarto import *
 import quarto_agents as qagents
-import multiprocessing as mp
 import os
 import pandas as pd
-
-#listens for messages on the q, writes to file.
-def mpListener(filename, q):
-    with open(filename, 'w') as f:
-        while 1:
-            m = q.get()
-            if m == 'kill':
-                break
-            f.write(str(m) + '\n')
-            f.flush()
-
-def batchRunInstance(num_times, agent1, agent2, q):
-    game = QuartoGame(agent1, agent2, gui_mode=False, bin_mode=False)
-
-    for _ in range(num_times):
-        result = game.playRandomFirst()
-        q.put(f"{result},{round(game.agent1_cumulative_time,4)},{round(game.agent2_cumulative_time,4)},{game.numMoves1},{game.numMoves2}")
-        game.resetGame()
-
-#multiprocessing batch running of games between two agents
-def mpBatchRun(agent1: qagents.GenericQuartoAgent, agent2: qagents.GenericQuartoAgent, gamesPerCPU: int, cpu_count: int):
-    assert cpu_count <= mp.cpu_count(), f"Higher than available cpu_count {mp.cpu_count()}"
-
-    #create a new log file for these runs
-    today = datetime.now()
-    filename = f"experiment_results/final/{today.date()} {today.hour}_{today.minute}_{today.second} {agent1.name}_{agent2.name}.txt"
-
-    #must use Manager queue here, or will not work
-    manager = mp.Manager()
-    q = manager.Queue()    
-    pool = mp.Pool(cpu_count+1)
-
-    q.put(f"{agent1.name},{agent2.name},{gamesPerCPU*cpu_count}")
-    q.put(f"result,player1cumulativeTime,player2cumulativeTime,player1numMoves,player2numMoves")
-
-    #put listener to work first
-    watcher = pool.apply_async(mpListener, (filename, q))
-
-    #fire off workers
-    jobs = []
-    for i in range(cpu_count):
-        job = pool.apply_async(batchRunInstance, (gamesPerCPU, agent1, agent2, q))
-        jobs.append(job)
-
-    # collect results from the workers through the pool result queue
-    for job in jobs: 
-        job.get()
-
-    #now we are done, kill the listener
-    q.put('kill')
-    pool.close()
-    pool.join()
+import numpy as np
+import random
+from bigtree.node.node import Node
+from quarto_batch import BatchRunner, getRunFilename
+
+#multiprocessing batch running of games between two agents, written to a new log file
+#runner is a quarto_batch.BatchRunner whose workers are reused across calls (and decide the cpu count), a temporary
+#one is used without it
+def mpBatchRun(agent1: qagents.GenericQuartoAgent, agent2: qagents.GenericQuartoAgent, gamesPerCPU: int, cpu_count: int, runner=None):
+    filename = getRunFilename(agent1.name, agent2.name)
+    if runner is None:
+        with BatchRunner(cpu_count) as runner:
+            return runner.run(agent1, agent2, gamesPerCPU*cpu_count, filename)
+    return runner.run(agent1, agent2, gamesPerCPU*cpu_count, filename)
+
+#Plays a sweep as a tournament on one pool of workers - every agent against every opponent in both seats, or a
+#round robin without opponents. The pairings are kept in experiment_results/tournaments/<name>, so a sweep that
+#is run again only plays the pairings without results. The crosstable is printed and saved next to them.
+def runSweep(name, agents, gamesPerSeat, opponents=None, cpu_count=4):
+    directory = f"experiment_results/tournaments/{name}"
+    start_time = time.time()
+    with BatchRunner(cpu_count) as runner:
+        table = runner.runTournament(agents, gamesPerSeat, directory, opponents)
+    print("Sweep run time: ", round(time.time() - start_time,4))
+    table.to_csv(f"{directory}/crosstable.csv")
+    print(table.to_string())
+    return table
 
 def negamax_tests():
     #search window and depth values
@@ -65,18 +39,11 @@ def negamax_tests():
     geneticminmax = qagents.GeneticMinmaxAgent(searchDepth=3, maxGenerations=2, initialPopulationSize=5000, maxPopulationSize=6000)
     geneticminmax.setName("ControlGenetic-3")
 
-    for s in negamax_search:
-        for d in negamax_depths:
-            negamax_agent = qagents.NegamaxAgent(depth=d, searchWindow=s)
-
-            start_time = time.time()
-            #half the runs as player 1
-            mpBatchRun(negamax_agent, geneticminmax, 12, 4)
-            end_time = time.time()
-            print("Batch run time: ", round(end_time - start_time,4))
+    # the table file is shared by all pool workers and kept for later runs of the same configuration
+    negamax_agents = [qagents.NegamaxAgent(depth=d, searchWindow=s, transposition=f"Negamax-{d}-{s}") for s in negamax_search for d in negamax_depths]
 
-            #half the runs as player 2
-            mpBatchRun(geneticminmax, negamax_agent, 12, 4)
+    #48 runs in each seat against the control agent
+    runSweep("negamax", negamax_agents, 48, [geneticminmax])
 
 def genetic_tests():
     #hyperparameters
@@ -88,18 +55,13 @@ def genetic_tests():
     negamax_agent = qagents.NegamaxAgent(depth=3, searchWindow=16)
     negamax_agent.setName("ControlNegamax-3")
 
-    for g in genetic_gens:
-        for d in genetic_depths:
-            geneticminmax = qagents.GeneticMinmaxAgent(searchDepth=d, maxGenerations=g, initialPopulationSize=initial_population, maxPopulationSize=max_population)
+    genetic_agents = [
+        qagents.GeneticMinmaxAgent(searchDepth=d, maxGenerations=g, initialPopulationSize=initial_population, maxPopulationSize=max_population)
+        for g in genetic_gens for d in genetic_depths
+    ]
 
-            start_time = time.time()
-            #half the runs as player 1
-            mpBatchRun(geneticminmax, negamax_agent, 13, 4)
-            end_time = time.time()
-            print("Batch run time: ", round(end_time - start_time,4))
-
-            #half the runs as player 2
-            mpBatchRun(negamax_agent, geneticminmax, 13, 4)
+    #52 runs in each seat against the control agent
+    runSweep("genetic", genetic_agents, 52, [negamax_agent])
 
 def vs_tests():
     #history neg - (3,16), (3,32)
@@ -109,22 +71,298 @@ def vs_tests():
     negamax_params = [(3,32)]
     genetic_params = [(3,2,8000,12000)]
 
-    for p in range(len(negamax_params)):
-        negamax_param = negamax_params[p]
-        negamax_agent = qagents.NegamaxAgent(depth=negamax_param[0], searchWindow=negamax_param[1])
+    negamax_agents = [qagents.NegamaxAgent(depth=d, searchWindow=s) for d, s in negamax_params]
+    genetic_agents = [
+        qagents.GeneticMinmaxAgent(searchDepth=d, maxGenerations=g, initialPopulationSize=initial_population, maxPopulationSize=max_population)
+        for d, g, initial_population, max_population in genetic_params
+    ]
+
+    #every genetic configuration against every negamax configuration, 20 runs in each seat
+    runSweep("vs", genetic_agents, 20, negamax_agents)
 
-        genetic_param = genetic_params[p]
-        d, g, initial_population, max_population = genetic_param
-        geneticminmax = qagents.GeneticMinmaxAgent(searchDepth=d, maxGenerations=g, initialPopulationSize=initial_population, maxPopulationSize=max_population)
+def mcts_tests():
+    #playouts per move
+    mcts_iterations = [1000, 5000, 20000]
 
-        start_time = time.time()
-        #half the runs as player 1
-        mpBatchRun(geneticminmax, negamax_agent, 5, 4)
-        end_time = time.time()
-        print("Batch run time: ", round(end_time - start_time,4))
+    #experiment control agent
+    negamax_agent = qagents.NegamaxAgent(depth=3, searchWindow=16)
+    negamax_agent.setName("ControlNegamax-3")
 
-        #half the runs as player 2
-        mpBatchRun(negamax_agent, geneticminmax, 5, 4)
+    mcts_agents = [qagents.MCTSAgent(iterations=i) for i in mcts_iterations]
+
+    #48 runs in each seat against the control agent
+    runSweep("mcts", mcts_agents, 48, [negamax_agent])
+
+#the original bigtree reservation tree, kept as the reference for reservation_tree_tests
+class BigtreeReservationTree:
+
+    def __init__(self) -> None:
+        self.rootNode = Node("root", value=-10)
+        self.leafNodes = dict()
+        self.uniqueValues = set()
+
+    def minmax(self, leaf):
+        maxTurn = (len(leaf.name) / 4) % 2 == 0
+        current = leaf
+        while current.parent != None:
+            current = current.parent
+            maxTurn = not maxTurn
+            if maxTurn:
+                current.value = np.max([i.value for i in current.children])
+            else:
+                current.value = np.min([i.value for i in current.children])
+
+    def findChromosomeNode(self, encoding):
+        currentRoot = self.rootNode
+        lastIndex = 0
+        for i in range(4, len(encoding) + 1, 4):
+            stop = True
+            for node in currentRoot.children:
+                if node.name == encoding[:i]:
+                    currentRoot = node
+                    lastIndex = i
+                    stop = False
+                    break
+            if stop:
+                break
+        return currentRoot, lastIndex
+
+    def addPath(self, encoding, leafEvaluation):
+        current, lastIndex = self.findChromosomeNode(encoding)
+        numMoves = (len(encoding) - lastIndex) // 4
+        self.uniqueValues.add(leafEvaluation)
+        for m in range(numMoves):
+            if m == numMoves - 1:
+                current = Node(encoding[0 : lastIndex + 4 * (m + 1)], value=leafEvaluation, parent=current)
+                self.minmax(current)
+                self.leafNodes[encoding] = current
+            else:
+                current = Node(encoding[0 : lastIndex + 4 * (m + 1)], value=-10, parent=current)
+
+    def computeFitness(self, encoding):
+        currNode = self.leafNodes[encoding]
+        leafValue = currNode.value
+        while currNode is not None:
+            if currNode.parent.value == leafValue:
+                currNode = currNode.parent
+                if currNode == self.rootNode:
+                    break
+            else:
+                break
+        return self.rootNode.max_depth - currNode.depth + 1
+
+#Builds both reservation trees from the same populations and checks that every node value, the child order
+#and the leaf fitness agree, then compares the insertion times
+def reservation_tree_tests(populationSizes=(1000, 5000, 12000), searchDepth=3, openingMoves=4, seed=0):
+    np.random.seed(seed)
+    random.seed(seed)
+    agent = qagents.GeneticMinmaxAgent(searchDepth=searchDepth)
+
+    #a position a few random moves into the game
+    board = qutil.QuartoBoard()
+    board.current = 0
+    board.available &= ~1
+    for _ in range(openingMoves):
+        position = random.choice(qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK))
+        nextPiece = random.choice(qutil.getMaskIndices(board.available))
+        board.makeMove(position, nextPiece)
+    gameState = [board, set(qutil.getMaskIndices(board.available)), set(qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK))]
+
+    #the bigtree version names nodes by their prefix in the old string encoding, 2 digits for the position and 2 for the piece
+    def moveString(code):
+        return "%02d%02d" % divmod(code, qagents.MOVE_CODE_BASE)
+
+    def legacyNodes(tree):
+        stack, nodes = [tree.rootNode], []
+        while stack:
+            node = stack.pop()
+            nodes.append((node.name, node.value))
+            stack.extend(reversed(node.children))
+        return nodes
+
+    def trieNodes(tree):
+        stack, nodes = [(tree.rootNode, "")], []
+        while stack:
+            node, prefix = stack.pop()
+            nodes.append((prefix or "root", tree.values[node]))
+            stack.extend((child, prefix + moveString(code)) for code, child in reversed(tree.children[node].items()))
+        return nodes
+
+    for populationSize in populationSizes:
+        population = agent.createPopulation(populationSize, gameState)
+        #mutated copies share long prefixes with their parents, like the children of a generation
+        population = np.concatenate([population, agent.mutation(population[: populationSize // 5], gameState)])
+        evaluations = agent.evaluatePopulation(population, gameState).tolist()
+        chromosomes = agent.encodeChromosomes(population)
+        encodings = ["".join(map(moveString, chromosome)) for chromosome in chromosomes]
+
+        times = []
+        trees = []
+        for treeClass, paths in ((BigtreeReservationTree, encodings), (qagents.ReservationTree, chromosomes)):
+            tree = treeClass()
+            start_time = time.time()
+            for chromosome, evaluation in zip(paths, evaluations):
+                tree.addPath(chromosome, evaluation)
+            times.append(time.time() - start_time)
+            trees.append(tree)
+
+        legacy, trie = trees
+        assert legacyNodes(legacy) == trieNodes(trie), "Node values differ"
+        assert legacy.uniqueValues == trie.uniqueValues
+        #bigtree walks the whole tree for max_depth on every call, so only a sample of the leaves is compared
+        sampled = random.sample(range(len(chromosomes)), min(200, len(chromosomes)))
+        assert all(legacy.computeFitness(encodings[i]) == trie.computeFitness(chromosomes[i]) for i in sampled), "Fitness differs"
+        print(f"{len(chromosomes)} chromosomes, {len(trie.values)} nodes: bigtree {round(times[0], 4)}s, trie {round(times[1], 4)}s, speedup {round(times[0] / times[1], 1)}x")
+
+#random position with numPlaced pieces on random cells and a random current piece (none on a full board), which
+#may already hold a winning line
+def random_position(numPlaced, rng):
+    cells = np.full(16, qutil.NULL_PIECE)
+    pieces = rng.permutation(16)
+    cells[rng.permutation(16)[:numPlaced]] = pieces[:numPlaced]
+    return qutil.QuartoBoard.fromArray(cells, pieces[numPlaced] if numPlaced < 16 else qutil.NULL_PIECE)
+
+#Checks the symmetry group of canonicalizeBoard - every variant of random positions under all 32 board x 384 piece
+#transforms has the same canonical key and the same game over state, and moves map into the canonical frame and back
+def symmetry_tests(numPositions=20, seed=0):
+    rng = np.random.default_rng(seed)
+    lines = set(map(frozenset, qutil.LINES))
+    assert len(set(qutil.BOARD_TRANSFORMS)) == 32, "Expected 32 board symmetries"
+    assert all({frozenset(t[c] for c in line) for line in qutil.LINES} == lines for t in qutil.BOARD_TRANSFORMS), "A board transform breaks a line"
+    assert len(set(qutil.PIECE_TRANSFORMS)) == 24 * 16, "Expected 384 piece symmetries"
+
+    start_time = time.time()
+    for _ in range(numPositions):
+        board = random_position(int(rng.integers(0, 16)), rng)
+        canonical, transform = qutil.canonicalizeBoard(board)
+        cells = board.toCells()
+        for t in range(32):
+            for p in range(24 * 16):
+                pieceTransform = qutil.PIECE_TRANSFORMS[p]
+                variantCells = np.full(16, qutil.NULL_PIECE)
+                variantCells[list(qutil.BOARD_TRANSFORMS[t][:16])] = [pieceTransform[piece] for piece in cells]
+                variant = qutil.QuartoBoard.fromArray(variantCells, pieceTransform[board.current])
+                assert qutil.canonicalizeBoard(variant)[0].key() == canonical.key(), f"Variant {t},{p} has another canonical key"
+                assert variant.isGameOver() == board.isGameOver(), f"Variant {t},{p} changes the game over state"
+                for move in ((int(rng.integers(0, 17)), int(rng.integers(0, 17))) for _ in range(4)):
+                    assert qutil.untransformMove(qutil.transformMove(move, (t, p)), (t, p)) == move, f"Move {move} does not map back"
+
+        #legal moves of the position stay legal in the canonical frame
+        for position in qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK):
+            for nextPiece in qutil.getMaskIndices(board.available) or [qutil.NULL_PIECE]:
+                canonicalPosition, canonicalPiece = qutil.transformMove((position, nextPiece), transform)
+                assert canonical.isEmpty(canonicalPosition), "Move maps onto an occupied cell"
+                assert canonicalPiece == qutil.NULL_PIECE or canonical.available >> canonicalPiece & 1, "Move maps onto a used piece"
+    print(f"{numPositions} positions x {32 * 24 * 16} transforms agree, {round(time.time() - start_time, 2)}s")
+
+#Compares the incremental and batched win checks with the full-board references (quarto_util.isGameOver on the
+#array, isGameOverEncoding and QuartoBoard.isGameOver). Every piece is tried on every empty cell of random positions
+#without a winning line, and the batched kernel is run on random positions, winning lines included.
+def win_check_tests(numPositions=300, seed=0):
+    rng = np.random.default_rng(seed)
+    start_time = time.time()
+    placements = 0
+    wins = 0
+    for _ in range(numPositions):
+        board = random_position(int(rng.integers(0, 16)), rng)
+        if board.isGameOver():
+            continue
+        cells = board.toCells()
+        for position in qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK):
+            for piece in qutil.getMaskIndices(board.available | 1 << board.current):
+                placed = cells.copy()
+                placed[position] = piece
+                after = qutil.QuartoBoard.fromArray(placed, qutil.NULL_PIECE)
+                reference = qutil.isGameOver(placed.reshape(4, 4))
+                assert qutil.isGameOverEncoding(after.toEncoding()) == reference, "Encoding check differs"
+                assert after.isGameOver() == reference, "QuartoBoard.isGameOver differs"
+                assert qutil.isWinningPlacement(after, position) == reference, f"isWinningPlacement differs at {position}"
+                assert qutil.isWinningMove(board, position, piece) == reference, f"isWinningMove differs at {position}"
+                placements += 1
+                wins += reference
+
+    boards = [random_position(int(numPlaced), rng) for numPlaced in rng.integers(0, 17, size=20 * numPositions)]
+    batchWins, threeCounts = qutil.batchEvaluateBoards(np.array([board.toCells() for board in boards]))
+    for board, win, threeCount in zip(boards, batchWins, threeCounts):
+        assert win == qutil.isGameOver(board.toArray()), "batchEvaluateBoards win differs"
+        assert threeCount == board.countThreeLines(), "batchEvaluateBoards three-piece line count differs"
+    print(f"{placements} placements ({wins} wins) and {len(boards)} batched boards agree, {round(time.time() - start_time, 2)}s")
+
+#A transposition file outlives the games played with it - its entries must survive resetGame and playHeadless,
+#which call onGameStart, while an in-memory table starts every game empty
+def transposition_file_tests(depth=3, searchWindow=32):
+    name = "TranspositionFileTest"
+    path = f"tables/{name}.qtt"
+    if os.path.exists(path):
+        os.remove(path)
+    negamax_agent = qagents.NegamaxAgent(depth=depth, searchWindow=searchWindow, transposition=name)
+    game = QuartoGame(negamax_agent, qagents.RandomAgent())
+    game.play()
+    entries = negamax_agent.table.numEntries()
+    assert entries > 0, "No entries stored"
+    game.resetGame()
+    assert negamax_agent.table.numEntries() == entries, "resetGame cleared the transposition file"
+    game.playHeadless(2)
+    assert negamax_agent.table.numEntries() >= entries, "playHeadless cleared the transposition file"
+    print(f"transposition file: {entries} entries after play, {negamax_agent.table.numEntries()} after playHeadless")
+
+    memory_agent = qagents.NegamaxAgent(depth=depth, searchWindow=searchWindow)
+    game = QuartoGame(memory_agent, qagents.RandomAgent())
+    game.play()
+    assert memory_agent.table.numEntries() > 0, "No entries stored"
+    game.resetGame()
+    assert memory_agent.table.numEntries() == 0, "resetGame kept the in-memory table"
+    negamax_agent.table.close()
+    os.remove(path)
+
+#Entries the negamax search stores as proven wins, losses and draws (at PROVEN_DEPTH, reused at any depth) must agree
+#with the endgame solver - with a narrow search window, whose truncated move lists prove nothing, and a full one
+def proven_score_tests(numPositions=30, seed=0):
+    rng = np.random.default_rng(seed)
+    solver = qagents.EndgameSolver()
+    values = {np.inf: qagents.WIN, 0: qagents.DRAW, -np.inf: qagents.LOSS}
+    start_time = time.time()
+    for depth, searchWindow, numPlaced in ((6, 2, (6, 9)), (4, 256, (6, 9)), (4, 256, (11, 13))):
+        proven = {value: 0 for value in values.values()}
+        for _ in range(numPositions):
+            board = random_position(int(rng.integers(*numPlaced)), rng)
+            if board.isGameOver() or board.current == qutil.NULL_PIECE:
+                continue
+            negamax_agent = qagents.NegamaxAgent(depth=depth, searchWindow=searchWindow, tableSize=2**14, endgameThreshold=0)
+            negamax_agent.startSearch()
+            negamax_agent.searchRoot(board, depth)
+            table = negamax_agent.table
+            for i in range(table.capacity):
+                if table.keys[i] is None or table.depths[i] != qagents.PROVEN_DEPTH:
+                    continue
+                value = solver.solve(qutil.QuartoBoard.fromKey(table.keys[i]))[0]
+                assert value == values[table.scores[i]], "Wrong proven score"
+                proven[value] += 1
+        print(f"depth {depth}, window {searchWindow}: {proven[qagents.WIN]} proven wins, {proven[qagents.LOSS]} losses and {proven[qagents.DRAW]} draws agree with the solver")
+    print(f"{round(time.time() - start_time, 2)}s")
+
+#Compacting a transposition file keeps every entry with its score, bound, depth and move at the default capacity,
+#and at a capacity too small for them the entries it drops are counted
+def compact_tests(depth=3, searchWindow=32):
+    name = "CompactTest"
+    path, outputPath = f"tables/{name}.qtt", f"tables/{name}Compacted.qtt"
+    if os.path.exists(path):
+        os.remove(path)
+    negamax_agent = qagents.NegamaxAgent(depth=depth, searchWindow=searchWindow, transposition=name)
+    QuartoGame(negamax_agent, qagents.RandomAgent()).playHeadless(2)
+    records = sorted(negamax_agent.table.getRecords())
+    negamax_agent.table.close()
+
+    metrics = qagents.compactMappedTable(path, outputPath)
+    compacted = qagents.MappedTranspositionTable(outputPath)
+    assert metrics["dropped"] == 0 and sorted(compacted.getRecords()) == records, "Compaction lost entries"
+    compacted.close()
+    print(f"{len(records)} entries kept at capacity {metrics['capacity']}")
+
+    metrics = qagents.compactMappedTable(path, outputPath, capacity=256)
+    assert metrics["dropped"] > 0 and metrics["entries"] + metrics["dropped"] == len(records), "Dropped entries not counted"
+    os.remove(path)
+    os.remove(outputPath)
 
 #Opens up all files in the directory and summarizes data in graphs and tables
 def create_table(path_to_dir: str):
@@ -182,15 +420,22 @@ def create_table(path_to_dir: str):
 
 def main():
     #RUN YOUR TESTS HERE
+    win_check_tests()
+    symmetry_tests()
+    transposition_file_tests()
+    proven_score_tests()
+    compact_tests()
     geneticminmax = qagents.GeneticMinmaxAgent(searchDepth=3, maxGenerations=3, initialPopulationSize=10000, maxPopulationSize=12000)
     # negamax= qagents.NegamaxAgent(depth=3, searchWindow=32)
     #game = QuartoGame(negamax, geneticminmax, gui_mode=True, bin_mode=False)
     game = QuartoGame(qagents.NegamaxAgent(depth=3, searchWindow=32), geneticminmax, gui_mode=True, bin_mode=False)
-    game.playRandomFirst()
+    game.play()
     
     #negamax_tests()
     #genetic_tests()
     #vs_tests()
+    #mcts_tests()
+    #reservation_tree_tests()
     #create_table('experiment_results/final/')
     pass
           
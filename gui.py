@@ -23,7 +23,8 @@ class QuartoGUI(tk.Tk):
         self.player1 = quarto_agents.GeneticMinmaxAgent(initialPopulationSize=2000, maxPopulationSize=5000)
         #self.player2 = quarto_agents.NegamaxAgent(depth=2, searchWindow=64)
         self.player2 = quarto_agents.GeneticMinmaxAgent(initialPopulationSize=2000, maxPopulationSize=5000)
-        self._game = QuartoGame(self.player1, self.player2, gui_mode=True, bin_mode=False)
+        # agents that support pondering think while the human picks a move
+        self._game = QuartoGame(self.player1, self.player2, gui_mode=True, bin_mode=False, ponder=True)
         self.moveCounter = 0
         self.isPlayerOneTurn = True
         self.moveType = MoveType.PICK_PIECE
@@ -86,7 +87,8 @@ class QuartoGUI(tk.Tk):
         self.startButton.bind("<ButtonPress-1>", self.play)
 
     def _checkIfGameOver(self):
-        if qutil.isGameOver(self._game.board):
+        if self._game.board.isGameOver():
+            self._game.stopPondering()
             self._toggleGridFreeze()
             if self.isPlayerOneTurn:
                 self.display["text"] = "Player 1 Won!"
@@ -96,6 +98,7 @@ class QuartoGUI(tk.Tk):
                 self.display2["text"] = ""
             return True
         elif self.moveCounter == 16:
+            self._game.stopPondering()
             self._toggleGridFreeze()
             self.display["text"] = "DRAW!"
             self.display2["text"] = ""
@@ -216,14 +219,11 @@ class QuartoGUI(tk.Tk):
 
     def placePiece(self, position):
         self._updateCell(position)
-        row, col = qutil.get2dCoords(position)
-        self._game.board[row][col] = self._game.currentPiece
-        self._game.availablePositions.remove(position)
+        self._game.board.placePiece(position)
 
     def pickNextPiece(self, nextPiece):
         self._updateCurrent(nextPiece)
-        self._game.currentPiece = nextPiece
-        self._game.availablePieces.remove(self._game.currentPiece)
+        self._game.board.selectPiece(nextPiece)
         if self._game.gui_mode:
             print("Move successful")
             self._game.showGameState()
@@ -239,6 +239,7 @@ class QuartoGUI(tk.Tk):
 
     def makeAgentMove(self):
         position, nextPiece = None, None
+        self._game.stopPondering(self.isPlayerOneTurn)
         if self.isPlayerOneTurn:
             position, nextPiece = self.player1.makeMove(
                 self._game.getGameState(), gui_mode=self._game.gui_mode
@@ -252,6 +253,7 @@ class QuartoGUI(tk.Tk):
         if self._checkIfGameOver():
             return
         self.pickNextPiece(nextPiece)
+        self._game.startPondering(self.isPlayerOneTurn)
         self._handleMoveEnd()
 
     def play(self, event):
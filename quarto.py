@@ -16,6 +16,7 @@ class QuartoGame:
         bin_mode=False,
         log_stats=False,
         numRetriesAllowed=3,
+        ponder=False,
     ):
 
         # additional configuration
@@ -27,6 +28,7 @@ class QuartoGame:
         self.bin_mode = bin_mode  # if terminal view is shown, replace integer piece representation with binary representation
         self.log_stats = log_stats
         self.numRetriesAllowed = numRetriesAllowed
+        self.ponder = ponder  # let the waiting agent think on the opponent's time (GenericQuartoAgent.startPondering)
 
         # game state
         self.moveHistory = list()
@@ -43,11 +45,23 @@ class QuartoGame:
         ), "Agent 2 is not initialized correctly."
 
     def resetGame(self):
-        self.board = np.full((4, 4), 16)
-        self.currentPiece = 16  # set to nothing upon starting
-        self.availablePieces = set(range(16))
-        self.availablePositions = set(range(16))
+        self.board = qutil.QuartoBoard()  # current piece is set to nothing upon starting
         self.moveHistory.clear()
+        self.stopPondering()
+        self.player1.onGameStart()
+        self.player2.onGameStart()
+
+    @property
+    def currentPiece(self):
+        return self.board.current
+
+    @property
+    def availablePieces(self):
+        return self.board.getAvailablePieces()
+
+    @property
+    def availablePositions(self):
+        return self.board.getAvailablePositions()
 
     def resetStats(self):
         self.agent1_cumulative_time = 0
@@ -56,7 +70,7 @@ class QuartoGame:
         self.numMoves2 = 0
 
     def encodeBoard(self):
-        return qutil.encodeBoard(self.board, self.currentPiece)
+        return self.board.toEncoding()
 
     def setPlayerNames(self, name1, name2):
         self.player1Name = self.player1.name if self.player1.name is not None else name1
@@ -69,12 +83,12 @@ class QuartoGame:
             print(f"\n ------{self.player2Name}'s Turn---------\n")
 
     def __getPieceToShow(self, i, j):
-        piece = str(self.board[i][j])
+        piece = str(self.board.getPiece(qutil.getLinearCoords(i, j)))
         if self.bin_mode:
             if piece == "16":
                 piece = f"({qutil.getLinearCoords(i,j)})"
             else:
-                piece = f"{self.board[i][j]:04b}"
+                piece = f"{int(piece):04b}"
         else:
             if piece == "16":
                 piece = "  "
@@ -121,14 +135,13 @@ class QuartoGame:
 
     def getGameState(self):
         return (
-            self.encodeBoard(),
-            self.availablePieces.copy(),
-            self.availablePositions.copy(),
+            self.board.copy(),
+            self.availablePieces,
+            self.availablePositions,
         )
 
     def makeFirstMove(self, nextPiece):
-        self.currentPiece = nextPiece
-        self.availablePieces.remove(self.currentPiece)
+        self.board.selectPiece(nextPiece)
         self.moveHistory.append((None, nextPiece))
         if self.gui_mode:
             print("First move successful")
@@ -140,30 +153,25 @@ class QuartoGame:
         if nextPiece not in range(16):
             print("This piece does not exist\n")
             return False
-        if position not in self.availablePositions:
+        if not self.board.isEmpty(position):
             print("This cell is unavailable\n")
             return False
-        if nextPiece not in self.availablePieces:
+        if not self.board.available >> nextPiece & 1:
             print("This piece has already been placed or will be placed now\n")
             return False
         return True
 
     def __makeMove(self, position, nextPiece):
         self.moveHistory.append((position, nextPiece))
-        row, col = qutil.get2dCoords(position)
-        self.board[row][col] = self.currentPiece
-        self.availablePositions.remove(position)
-
-        self.currentPiece = nextPiece
-        self.availablePieces.remove(self.currentPiece)
+        self.board.makeMove(position, nextPiece)
 
         if self.gui_mode:
             print("Move successful")
 
     def makeLastMove(self):
+        self.stopPondering()
         lastPosition = self.availablePositions.pop()
-        row, col = qutil.get2dCoords(lastPosition)
-        self.board[row][col] = self.currentPiece
+        self.board.placePiece(lastPosition)
         self.moveHistory.append((lastPosition, None))
 
         if self.gui_mode:
@@ -177,7 +185,21 @@ class QuartoGame:
             self.agent2_cumulative_time += endTime - startTime
             self.numMoves2 += 1
 
+    # the agent to move stops pondering first, so its background search is done before it is asked for a move
+    def startPondering(self, isPlayerOneTurn):
+        if self.ponder:
+            agent = self.player1 if isPlayerOneTurn else self.player2
+            agent.startPondering(self.getGameState())
+
+    def stopPondering(self, isPlayerOneTurn=None):
+        if self.ponder:
+            if isPlayerOneTurn is not False:
+                self.player1.stopPondering()
+            if isPlayerOneTurn is not True:
+                self.player2.stopPondering()
+
     def tryMakeMove(self, isPlayerOneTurn):
+        self.stopPondering(isPlayerOneTurn)
         for i in range(self.numRetriesAllowed):
             position, nextPiece = None, None
 
@@ -198,16 +220,20 @@ class QuartoGame:
                 return True
             elif i == self.numRetriesAllowed - 1:
                 print(f"{self.numRetriesAllowed} invalid moves made - game ended")
+                self.stopPondering()
                 return False
 
     def isGameOver(self, isPlayerOneTurn):
         identifier = 1 if isPlayerOneTurn else 2
         playerName = self.player1Name if isPlayerOneTurn else self.player2Name
 
-        if qutil.isGameOver(self.board):
+        # only the lines through the last placed cell can have changed
+        lastPosition = self.moveHistory[-1][0]
+        if qutil.isWinningPlacement(self.board, lastPosition):
             if self.log_stats:
                 self.detailedLogFile.write(f"{identifier}\n")
             print(f"\nPlayer {identifier} ({playerName}) won!")
+            self.stopPondering()
             return True
 
     def pickRandomAvailablePiece(self):
@@ -240,6 +266,7 @@ class QuartoGame:
             if self.isGameOver(isPlayerOneTurn):
                 return 1 if isPlayerOneTurn else 2
 
+            self.startPondering(isPlayerOneTurn)
             isPlayerOneTurn = not isPlayerOneTurn
 
         # Place last piece and set nextPiece to nothing
@@ -256,6 +283,80 @@ class QuartoGame:
             print("\nDraw!")
             return 0
 
+    # Plays numGames games without any output and returns the per-game results (as returned by play), the number
+    # of moves and the cumulative move time of each agent as NumPy arrays. One board and one game state are reused
+    # for all games - the agents receive the same state on every move, refreshed in place, so they must not keep it
+    # between moves. Validation uses the board masks, so an agent changing the state only affects itself.
+    def playHeadless(self, numGames, randomizeFirstMove=True):
+        results = np.zeros(numGames, dtype=np.int8)
+        numMoves = np.zeros((numGames, 2), dtype=np.int16)
+        agentTimes = np.zeros((numGames, 2))
+
+        board = self.board
+        view = qutil.QuartoBoard()
+        availablePieces, availablePositions = set(), set()
+        state = (view, availablePieces, availablePositions)
+        players = (self.player1, self.player2)
+        clock = time.perf_counter
+
+        for game in range(numGames):
+            board.pieces, board.occupied = 0, 0
+            board.available, board.current = qutil.FULL_MASK, qutil.NULL_PIECE
+            self.player1.onGameStart()
+            self.player2.onGameStart()
+            availablePieces.update(range(16))
+            availablePositions.update(range(16))
+
+            if randomizeFirstMove:
+                firstPiece = int(np.random.randint(16))
+            else:
+                view.pieces, view.occupied, view.available, view.current = 0, 0, qutil.FULL_MASK, 16
+                firstPiece = self.player1.makeFirstMove(state)
+            board.selectPiece(firstPiece)
+            availablePieces.discard(firstPiece)
+
+            # player 2 places the first piece, the last placement is forced and made for the player to move
+            player = 1
+            result = 0
+            for _ in range(15):
+                for attempt in range(self.numRetriesAllowed):
+                    view.pieces, view.occupied = board.pieces, board.occupied
+                    view.available, view.current = board.available, board.current
+                    startTime = clock()
+                    position, nextPiece = players[player].makeMove(state)
+                    agentTimes[game, player] += clock() - startTime
+                    if (
+                        position in range(16)
+                        and nextPiece in range(16)
+                        and not board.occupied >> position & 1
+                        and board.available >> nextPiece & 1
+                    ):
+                        break
+                else:
+                    result = -1 - player
+                    break
+
+                board.makeMove(position, nextPiece)
+                availablePositions.discard(position)
+                availablePieces.discard(nextPiece)
+                numMoves[game, player] += 1
+                if qutil.isWinningPlacement(board, position):
+                    result = 1 + player
+                    break
+                player = 1 - player
+            else:
+                position = (~board.occupied & qutil.FULL_MASK).bit_length() - 1
+                board.placePiece(position)
+                if qutil.isWinningPlacement(board, position):
+                    result = 1 + player
+
+            results[game] = result
+            availablePieces.clear()
+            availablePositions.clear()
+
+        self.resetGame()
+        return results, numMoves, agentTimes
+
     def __playWithLogs(self, randomizeFirstMove=True):
         isPlayerOneTurn = True
         if self.gui_mode:
@@ -292,6 +393,7 @@ class QuartoGame:
             if self.isGameOver(isPlayerOneTurn):
                 return 1 if isPlayerOneTurn else 2
 
+            self.startPondering(isPlayerOneTurn)
             isPlayerOneTurn = not isPlayerOneTurn
 
         # Place last piece and set nextPiece to nothing
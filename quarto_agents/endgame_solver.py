@@ -0,0 +1,158 @@
+import random
+import time
+import quarto_util as qutil
+from quarto_agents.transposition_table import (
+    TranspositionTable,
+    EXACT,
+    LOWER_BOUND,
+    UPPER_BOUND,
+)
+
+# game-theoretic values, from the point of view of the player placing the current piece
+WIN = 1
+DRAW = 0
+LOSS = -1
+
+
+# Exact solver for late positions. Full-width alpha-beta over the proven values WIN/DRAW/LOSS - no heuristic
+# evaluation and no search window, so the returned value is the true outcome under perfect play.
+# Immediate wins are found with the threat index and moves handing over a poisoned piece are never searched.
+# Solved positions are kept in a transposition table across calls, under their symmetry-canonical key when
+# at least canonicalMinEmpty cells are empty (canonicalization costs more than it saves closer to the end).
+# With a tablebase file (see quarto_tablebase.py) positions it covers are looked up instead of searched.
+class EndgameSolver:
+    def __init__(self, tableSize=2**18, canonicalMinEmpty=10, tablebase=None) -> None:
+        self.table = TranspositionTable(tableSize, "depth")
+        self.canonicalMinEmpty = canonicalMinEmpty
+        self.tablebase = qutil.Tablebase(tablebase) if tablebase is not None else None
+        self.nodes = 0
+        self.timeMs = 0.0
+
+    # returns (value, (position, nextPiece)) for the player about to place board.current
+    def solve(self, board):
+        assert board.current != qutil.NULL_PIECE, "The piece to place has to be selected."
+        startTime = time.time()
+        self.nodes = 0
+        board = board.copy()
+        self.threats = qutil.ThreatIndex(board)
+        result = self.search(board, LOSS, WIN)
+        self.timeMs = round((time.time() - startTime) * 1000, 2)
+        return result
+
+    def search(self, board, alpha, beta):
+        self.nodes += 1
+        threats = self.threats
+        availablePositions = qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK)
+
+        if threats.isWinningPiece(board.current):
+            nextPiece = qutil.getMaskIndices(board.available)[:1] or (16,)
+            for position in availablePositions:
+                if qutil.isWinningMove(board, position, board.current):
+                    return WIN, (position, nextPiece[0])
+        if len(availablePositions) == 1:
+            return DRAW, (availablePositions[0], 16)
+
+        # every empty cell count is searched to the end, so the number of empty cells is the entry depth
+        numEmpty = len(availablePositions)
+        if self.tablebase is not None and numEmpty <= self.tablebase.maxEmpty:
+            entry = self.tablebase.probe(board)
+            if entry is not None:
+                return entry
+        transform = None
+        if numEmpty >= self.canonicalMinEmpty:
+            canonical, transform = qutil.canonicalizeBoard(board)
+            key = canonical.key()
+        else:
+            key = board.key()
+        alphaOriginal = alpha
+        priorityMove = None
+        entry = self.table.probe(key)
+        if entry is not None:
+            score, flag, _, priorityMove = entry
+            if transform is not None:
+                priorityMove = qutil.untransformMove(priorityMove, transform)
+            if flag == EXACT:
+                return score, priorityMove
+            elif flag == LOWER_BOUND:
+                alpha = max(alpha, score)
+            else:
+                beta = min(beta, score)
+            if alpha >= beta:
+                return score, priorityMove
+
+        moves = [
+            (position, nextPiece)
+            for position in availablePositions
+            for nextPiece in qutil.getMaskIndices(
+                board.available & ~threats.getPoisonedPieces(position)
+            )
+        ]
+        if not moves:
+            # every piece left lets the opponent win
+            return LOSS, (availablePositions[0], qutil.getMaskIndices(board.available)[0])
+        if priorityMove is not None and priorityMove in moves:
+            moves.remove(priorityMove)
+            moves.insert(0, priorityMove)
+
+        maxScore = LOSS - 1
+        bestMove = moves[0]
+        for position, nextPiece in moves:
+            board.makeMove(position, nextPiece)
+            threats.update(position)
+            curr = -self.search(board, -beta, -alpha)[0]
+            board.undoMove(position)
+            threats.update(position)
+
+            if curr > maxScore:
+                maxScore = curr
+                bestMove = (position, nextPiece)
+                if maxScore > alpha:
+                    alpha = maxScore
+                    if alpha >= beta:
+                        break
+
+        if maxScore <= alphaOriginal:
+            flag = UPPER_BOUND
+        elif maxScore >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        if transform is not None:
+            self.table.store(key, maxScore, flag, numEmpty, qutil.transformMove(bestMove, transform))
+        else:
+            self.table.store(key, maxScore, flag, numEmpty, bestMove)
+        return maxScore, bestMove
+
+    # Largest number of empty cells whose positions are solved within timeLimitMs, measured on positions
+    # reached by random play. The slowest of numPositions samples per empty cell count has to fit the budget.
+    def calibrateThreshold(self, timeLimitMs, numPositions=5, maxEmptyCells=10, seed=None):
+        rng = random.Random(seed)
+        threshold = 0
+        for numEmpty in range(2, maxEmptyCells + 1):
+            slowest = 0.0
+            for _ in range(numPositions):
+                self.table.clear()
+                self.solve(randomPosition(numEmpty, rng))
+                slowest = max(slowest, self.timeMs)
+            if slowest > timeLimitMs:
+                break
+            threshold = numEmpty
+        self.table.clear()
+        return threshold
+
+
+# Random position with numEmpty empty cells. Like in real games the current piece does not win right away,
+# otherwise most sampled positions would be solved by the first check.
+def randomPosition(numEmpty, rng=random):
+    while True:
+        board = qutil.QuartoBoard()
+        board.selectPiece(rng.randrange(16))
+        gameOver = False
+        for _ in range(16 - numEmpty):
+            position = rng.choice(qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK))
+            board.makeMove(position, rng.choice(qutil.getMaskIndices(board.available)))
+            if qutil.isWinningPlacement(board, position):
+                gameOver = True
+                break
+        if not gameOver and not qutil.ThreatIndex(board).isWinningPiece(board.current):
+            return board
@@ -11,4 +11,17 @@ class GenericQuartoAgent(ABC):
         pass
 
     def setName(self, name) -> None:
-        self.name = name
\ No newline at end of file
+        self.name = name
+
+    # Called by QuartoGame.resetGame before every game - agents keeping state across the moves of a game reset it here
+    def onGameStart(self) -> None:
+        pass
+
+    # Optional pondering - with QuartoGame(ponder=True) the agent is handed the game state after each of its moves
+    # and may think in the background while the opponent moves. stopPondering is called before its next move
+    # and when the game ends, and has to return once the background work has stopped.
+    def startPondering(self, quartoGameState) -> None:
+        pass
+
+    def stopPondering(self) -> None:
+        pass
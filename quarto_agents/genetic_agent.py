@@ -1,10 +1,48 @@
 from quarto_agents.generic_quarto_agent import GenericQuartoAgent
+from quarto_agents.endgame_solver import EndgameSolver
 import quarto_util as qutil
 import numpy as np
-from bigtree.node.node import Node
-from random import sample
+import multiprocessing as mp
+import time
 from math import factorial
 
+# a move of a chromosome is coded as position * MOVE_CODE_BASE + nextPiece, the next piece being at most 16
+MOVE_CODE_BASE = 17
+
+NUM_MOVE_CODES = 16 * MOVE_CODE_BASE
+
+# the results of prefixes of up to CACHED_PREFIX_MOVES moves are cached in tables indexed by their move codes
+CACHED_PREFIX_MOVES = 2
+UNKNOWN_RESULT = 1
+
+
+# Island worker - evolves one sub-population of the island model in its own process, keeping the population and
+# the reservation tree of the island between migrations. Every command is answered with its result and the time
+# spent on it.
+def runIsland(agent, connection):
+    agent.workers = 1
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        command, args = message
+        startTime = time.time()
+        if command == "start":
+            quartoGameState, safeMoves, initialPopulationSize, maxPopulationSize, seed = args
+            np.random.seed(seed)
+            agent.resetSearch()
+            agent.safeMoves = safeMoves
+            agent.startEvolution(quartoGameState, initialPopulationSize, maxPopulationSize)
+            result = None
+        elif command == "evolve":
+            numGenerations, immigrants, numMigrants = args
+            agent.evolve(numGenerations, immigrants)
+            result = agent.getBestChromosomes(numMigrants)
+        else:
+            result = agent.getLeaves(), agent.searchInfo
+        connection.send((result, time.time() - startTime))
+    connection.close()
+
 
 class GeneticMinmaxAgent(GenericQuartoAgent):
     def __init__(
@@ -15,9 +53,17 @@ class GeneticMinmaxAgent(GenericQuartoAgent):
         mutationRate=0.8,
         initialPopulationSize=3,
         maxPopulationSize=10,
+        endgameThreshold=8,
+        openingBook=None,
+        workers=1,
+        migrationInterval=2,
+        numMigrants=32,
+        timeLimitMs=None,
+        populationGrowth=1.5,
     ) -> None:
         super().__init__()
-        super().setName(f"Genetic-{searchDepth}-{maxGenerations}-{initialPopulationSize}")
+        budget = f"{maxGenerations}" if timeLimitMs is None else f"{timeLimitMs}ms"
+        super().setName(f"Genetic-{searchDepth}-{budget}-{initialPopulationSize}")
 
         # hyperparameters
         self.searchDepth = searchDepth
@@ -28,7 +74,45 @@ class GeneticMinmaxAgent(GenericQuartoAgent):
         self.maxPopulationSize = maxPopulationSize
         self.fitnessCountLimit = maxPopulationSize
 
+        # Anytime mode - with timeLimitMs the search runs generations instead of maxGenerations until the next one
+        # would end after the deadline. While there is time for a few more generations the population sizes grow
+        # by populationGrowth, so moves with a large search space get more chromosomes. The search stops early once
+        # it runs out of new chromosomes.
+        assert timeLimitMs is None or timeLimitMs > 0, "The time limit must be positive."
+        assert populationGrowth >= 1, "The population cannot shrink."
+        self.timeLimitMs = timeLimitMs
+        self.populationGrowth = populationGrowth
+
+        # positions with at most endgameThreshold empty cells are solved exactly instead of evolved
+        self.endgameThreshold = endgameThreshold
+        self.endgameSolver = EndgameSolver() if endgameThreshold else None
+
+        # openingBook is the path of an opening book file (quarto_book.py), read on the first lookup
+        self.openingBook = qutil.OpeningBook(openingBook) if openingBook is not None else None
+
+        # Island model - with workers > 1 the population is split into that many islands, all but the first
+        # evolving in their own processes. Every migrationInterval generations each island sends its numMigrants
+        # best chromosomes to the next one, and at the end the leaves of all islands are merged into one
+        # reservation tree. Inside daemonic processes such as the mpBatchRun workers, which cannot start processes, the search stays serial.
+        self.workers = workers
+        self.migrationInterval = migrationInterval
+        self.numMigrants = numMigrants
+        self.islands = None
+
         self.fitness = dict()
+        self.searchInfo = dict()
+        # generations, evaluations, final population size and time of every searched move of the game
+        self.moveHistory = []
+        self.resetCache()
+
+        # root moves that do not hand the opponent a winning piece - set by generateSolution
+        self.safeMoves = []
+
+    # solved endgame positions stay useful for the rest of the game only
+    def onGameStart(self):
+        self.moveHistory = []
+        if self.endgameSolver is not None:
+            self.endgameSolver.table.clear()
 
     # Only used in debugging
     def makeFirstMove(self, quartoGameState, gui_mode=False):
@@ -40,6 +124,12 @@ class GeneticMinmaxAgent(GenericQuartoAgent):
         if gui_mode:
             print(f"Genetic agent placed piece at cell {position} and nextPiece is {nextPiece}")
             print("maxEval: ", eval)
+            if self.searchInfo.get("generations"):
+                print(
+                    f"generations: {self.searchInfo['generations']}  evaluations: {self.searchInfo['evaluations']}",
+                    f" cache hits: {self.searchInfo['chromosomeHits']} {self.searchInfo['prefixHits']}",
+                    f" population: {self.searchInfo['populationSize']}  time: {self.searchInfo['timeMs']}ms",
+                )
         return position, nextPiece
 
     # maxPossibleChromosomes
@@ -51,337 +141,636 @@ class GeneticMinmaxAgent(GenericQuartoAgent):
         )
 
     # Counts how many lines of three pieces with an identical property
-    def lineEvaluation(self, encoding, turn: bool):
-        board = [int(encoding[i] + encoding[i + 1]) for i in range(0, len(encoding) - 2, 2)]
-        tempLine = None
-        numLines = 0
-
-        for i in range(4):
-            # check horizontal lines
-            tempLine = board[4 * i : 4 * (i + 1)]
-            if tempLine.count(16) == 1:
-                tempLine.remove(16)
-                if qutil.matchingPropertyExists(tempLine):
-                    numLines += 1
-
-            tempLine = board[i : len(board) : 4]
-            # check vertical lines
-            if tempLine.count(16) == 1:
-                tempLine.remove(16)
-                if qutil.matchingPropertyExists(tempLine):
-                    numLines += 1
-
-        # check obtuse diagonal line
-        tempLine = board[0 : len(board) : 5]
-        if tempLine.count(16) == 1:
-            tempLine.remove(16)
-            if qutil.matchingPropertyExists(tempLine):
-                numLines += 1
-
-        # check acute diagonal line:
-        tempLine = board[3:-1:3]
-        if tempLine.count(16) == 1:
-            tempLine.remove(16)
-            if qutil.matchingPropertyExists(tempLine):
-                numLines += 1
-
+    def lineEvaluation(self, board, turn: bool):
+        numLines = board.countThreeLines()
         if turn:
             return -numLines
         else:
             return numLines
 
-    # Each move consists of 4 consecutive characters in the chromosome - 2 for place and 2 for next piece
-    # movePath is defined as a list of tuples which represent moves
-    def encodeChromosome(self, movePath):
-        encoding = "".join(
-            [
-                qutil.convertIntMoveToStr(move[0]) + qutil.convertIntMoveToStr(move[1])
-                for move in movePath
-            ]
-        )
-        return encoding
+    # A population is an (N, numMoves, 2) integer array holding the position and the next piece of every move.
+    # The reservation tree and the fitness table key a chromosome on the tuple of its move codes.
+    def encodeChromosomes(self, population):
+        codes = population[:, :, 0].astype(np.intp) * MOVE_CODE_BASE + population[:, :, 1]
+        return list(map(tuple, codes.tolist()))
 
-    def decodeChromosome(self, chromosome):
-        movePath = [
-            (
-                int(chromosome[i : i + 2]),
-                int(chromosome[i + 2 : i + 4]),
-            )
-            for i in range(0, len(chromosome) - 3, 4)
-        ]
-        return movePath
+    def decodeChromosomes(self, chromosomes):
+        codes = np.array(chromosomes, dtype=np.intp).reshape(len(chromosomes), -1)
+        return np.stack([codes // MOVE_CODE_BASE, codes % MOVE_CODE_BASE], axis=2).astype(np.int8)
 
-    def createChromosome(self, quartoGameState):
+    # random orders of the available positions and pieces, the first move drawn from the safe moves
+    def createPopulation(self, size, quartoGameState):
         _, availableNextPieces, availablePositions = quartoGameState
-        tempNextPieces = list(availableNextPieces)
-        tempPositions = list(availablePositions)
-        chromosomeLength = self.searchDepth
-
-        # generate random moves
-        if len(tempNextPieces) < self.searchDepth:
-            randomPieces = sample(tempNextPieces, len(tempNextPieces))
-            randomPieces.append(16)
-            randomPositions = sample(tempPositions, len(tempPositions))
-            chromosomeLength = len(tempPositions)
-        else:
-            randomPieces = sample(tempNextPieces, self.searchDepth)
-            randomPositions = sample(tempPositions, self.searchDepth)
-
-        newChromosome = ""
-        for i in range(chromosomeLength):
-            newChromosome += qutil.convertIntMoveToStr(randomPositions[i])
-            newChromosome += qutil.convertIntMoveToStr(randomPieces[i])
-
-        return newChromosome, self.evaluate(newChromosome, quartoGameState)
-
-    # one-point crossover
-    def crossover(self, chromosomeA, chromosomeB):
-        if len(chromosomeA) <= len(chromosomeB):
-            numMoves = len(chromosomeA) // 4
-        else:
-            numMoves = len(chromosomeB) // 4
-
+        positions = np.array(sorted(availablePositions), dtype=np.int8)
+        pieces = np.array(sorted(availableNextPieces), dtype=np.int8)
+
+        # near the end of the game the chromosome plays out every position, the last move handing over no piece
+        numMoves = self.searchDepth
+        if len(pieces) < self.searchDepth:
+            numMoves = len(positions)
+        population = np.full((size, numMoves, 2), qutil.NULL_PIECE, dtype=np.int8)
+        population[:, :, 0] = positions[np.argsort(np.random.random((size, len(positions))), axis=1)[:, :numMoves]]
+        numPieces = min(numMoves, len(pieces))
+        population[:, :numPieces, 1] = pieces[np.argsort(np.random.random((size, len(pieces))), axis=1)[:, :numPieces]]
+
+        if self.safeMoves:
+            firstMoves = np.array(self.safeMoves, dtype=np.int8)[np.random.randint(len(self.safeMoves), size=size)]
+            for gene in range(2):
+                self.swapToFront(population[:, :, gene], firstMoves[:, gene])
+        return population
+
+    # moves values to the front of the rows, keeping the values of each row unique
+    def swapToFront(self, rows, values):
+        matches = rows == values[:, None]
+        found = np.flatnonzero(matches.any(axis=1))
+        rows[found, matches[found].argmax(axis=1)] = rows[found, 0]
+        rows[:, 0] = values
+
+    # one-point crossover of the rows of parentsA and parentsB
+    def crossover(self, parentsA, parentsB):
+        numMoves = parentsA.shape[1]
         if numMoves == 1:
-            return chromosomeA
-
-        point = np.random.randint(1, numMoves)
-        return chromosomeA[: 4 * point] + chromosomeB[4 * point :]
-
-    def mutation(self, chromosome, quartoGameState):
-        numMoves = len(chromosome) // 2
-        positions = list(range(0, numMoves, 2))
-        pieces = list(range(1, numMoves, 2))
-
-        if np.random.sample() < 0.8:
-            mutationPoint = np.random.choice(positions)
+            return parentsA.copy()
+
+        points = np.random.randint(1, numMoves, size=len(parentsA))
+        fromA = np.arange(numMoves) < points[:, None]
+        return np.where(fromA[:, :, None], parentsA, parentsB)
+
+    # replaces one gene of every row, a position 80% of the time and a next piece otherwise
+    def mutation(self, parents, quartoGameState):
+        children = parents.copy()
+        rows = np.arange(len(children))
+        moves = np.random.randint(children.shape[1], size=len(children))
+        genes = (np.random.random(len(children)) >= 0.8).astype(np.intp)
+
+        positions = np.array(sorted(quartoGameState[2]), dtype=np.int8)
+        pieces = np.array(sorted(quartoGameState[1]), dtype=np.int8)
+        values = positions[np.random.randint(len(positions), size=len(children))]
+        if len(pieces):
+            values = np.where(genes == 1, pieces[np.random.randint(len(pieces), size=len(children))], values)
         else:
-            mutationPoint = np.random.choice(pieces)
-
-        if mutationPoint % 2 == 0:  # move position
-            mutation = sample(list(quartoGameState[2]), 1)[0]
-        else:  # move nextPiece
-            mutation = sample(list(quartoGameState[1]), 1)[0]
-
-        move = qutil.convertIntMoveToStr(mutation)
-        mutatedChromosome = (
-            chromosome[: 2 * mutationPoint] + move + chromosome[2 * mutationPoint + 2 :]
-        )
-
-        return mutatedChromosome
-
-    def isValidChromosome(self, chromosome, quartoGameState):
-        positions = [int(chromosome[i : i + 2]) for i in range(0, len(chromosome), 4)] + list(
-            set(range(16)) - quartoGameState[2]
-        )
-        nextPieces = [int(chromosome[i : i + 2]) for i in range(2, len(chromosome), 4)] + list(
-            set(range(16)) - quartoGameState[1]
+            genes[:] = 0
+        children[rows, moves, genes] = values
+        return children
+
+    # rows whose positions are empty and distinct, whose pieces are available and distinct and whose first move is
+    # safe
+    def validChromosomes(self, population, quartoGameState):
+        emptyCells = np.zeros(17, dtype=bool)
+        emptyCells[list(quartoGameState[2])] = True
+        availablePieces = np.zeros(17, dtype=bool)
+        availablePieces[list(quartoGameState[1]) + [qutil.NULL_PIECE]] = True
+
+        valid = np.ones(len(population), dtype=bool)
+        for gene, available in enumerate((emptyCells, availablePieces)):
+            values = np.sort(population[:, :, gene], axis=1)
+            valid &= available[values].all(axis=1) & (values[:, 1:] != values[:, :-1]).all(axis=1)
+        if self.safeMoves:
+            safe = np.zeros((17, 17), dtype=bool)
+            safe[tuple(np.array(self.safeMoves).T)] = True
+            valid &= safe[population[:, 0, 0], population[:, 0, 1]]
+        return valid
+
+    # The evaluation cache of one generateSolution call. Thousands of chromosomes share their first one or two
+    # moves, so the result of the game after every prefix of up to CACHED_PREFIX_MOVES moves is kept in a table
+    # indexed by its move codes: 10 or -10 once a move of the prefix has won, 0 otherwise. Longer prefixes are
+    # rarely shared and whole chromosomes are looked up in the reservation tree (addToPopulation).
+    def resetCache(self):
+        self.prefixResults = [
+            np.full(NUM_MOVE_CODES ** (numMoves + 1), UNKNOWN_RESULT, dtype=np.int8)
+            for numMoves in range(CACHED_PREFIX_MOVES)
+        ]
+        self.evaluations = 0
+        self.chromosomeHits = 0  # chromosomes bred again
+        self.prefixHits = 0  # prefixes of new chromosomes found in the cache
+        self.boardsEvaluated = 0
+
+    # Evaluates the leaf nodes of a population. The board after every move of every chromosome is built at once,
+    # and all of them except the cached prefixes and the boards after a cached winning move are checked in one
+    # batched call. A chromosome ends at its first winning move, 10 if it is ours and -10 if it is the opponent's,
+    # otherwise the three-piece lines are counted as in lineEvaluation.
+    def evaluatePopulation(self, population, quartoGameState):
+        numChromosomes, numMoves, _ = population.shape
+        if numChromosomes == 0:
+            return np.zeros(0, dtype=np.int8)
+
+        board = quartoGameState[0]
+        placedPieces = np.empty((numChromosomes, numMoves), dtype=np.uint8)
+        placedPieces[:, 0] = board.current
+        placedPieces[:, 1:] = population[:, :-1, 1]
+        boards = np.tile(board.toCells(), (numChromosomes, numMoves, 1))
+        rows = np.arange(numChromosomes)
+        for move in range(numMoves):
+            boards[rows, move:, population[:, move, 0]] = placedPieces[:, move, None]
+
+        # the leaf boards are always checked for their three-piece lines
+        results = np.zeros((numChromosomes, numMoves), dtype=np.int8)
+        hits = np.zeros((numChromosomes, numMoves), dtype=bool)
+        codes = population[:, :, 0].astype(np.intp) * MOVE_CODE_BASE + population[:, :, 1]
+        prefixIndices = np.zeros((numChromosomes, numMoves), dtype=np.intp)
+        cachedMoves = min(CACHED_PREFIX_MOVES, numMoves - 1)
+        for move in range(cachedMoves):
+            prefixIndices[:, move] = codes[:, move] + (prefixIndices[:, move - 1] * NUM_MOVE_CODES if move else 0)
+            cachedResults = self.prefixResults[move][prefixIndices[:, move]]
+            hits[:, move] = cachedResults != UNKNOWN_RESULT
+            results[hits[:, move], move] = cachedResults[hits[:, move]]
+        self.prefixHits += int(np.count_nonzero(hits))
+
+        missing = ~hits
+        missing[:, 1:] &= ~np.logical_or.accumulate(results != 0, axis=1)[:, :-1]
+        missingIndices = np.flatnonzero(missing)
+        wins, counts = qutil.batchEvaluateBoards(boards.reshape(-1, 16)[missingIndices])
+        self.boardsEvaluated += len(missingIndices)
+        winValues = np.where(missingIndices % numMoves % 2 == 0, 10, -10)
+        results.ravel()[missingIndices] = np.where(wins, winValues, 0)
+        threeCounts = np.zeros(numChromosomes * numMoves, dtype=np.int64)
+        threeCounts[missingIndices] = counts
+
+        # the result of a prefix holds from its first winning move on
+        ended = results != 0
+        firstWins = np.where(ended.any(axis=1), ended.argmax(axis=1), numMoves)
+        finalResults = results[rows, np.minimum(firstWins, numMoves - 1)]
+        for move in range(cachedMoves):
+            self.prefixResults[move][prefixIndices[:, move]] = np.where(firstWins <= move, finalResults, 0)
+
+        lineEvaluations = (-1 if numMoves % 2 == 1 else 1) * threeCounts.reshape(numChromosomes, numMoves)[:, -1]
+        return np.where(firstWins < numMoves, finalResults, lineEvaluations).astype(np.int8)
+
+    # new chromosomes from random pairs of parents, by mutation or crossover, keeping the valid ones
+    def breed(self, parents, numChildren, quartoGameState):
+        numParents = len(parents)
+        parentsA = np.random.randint(numParents, size=numChildren)
+        parentsB = np.random.randint(numParents - 1, size=numChildren)
+        parentsB += parentsB >= parentsA
+
+        mutated = np.random.random(numChildren) < self.mutationRate
+        crossed = ~mutated & (np.random.random(numChildren) < self.crossoverRate)
+        children = np.concatenate(
+            [
+                self.mutation(parents[parentsA[mutated]], quartoGameState),
+                self.crossover(parents[parentsA[crossed]], parents[parentsB[crossed]]),
+            ]
         )
-        if len(set(positions)) < len(positions):
-            return False
-        if len(set(nextPieces)) < len(nextPieces):
-            return False
-
-        return True
-
-    # evaluate chromosome leaf node
-    def evaluate(self, chromosome, quartoGameState):
-        movePath = self.decodeChromosome(chromosome)
-        boardEncoding = quartoGameState[0]
-        tempCurrentPiece = int(boardEncoding[-2:])
-        evaluation = 0
-        myTurn = True
-        isGameOver = False
-
-        # update board encoding and temporary piece
-        for move in movePath:
-            tempCurrentPiece = qutil.convertIntMoveToStr(tempCurrentPiece)
-            boardEncoding = (
-                boardEncoding[: 2 * move[0]] + tempCurrentPiece + boardEncoding[2 * move[0] + 2 :]
-            )
-            tempCurrentPiece = move[1]
-
-            if qutil.isGameOverEncoding(boardEncoding):
-                isGameOver = True
-                if myTurn:
-                    evaluation = 10
-                else:
-                    evaluation = -10
-                break
-
-            myTurn = not myTurn
-
-        # case when no player has won
-        if not isGameOver:
-            evaluation = self.lineEvaluation(boardEncoding, not myTurn)
-
-        return evaluation
+        return children[self.validChromosomes(children, quartoGameState)]
 
     # recursive function to update the fitness of the top N chromosomes
     def computeFitness(self, node, evaluation, i):
         if self.fitnessCounter >= self.fitnessCountLimit:
             return
-        if node.is_leaf:
-            self.fitness[node.name] = evaluation
+        tree = self.reservationTree
+        if tree.isLeaf(node):
+            self.fitness[tree.leafChromosomes[node]] = evaluation
             self.fitnessCounter += 1
         else:
-            for child in [n for n in node.children if n.value == evaluation]:
+            for child in [n for n in tree.children[node].values() if tree.values[n] == evaluation]:
                 self.computeFitness(child, evaluation, i)
 
+    # evaluate new chromosomes in one batch and add them to the population and the reservation tree - chromosomes
+    # already in the tree keep their leaf evaluation
+    def addToPopulation(self, population, quartoGameState):
+        leafNodes = self.reservationTree.leafNodes
+        newRows = dict()
+        for row, chromosome in enumerate(self.encodeChromosomes(population)):
+            self.fitness[chromosome] = 0
+            if chromosome not in leafNodes:
+                newRows.setdefault(chromosome, row)
+        self.chromosomeHits += len(population) - len(newRows)
+
+        leafEvaluations = self.evaluatePopulation(population[list(newRows.values())], quartoGameState)
+        self.evaluations += len(newRows)
+        for chromosome, leafEvaluation in zip(newRows, leafEvaluations.tolist()):
+            self.reservationTree.addPath(chromosome, leafEvaluation)
+
+    # the cache counters of the generation just finished
+    def recordGeneration(self):
+        for counter in ("evaluations", "chromosomeHits", "prefixHits", "boardsEvaluated"):
+            self.searchInfo[counter].append(getattr(self, counter) - sum(self.searchInfo[counter]))
+        self.searchInfo["generations"] = len(self.searchInfo["evaluations"]) - 1
+
+    # a new reservation tree, evaluation cache and search info for the next move
+    def resetSearch(self):
+        self.reservationTree = ReservationTree()
+        self.resetCache()
+        # counters per generation, the initial population first
+        self.searchInfo = {
+            "generations": 0,
+            "evaluations": [],
+            "chromosomeHits": [],
+            "prefixHits": [],
+            "boardsEvaluated": [],
+        }
+
     # main Genetic Minimax implementation
     def generateSolution(self, quartoGameState):
-        # initialize reservation tree
-        self.reservationTree = ReservationTree()
+        self.startTime = time.time()
+        self.resetSearch()
 
         # reduce initial population size to maximum possible moves explorable
         initialPopulationSize = self.initialPopulationSize
         maxPopulationSize = self.maxPopulationSize
-        self.fitnessCountLimit = self.maxPopulationSize
 
+        # early positions are played from the book
+        board = quartoGameState[0]
+        if self.openingBook is not None:
+            bookEntry = self.openingBook.lookup(board)
+            if bookEntry is not None:
+                return bookEntry[1], bookEntry[0]
+
+        # late positions are solved - a proven win/loss is scored like a win/loss leaf
+        if self.endgameSolver is not None and board.numEmptyCells() <= self.endgameThreshold:
+            value, move = self.endgameSolver.solve(board)
+            return move, 10 * value
+
+        # An immediate win is played right away and the piece dimension of the first move is pruned to pieces
+        # the opponent cannot win with. When every piece is poisoned the game is lost and any move will do.
+        threats = qutil.ThreatIndex(board)
+        availablePositions = sorted(quartoGameState[2])
+        availableNextPieces = sorted(quartoGameState[1]) or [16]
+        if threats.isWinningPiece(board.current):
+            for position in availablePositions:
+                if qutil.isWinningMove(board, position, board.current):
+                    return (position, availableNextPieces[0]), 10
+        if board.available == 0:
+            self.safeMoves = [(position, 16) for position in availablePositions]
+        else:
+            self.safeMoves = [
+                (position, nextPiece)
+                for position in availablePositions
+                for nextPiece in qutil.getMaskIndices(
+                    board.available & ~threats.getPoisonedPieces(position)
+                )
+            ]
+        if not self.safeMoves:
+            return (availablePositions[0], availableNextPieces[0]), -10
+
+        # the population does not grow past twice the number of possible chromosomes
         numPossibleMoves = len(quartoGameState[2])
+        populationLimit = None
         if numPossibleMoves > self.searchDepth:
             maxPossibleStates = self.getNumStates(numPossibleMoves)
+            populationLimit = int(2 * maxPossibleStates)
             if maxPossibleStates < initialPopulationSize:
                 initialPopulationSize = int(1.5 * maxPossibleStates)
                 maxPopulationSize = int(2 * maxPossibleStates)
-                self.fitnessCountLimit = maxPopulationSize
 
-        # randomize initial population
+        if self.workers > 1 and not mp.current_process().daemon:
+            bestMove = self.evolveIslands(quartoGameState, initialPopulationSize, maxPopulationSize)
+        else:
+            self.startEvolution(quartoGameState, initialPopulationSize, maxPopulationSize)
+            if self.timeLimitMs is None:
+                self.evolve(self.maxGenerations)
+            else:
+                self.evolveUntilDeadline(populationLimit)
+            bestMove = self.getBestMove()
+        self.recordMove()
+        return bestMove
+
+    # randomize initial population
+    def startEvolution(self, quartoGameState, initialPopulationSize, maxPopulationSize):
+        self.quartoGameState = quartoGameState
+        self.populationSizes = (initialPopulationSize, maxPopulationSize)
+        self.fitnessCountLimit = maxPopulationSize
         self.fitness.clear()
-        for _ in range(initialPopulationSize):
-            chromosome, leafEvaluation = self.createChromosome(quartoGameState)
-            self.fitness[chromosome] = 0
-            self.reservationTree.addPath(chromosome, leafEvaluation)
+        population = self.createPopulation(initialPopulationSize, quartoGameState)
+        self.addToPopulation(population, quartoGameState)
+        self.recordGeneration()
+
+    # runs numGenerations generations, the immigrants from another island joining the population first
+    def evolve(self, numGenerations, immigrants=None):
+        if immigrants is not None:
+            self.addToPopulation(immigrants, self.quartoGameState)
+        for _ in range(numGenerations):
+            self.runGeneration()
+
+    def runGeneration(self):
+        quartoGameState = self.quartoGameState
+        initialPopulationSize, maxPopulationSize = self.populationSizes
+
+        # perform crossover and mutation - only full length chromosomes have offspring
+        parents = self.decodeChromosomes(list(self.fitness.keys()))
+        numChildren = maxPopulationSize - max(len(parents), initialPopulationSize)
+        if len(parents) >= 2 and numChildren > 0 and parents.shape[1] >= self.searchDepth:
+            self.addToPopulation(self.breed(parents, numChildren, quartoGameState), quartoGameState)
+        self.recordGeneration()
+
+        # set next generation's initial population as the top N chromosomes of this generation
+        self.rankPopulation()
+
+    # Anytime search of one move. The time of the last generation estimates the next one, which only runs if it
+    # would end before the deadline. While populationGrowth times that still leaves time for two more generations,
+    # both population sizes grow first, up to populationLimit. Two generations in a row without a new chromosome
+    # end the search early.
+    def evolveUntilDeadline(self, populationLimit):
+        deadline = self.startTime + self.timeLimitMs / 1000
+        generationTime = time.time() - self.startTime
+        while True:
+            initialPopulationSize, maxPopulationSize = self.populationSizes
+            remainingTime = deadline - time.time()
+            canGrow = populationLimit is None or maxPopulationSize < populationLimit
+            if canGrow and remainingTime > 3 * self.populationGrowth * generationTime:
+                maxPopulationSize = int(maxPopulationSize * self.populationGrowth)
+                if populationLimit is not None:
+                    maxPopulationSize = min(maxPopulationSize, populationLimit)
+                initialPopulationSize = int(initialPopulationSize * self.populationGrowth)
+                generationTime *= maxPopulationSize / self.populationSizes[1]
+                self.populationSizes = (min(initialPopulationSize, maxPopulationSize), maxPopulationSize)
+                self.fitnessCountLimit = maxPopulationSize
+            if remainingTime < generationTime:
+                break
 
-        bestChromosome = ""
-        finalEvaluation = -1
-        for _ in range(self.maxGenerations):
-            # perform crossover and mutation
-            parents = list(self.fitness.keys())
+            startTime = time.time()
+            self.runGeneration()
+            generationTime = time.time() - startTime
+            if self.searchInfo["evaluations"][-2:] == [0, 0]:
+                break
 
-            for _ in range(maxPopulationSize - np.max([len(parents), initialPopulationSize])):
-                # random parent selection
-                if len(parents) < 2:
-                    break
-                a, b = sample(parents, 2)
-
-                # random mutation
-                if np.random.sample() < self.mutationRate:
-                    mutatedChild = self.mutation(a, quartoGameState)
-                    if len(mutatedChild) < 4 * self.searchDepth:
-                        continue
-                    if self.isValidChromosome(mutatedChild, quartoGameState):
-                        self.fitness[mutatedChild] = 0
-                        leafEvaluation = self.evaluate(mutatedChild, quartoGameState)
-                        self.reservationTree.addPath(mutatedChild, leafEvaluation)
-
-                    continue
-
-                # crossover
-                if a == b:
-                    continue
-                if np.random.sample() < self.crossoverRate:
-                    crossoverChild = self.crossover(a, b)
-                    if len(crossoverChild) < 4 * self.searchDepth:
-                        continue
-                    if self.isValidChromosome(crossoverChild, quartoGameState):
-                        self.fitness[crossoverChild] = 0
-                        leafEvaluation = self.evaluate(crossoverChild, quartoGameState)
-                        self.reservationTree.addPath(crossoverChild, leafEvaluation)
-
-            # update fitness for all chromosomes in this generation
-            self.fitnessCounter = 0
-            self.fitness.clear()
-            leafEvaluations = sorted(self.reservationTree.uniqueValues)[::-1]
-            for i in range(len(leafEvaluations)):
-                self.computeFitness(self.reservationTree.rootNode, leafEvaluations[i], i)
-
-            # set next generation's initial population as the top N chromosomes of this generation
-            bestChromosome = max(self.fitness, key=lambda chromosome: self.fitness[chromosome])
-            finalEvaluation = self.fitness[bestChromosome]
-
-        bestMove = (
-            int(bestChromosome[0] + bestChromosome[1]),
-            int(bestChromosome[2] + bestChromosome[3]),
+    # update fitness for all chromosomes in the reservation tree
+    def rankPopulation(self):
+        self.fitnessCounter = 0
+        self.fitness.clear()
+        leafEvaluations = sorted(self.reservationTree.uniqueValues)[::-1]
+        for i in range(len(leafEvaluations)):
+            self.computeFitness(self.reservationTree.rootNode, leafEvaluations[i], i)
+
+    # the first move of the best chromosome in the reservation tree, available at any point of the search
+    def getBestMove(self):
+        bestChromosome, value = self.reservationTree.getBestChromosome()
+        return divmod(bestChromosome[0], MOVE_CODE_BASE), value
+
+    # the search info of the move just searched, summed up in the move history of the game
+    def recordMove(self):
+        self.searchInfo["populationSize"] = self.populationSizes[1]
+        self.searchInfo.setdefault("timeMs", round((time.time() - self.startTime) * 1000, 2))
+        self.moveHistory.append(
+            {
+                "emptyCells": self.quartoGameState[0].numEmptyCells(),
+                "generations": self.searchInfo["generations"],
+                "evaluations": sum(self.searchInfo["evaluations"]),
+                "populationSize": self.searchInfo["populationSize"],
+                "timeMs": self.searchInfo["timeMs"],
+            }
+        )
+
+    # the count fittest chromosomes as a population
+    def getBestChromosomes(self, count):
+        best = sorted(self.fitness, key=lambda chromosome: self.fitness[chromosome], reverse=True)[:count]
+        return self.decodeChromosomes(best)
+
+    # every leaf of the reservation tree as a population, with the leaf evaluations
+    def getLeaves(self):
+        tree = self.reservationTree
+        leafEvaluations = np.array([tree.values[leaf] for leaf in tree.leafNodes.values()], dtype=np.int8)
+        return self.decodeChromosomes(list(tree.leafNodes)), leafEvaluations
+
+    # Island model search of one move. This process evolves the first island and workers - 1 processes the others,
+    # migrationInterval generations at a time. In between, the best chromosomes of every island join the next
+    # island (a ring). At the end the leaves of the other islands are added to the reservation tree of the first,
+    # which picks the move as in the serial search. The efficiency in searchInfo is the time the islands were
+    # busy over workers times the wall time.
+    def evolveIslands(self, quartoGameState, initialPopulationSize, maxPopulationSize):
+        startTime = time.time()
+        islands = self.getIslands()
+        numIslands = len(islands) + 1
+        busyTimes = np.zeros(numIslands)
+
+        # sends a command to the island processes and runs its local part meanwhile
+        def broadcast(messages, runLocal):
+            for (_, connection), message in zip(islands, messages):
+                connection.send(message)
+            localStartTime = time.time()
+            results = [runLocal()]
+            busyTimes[0] += time.time() - localStartTime
+            for i, (_, connection) in enumerate(islands, 1):
+                result, busyTime = connection.recv()
+                busyTimes[i] += busyTime
+                results.append(result)
+            return results
+
+        seeds = np.random.randint(2**31, size=len(islands))
+        islandSizes = (-(-initialPopulationSize // numIslands), -(-maxPopulationSize // numIslands))
+        broadcast(
+            [("start", (quartoGameState, self.safeMoves, *islandSizes, seed)) for seed in seeds],
+            lambda: self.startEvolution(quartoGameState, *islandSizes),
         )
-        return bestMove, finalEvaluation
 
+        def evolveLocal(numGenerations, immigrants):
+            self.evolve(numGenerations, immigrants)
+            return self.getBestChromosomes(self.numMigrants)
+
+        # With a time limit the islands evolve until the next migration would end after the deadline, keeping
+        # as much time as the start took for the merge. The island populations do not grow.
+        deadline = None
+        if self.timeLimitMs is not None:
+            deadline = self.startTime + self.timeLimitMs / 1000
+            segmentTime = mergeTime = time.time() - startTime
+        immigrants = [None] * numIslands
+        generations = 0
+        while True:
+            if deadline is None:
+                numGenerations = min(self.migrationInterval, self.maxGenerations - generations)
+                if numGenerations <= 0:
+                    break
+            else:
+                numGenerations = self.migrationInterval
+                if time.time() + segmentTime + mergeTime > deadline:
+                    break
+            segmentStartTime = time.time()
+            migrants = broadcast(
+                [("evolve", (numGenerations, immigrants[i], self.numMigrants)) for i in range(1, numIslands)],
+                lambda: evolveLocal(numGenerations, immigrants[0]),
+            )
+            immigrants = migrants[-1:] + migrants[:-1]
+            generations += numGenerations
+            segmentTime = time.time() - segmentStartTime
 
+        mergeStartTime = time.time()
+        results = broadcast([("finish", ())] * len(islands), lambda: None)[1:]
+        self.fitnessCountLimit = maxPopulationSize
+        for (leaves, leafEvaluations), _ in results:
+            for chromosome, leafEvaluation in zip(self.encodeChromosomes(leaves), leafEvaluations.tolist()):
+                self.reservationTree.addPath(chromosome, leafEvaluation)
+        bestMove = self.getBestMove()
+
+        # the counters of the islands are added up per generation
+        for counter in ("evaluations", "chromosomeHits", "prefixHits", "boardsEvaluated"):
+            counts = [self.searchInfo[counter]] + [info[counter] for _, info in results]
+            self.searchInfo[counter] = np.sum(counts, axis=0).tolist()
+        timeMs = (time.time() - startTime) * 1000
+        self.searchInfo.update(
+            {
+                "generations": generations,
+                "workers": numIslands,
+                "islandMs": np.round(busyTimes * 1000, 2).tolist(),
+                "mergeMs": round((time.time() - mergeStartTime) * 1000, 2),
+                "timeMs": round(timeMs, 2),
+                "efficiency": float(busyTimes.sum() * 1000 / (numIslands * timeMs)),
+            }
+        )
+        return bestMove
+
+    # the processes of the islands after the first
+    def getIslands(self):
+        if self.islands is None:
+            self.islands = []
+            for _ in range(self.workers - 1):
+                connection, islandConnection = mp.Pipe()
+                process = mp.Process(target=runIsland, args=(self, islandConnection), daemon=True)
+                process.start()
+                self.islands.append((process, connection))
+        return self.islands
+
+    def closePool(self):
+        if self.islands is not None:
+            for process, connection in self.islands:
+                connection.send(None)
+                process.join()
+            self.islands = None
+
+    # the island processes are not sent along when the agent is pickled (island processes, mpBatchRun workers)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["islands"] = None
+        return state
+
+    # Searches the position serially and with the islands and compares the two. The efficiency is the speedup
+    # over the number of workers.
+    def measureIslandSpeedup(self, quartoGameState):
+        workers = self.workers
+        self.getIslands()
+
+        self.workers = 1
+        startTime = time.time()
+        serialMove = self.generateSolution(quartoGameState)
+        serialMs = (time.time() - startTime) * 1000
+        serialEvaluations = sum(self.searchInfo["evaluations"])
+
+        self.workers = workers
+        startTime = time.time()
+        islandMove = self.generateSolution(quartoGameState)
+        islandMs = (time.time() - startTime) * 1000
+
+        return {
+            "workers": workers,
+            "serialMs": round(serialMs, 2),
+            "islandMs": round(islandMs, 2),
+            "speedup": serialMs / max(islandMs, 0.01),
+            "efficiency": serialMs / max(islandMs, 0.01) / workers,
+            "busyEfficiency": self.searchInfo["efficiency"],
+            "serialEvaluations": serialEvaluations,
+            "islandEvaluations": sum(self.searchInfo["evaluations"]),
+            "serialMove": serialMove,
+            "islandMove": islandMove,
+        }
+
+
+# Minimax tree over the move prefixes of the population. Nodes are integer ids into parallel lists, the children
+# of a node are a dict from the move code to the child id (in insertion order), and nodes at an even
+# depth are MAX nodes. Inserting a path only changes the values on its way to the root, so the update stops at the
+# first ancestor whose value stays the same.
 class ReservationTree:
 
     def __init__(self) -> None:
-        self.rootNode = Node("root", value=-10)
-        self.leafNodes = dict()
+        self.rootNode = 0
+        self.children = [dict()]
+        self.parents = [-1]
+        self.depths = [0]
+        self.values = [-10]
+        self.maxDepth = 0
+        self.leafNodes = dict()  # chromosome -> node
+        self.leafChromosomes = dict()  # node -> chromosome
         self.uniqueValues = set()
 
     def showTree(self):
-        self.rootNode.show(attr_list=["value"])
-
-    # updates node values using minmax along a path from leaf to root
-    def minmax(self, leaf):
-        # determine if MIN or MAX
-        maxTurn = (len(leaf.name) / 4) % 2 == 0
-
-        # recurrently update node values
-        current = leaf
-        while current.parent != None:
-            current = current.parent
-            maxTurn = not maxTurn
-
-            if maxTurn:
-                current.value = np.max([i.value for i in current.children])
+        stack = [(self.rootNode, "root")]
+        while stack:
+            node, name = stack.pop()
+            print(f"{'    ' * self.depths[node]}{name} [value={self.values[node]}]")
+            stack.extend((child, code) for code, child in reversed(self.children[node].items()))
+
+    def isLeaf(self, node):
+        return not self.children[node]
+
+    # Follows the first child with the value of its parent from the root down to a leaf. Returns the chromosome
+    # of that leaf, the principal line of the tree, and the root value.
+    def getBestChromosome(self):
+        node = self.rootNode
+        while not self.isLeaf(node):
+            value = self.values[node]
+            node = next(child for child in self.children[node].values() if self.values[child] == value)
+        return self.leafChromosomes[node], self.values[self.rootNode]
+
+    # node values along the path from node to the root after the value of child changed from old to new
+    def minmax(self, child, old, new):
+        node = self.parents[child]
+        while node >= 0:
+            value = self.values[node]
+            if self.depths[node] % 2 == 0:
+                if new > value:
+                    value = new
+                elif old == value and new < old:
+                    value = max(self.values[c] for c in self.children[node].values())
             else:
-                current.value = np.min([i.value for i in current.children])
-
-    # Given a chromosome, finds the last node in the tree where it exists
-    def findChromosomeNode(self, encoding):
-        currentRoot = self.rootNode
-        lastIndex = 0
-
-        for i in range(4, len(encoding) + 1, 4):
-            stop = True
-
-            for node in currentRoot.children:
-                if node.name == encoding[:i]:
-                    currentRoot = node
-                    lastIndex = i
-                    stop = False
-                    break
-
-            if stop:
+                if new < value:
+                    value = new
+                elif old == value and new > old:
+                    value = min(self.values[c] for c in self.children[node].values())
+
+            if value == self.values[node]:
+                return
+            old, new = self.values[node], value
+            self.values[node] = value
+            node = self.parents[node]
+
+    # Given a chromosome (a sequence of move codes), finds the last node in the tree where it exists and the number
+    # of its moves on the way there
+    def findChromosomeNode(self, chromosome):
+        current = self.rootNode
+        numMoves = 0
+        for move in chromosome:
+            child = self.children[current].get(move)
+            if child is None:
                 break
+            current = child
+            numMoves += 1
+        return current, numMoves
 
-        return currentRoot, lastIndex
-
-    # adds a new path of nodes from a chromosome encoding
-    def addPath(self, encoding, leafEvaluation):
-        current, lastIndex = self.findChromosomeNode(encoding)
-        movePath = [
-            (int(encoding[i] + encoding[i + 1]), int(encoding[i + 2] + encoding[i + 3]))
-            for i in range(lastIndex, len(encoding) - 3, 4)
-        ]
+    # adds a new path of nodes from a chromosome
+    def addPath(self, chromosome, leafEvaluation):
         self.uniqueValues.add(leafEvaluation)
-        for m in range(0, len(movePath)):
-            if m == len(movePath) - 1:  # leaf node
-                current = Node(
-                    encoding[0 : lastIndex + 4 * (m + 1)],
-                    value=leafEvaluation,
-                    parent=current,
-                )
-                self.minmax(current)
-                self.leafNodes[encoding] = current
-            else:
-                current = Node(encoding[0 : lastIndex + 4 * (m + 1)], value=-10, parent=current)
-
-    def computeFitness(self, encoding):
-        currNode = self.leafNodes[encoding]
-        leafValue = currNode.value  # type: ignore
-
-        while currNode is not None:
-            if currNode.parent.value == leafValue:  # type: ignore
-                currNode = currNode.parent
-                if currNode == self.rootNode:
-                    break
-            else:
-                break
+        current, numMoves = self.findChromosomeNode(chromosome)
+        if numMoves == len(chromosome):
+            return
 
-        return self.rootNode.max_depth - currNode.depth + 1  # type: ignore
+        # the new nodes form a chain below current, so they all take the leaf value
+        attached = current
+        for move in chromosome[numMoves:]:
+            node = len(self.values)
+            self.children[current][move] = node
+            self.children.append(dict())
+            self.parents.append(current)
+            self.depths.append(self.depths[current] + 1)
+            self.values.append(leafEvaluation)
+            current = node
+        self.leafNodes[chromosome] = current
+        self.leafChromosomes[current] = chromosome
+        self.maxDepth = max(self.maxDepth, self.depths[current])
+
+        # a node that had no children (the root or a former leaf) takes the value of its new child
+        old = self.values[attached]
+        if len(self.children[attached]) == 1:
+            new = leafEvaluation
+        elif self.depths[attached] % 2 == 0:
+            new = max(old, leafEvaluation)
+        else:
+            new = min(old, leafEvaluation)
+        if new != old:
+            self.values[attached] = new
+            if attached != self.rootNode:
+                self.minmax(attached, old, new)
+
+    def computeFitness(self, chromosome):
+        node = self.leafNodes[chromosome]
+        leafValue = self.values[node]
+        while node != self.rootNode and self.values[self.parents[node]] == leafValue:
+            node = self.parents[node]
+        return self.maxDepth - self.depths[node] + 1
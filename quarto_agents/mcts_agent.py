@@ -0,0 +1,293 @@
+from quarto_agents.generic_quarto_agent import GenericQuartoAgent
+import math
+import numpy as np
+import time
+import quarto_util as qutil
+from quarto_agents.endgame_solver import EndgameSolver
+
+
+# Monte-Carlo tree search (UCT)
+# The tree is stored in flat arrays indexed by node, the children of a node in one contiguous block, so the UCT
+# scores of all children are computed at once. Rewards are 1 win, 0.5 draw, 0 loss and values[i] sums them for the
+# player who made the move into node i. Leaves are collected batchSize at a time - every node on a selected path
+# counts its visit right away (a virtual loss until the reward arrives), which spreads the batch over the tree -
+# and played out together with quarto_util.batchRandomPlayouts.
+# Like the search agents, expansions skip moves handing over a winning piece, and a node whose current piece wins,
+# whose last piece draws or whose moves all hand over a winning piece is terminal with a known reward.
+# The subtree of the position reached after the opponent's reply is kept for the next move.
+class MCTSAgent(GenericQuartoAgent):
+    def __init__(
+        self,
+        iterations=10000,
+        timeLimitMs=None,
+        batchSize=32,
+        exploration=0.7,
+        maxNodes=2**20,
+        reuseTree=True,
+        endgameThreshold=8,
+        seed=None,
+    ) -> None:
+        super().__init__()
+        assert iterations is not None or timeLimitMs is not None, "MCTS needs an iteration or time budget."
+        budget = f"{iterations}" if timeLimitMs is None else f"{timeLimitMs}ms"
+        super().setName(f"MCTS-{budget}")
+
+        # the search of a move stops after iterations playouts or timeLimitMs, whichever comes first
+        self.iterations = iterations
+        self.timeLimitMs = timeLimitMs
+        self.batchSize = batchSize
+        self.exploration = exploration
+        self.maxNodes = maxNodes
+        self.reuseTree = reuseTree
+        self.rng = np.random.default_rng(seed)
+        self.searchInfo = dict()
+
+        # positions with at most endgameThreshold empty cells are solved exactly instead of sampled
+        self.endgameThreshold = endgameThreshold
+        self.endgameSolver = EndgameSolver() if endgameThreshold else None
+
+        self.resetTree()
+
+    def resetTree(self):
+        self.numNodes = 0
+        self.visits = np.zeros(0)
+        self.values = np.zeros(0)
+        self.terminal = np.zeros(0)  # known reward of terminal nodes, nan otherwise
+        self.firstChild = np.zeros(0, dtype=np.int32)  # -1 until expanded
+        self.numChildren = np.zeros(0, dtype=np.int16)
+        self.movePositions = np.zeros(0, dtype=np.int8)
+        self.movePieces = np.zeros(0, dtype=np.int8)
+        self.root = self.addNodes(1)
+        # node and position after the last move played, where the search continues after the opponent's reply
+        self.lastNode = None
+        self.lastKey = None
+
+    # appends count fresh nodes, returns the index of the first one or None when the tree is full
+    def addNodes(self, count):
+        if self.numNodes + count > self.maxNodes:
+            return None
+        if self.numNodes + count > len(self.visits):
+            capacity = min(self.maxNodes, max(2**12, 2 * len(self.visits), self.numNodes + count))
+            for name, fill in (
+                ("visits", 0),
+                ("values", 0),
+                ("terminal", np.nan),
+                ("firstChild", -1),
+                ("numChildren", 0),
+                ("movePositions", 0),
+                ("movePieces", 0),
+            ):
+                old = getattr(self, name)
+                grown = np.full(capacity, fill, dtype=old.dtype)
+                grown[: self.numNodes] = old[: self.numNodes]
+                setattr(self, name, grown)
+        first = self.numNodes
+        self.numNodes += count
+        nodes = slice(first, self.numNodes)
+        self.visits[nodes] = 0
+        self.values[nodes] = 0
+        self.terminal[nodes] = np.nan
+        self.firstChild[nodes] = -1
+        self.numChildren[nodes] = 0
+        return first
+
+    def onGameStart(self):
+        self.resetTree()
+        if self.endgameSolver is not None:
+            self.endgameSolver.table.clear()
+
+    # Every piece is equivalent on the empty board (any piece maps onto any other by the piece symmetries of
+    # quarto_util.canonicalizeBoard), so there is nothing to search and the first piece is a random one
+    def makeFirstMove(self, quartoGameState, gui_mode=False):
+        nextPiece = int(self.rng.choice(qutil.getMaskIndices(quartoGameState[0].available)))
+        if gui_mode:
+            print(f"MCTS agent picked first piece {nextPiece}")
+        return nextPiece
+
+    def makeMove(self, quartoGameState, gui_mode=False):
+        board = quartoGameState[0].copy()
+        startTime = time.time()
+        threats = qutil.ThreatIndex(board)
+        nextPieces = qutil.getMaskIndices(board.available) or (16,)
+        positions = qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK)
+
+        if threats.isWinningPiece(board.current):
+            position = next(p for p in positions if qutil.isWinningMove(board, p, board.current))
+            nextPiece = nextPieces[0]
+            self.searchInfo = {"iterations": 0, "nodes": 0, "timeMs": 0.0}
+        elif self.endgameSolver is not None and board.numEmptyCells() <= self.endgameThreshold:
+            _, (position, nextPiece) = self.endgameSolver.solve(board)
+            self.searchInfo = {
+                "iterations": 0,
+                "nodes": self.endgameSolver.nodes,
+                "timeMs": self.endgameSolver.timeMs,
+            }
+            self.resetTree()
+        else:
+            self.setRoot(board)
+            iterations = self.search(board, startTime)
+            node = self.getBestChild()
+            if node is None:
+                # terminal root - every piece left lets the opponent win
+                position, nextPiece = positions[0], nextPieces[0]
+            else:
+                position, nextPiece = int(self.movePositions[node]), int(self.movePieces[node])
+            self.searchInfo = {
+                "iterations": iterations,
+                "nodes": self.numNodes,
+                "timeMs": round((time.time() - startTime) * 1000, 2),
+            }
+            board.makeMove(position, nextPiece)
+            self.lastNode, self.lastKey = node, board.key()
+
+        if gui_mode:
+            print(
+                f"MCTS agent placed piece at cell {position} and nextPiece is {nextPiece}\n",
+                f"iterations: {self.searchInfo['iterations']}  nodes: {self.searchInfo['nodes']}",
+            )
+        return position, nextPiece
+
+    # Keeps the subtree of board if it follows the last move played by one opponent move, else starts a new tree
+    def setRoot(self, board):
+        if self.reuseTree and self.lastNode is not None and self.firstChild[self.lastNode] >= 0:
+            last = qutil.QuartoBoard.fromKey(self.lastKey)
+            placed = board.occupied & ~last.occupied
+            if placed.bit_count() == 1 and board.occupied == last.occupied | placed:
+                first = self.firstChild[self.lastNode]
+                children = slice(first, first + self.numChildren[self.lastNode])
+                matches = np.flatnonzero(
+                    (self.movePositions[children] == placed.bit_length() - 1)
+                    & (self.movePieces[children] == board.current)
+                )
+                if len(matches) != 0:
+                    self.reroot(first + int(matches[0]))
+                    return
+        self.resetTree()
+
+    # Makes node the root, dropping everything outside its subtree. The subtree is copied to the front of the
+    # arrays level by level, which keeps the children of every node in one block.
+    def reroot(self, node):
+        levels = [np.array([node])]
+        while True:
+            parents = levels[-1][self.firstChild[levels[-1]] >= 0]
+            if len(parents) == 0:
+                break
+            counts = self.numChildren[parents].astype(np.intp)
+            starts = np.cumsum(counts) - counts
+            levels.append(
+                np.repeat(self.firstChild[parents], counts) + np.arange(counts.sum()) - np.repeat(starts, counts)
+            )
+        order = np.concatenate(levels)
+        newIndex = np.full(self.numNodes, -1, dtype=np.int32)
+        newIndex[order] = np.arange(len(order))
+
+        for name in ("visits", "values", "terminal", "numChildren", "movePositions", "movePieces"):
+            array = getattr(self, name)
+            array[: len(order)] = array[order]
+        firstChild = self.firstChild[order]
+        self.firstChild[: len(order)] = np.where(firstChild >= 0, newIndex[firstChild], -1)
+        self.numNodes = len(order)
+        self.root = 0
+        self.lastNode = None
+
+    # Runs batches of playouts until the budget is spent, returns the number of playouts
+    def search(self, rootBoard, startTime):
+        deadline = startTime + self.timeLimitMs / 1000 if self.timeLimitMs is not None else np.inf
+        iterations = 0
+        while (self.iterations is None or iterations < self.iterations) and time.time() < deadline:
+            batchSize = self.batchSize
+            if self.iterations is not None:
+                batchSize = min(batchSize, self.iterations - iterations)
+            paths, rewards, leaves = [], [], []
+            for _ in range(batchSize):
+                board = rootBoard.copy()
+                path = self.selectLeaf(board)
+                paths.append(path)
+                leaf = path[-1]
+                if np.isnan(self.terminal[leaf]):
+                    rewards.append(None)
+                    leaves.append(board)
+                else:
+                    rewards.append(self.terminal[leaf])
+
+            if leaves:
+                # playout outcomes are for the player to move at the leaf, rewards for the player moving into it
+                playoutRewards = iter((1 - qutil.batchRandomPlayouts(leaves, self.rng)) / 2)
+            for path, reward in zip(paths, rewards):
+                if reward is None:
+                    reward = next(playoutRewards)
+                self.backpropagate(path, reward)
+            iterations += batchSize
+        return iterations
+
+    # Descends from the root by UCT, applying the moves to board. Nodes visited a second time are expanded.
+    # Returns the path, ending in a terminal node or a leaf to play out.
+    def selectLeaf(self, board):
+        node = self.root
+        path = [node]
+        self.visits[node] += 1
+        while np.isnan(self.terminal[node]):
+            if self.firstChild[node] < 0:
+                if (self.visits[node] == 1 and node != self.root) or not self.expand(node, board):
+                    break
+                if not np.isnan(self.terminal[node]):
+                    break
+            node = self.selectChild(node)
+            board.makeMove(int(self.movePositions[node]), int(self.movePieces[node]))
+            self.visits[node] += 1
+            path.append(node)
+        return path
+
+    def selectChild(self, node):
+        first = self.firstChild[node]
+        children = slice(first, first + self.numChildren[node])
+        visits = self.visits[children]
+        counts = np.maximum(visits, 1)
+        scores = self.values[children] / counts + self.exploration * np.sqrt(math.log(self.visits[node]) / counts)
+        scores[visits == 0] = np.inf
+        return first + int(scores.argmax())
+
+    # Adds the children of node, or marks it terminal. Returns False when the tree is full.
+    def expand(self, node, board):
+        threats = qutil.ThreatIndex(board)
+        positions = qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK)
+        if threats.isWinningPiece(board.current):
+            self.terminal[node] = 0.0
+            return True
+        if len(positions) == 1:
+            self.terminal[node] = 0.5
+            return True
+
+        moves = [
+            (position, nextPiece)
+            for position in positions
+            for nextPiece in qutil.getMaskIndices(board.available & ~threats.getPoisonedPieces(position))
+        ]
+        if not moves:
+            self.terminal[node] = 1.0
+            return True
+        first = self.addNodes(len(moves))
+        if first is None:
+            return False
+        # shuffled, so a budget smaller than the number of children does not favour the low cells
+        moves = np.array(moves)[self.rng.permutation(len(moves))]
+        children = slice(first, first + len(moves))
+        self.movePositions[children] = moves[:, 0]
+        self.movePieces[children] = moves[:, 1]
+        self.firstChild[node] = first
+        self.numChildren[node] = len(moves)
+        return True
+
+    # the visits were counted on the way down, rewards alternate between the two players along the path
+    def backpropagate(self, path, reward):
+        for node in reversed(path):
+            self.values[node] += reward
+            reward = 1 - reward
+
+    # most visited child of the root, None for a terminal root
+    def getBestChild(self):
+        first = self.firstChild[self.root]
+        if first < 0:
+            return None
+        children = slice(first, first + self.numChildren[self.root])
+        return first + int(np.argmax(self.visits[children]))
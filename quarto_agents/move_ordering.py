@@ -0,0 +1,99 @@
+import itertools
+import quarto_util as qutil
+
+
+# Move ordering stage for alpha-beta search. Moves are (position, nextPiece) tuples and are tried in this order:
+# 1. placements of the current piece that win immediately
+# 2. the transposition table / principal variation move
+# 3. killer moves - recent moves that caused a cutoff at the same ply
+# 4. the remaining moves by their history score - cutoffs seen for (position, nextPiece), weighted by depth^2
+# Sorting every move by history costs more than it saves right above the leaves, so nodes with less than
+# historyMinDepth plies left keep the natural order for the remaining moves.
+# Moves handing over a poisoned piece (see quarto_util.ThreatIndex) are left out, except for the winning placement.
+class MoveOrderer:
+    def __init__(self, winFirst=True, numKillers=2, useHistory=True, historyMinDepth=2) -> None:
+        self.winFirst = winFirst
+        self.numKillers = numKillers
+        self.useHistory = useHistory
+        self.historyMinDepth = historyMinDepth
+        self.clear()
+
+    def clear(self):
+        self.killers = [[] for _ in range(17)]
+        self.history = [[0] * 17 for _ in range(16)]
+        self.resetStats()
+
+    # The next search of the game starts plies moves further down - killers of the previous search move up to the
+    # ply they now belong to, the history scores are kept
+    def advance(self, plies):
+        self.killers = self.killers[plies:] + [[] for _ in range(plies)]
+
+    def resetStats(self):
+        self.orderedNodes = 0
+        self.cutoffs = 0
+        self.firstMoveCutoffs = 0
+        self.cutoffIndexSum = 0
+
+    def getStats(self):
+        return {
+            "orderedNodes": self.orderedNodes,
+            "cutoffs": self.cutoffs,
+            "firstMoveCutoffRate": self.firstMoveCutoffs / self.cutoffs if self.cutoffs != 0 else 0.0,
+            "avgCutoffIndex": self.cutoffIndexSum / self.cutoffs if self.cutoffs != 0 else 0.0,
+        }
+
+    # returns an iterator over at most searchWindow moves, best candidates first
+    # poisoned maps each position to the piece mask that must not be handed over after placing there, or is None
+    def orderMoves(
+        self, board, ply, depth, nextPieces, positions, priorityMove, searchWindow, poisoned=None
+    ):
+        self.orderedNodes += 1
+        front = []
+
+        if self.winFirst and board.current != qutil.NULL_PIECE:
+            for position in positions:
+                if qutil.isWinningMove(board, position, board.current):
+                    front.append((position, nextPieces[0]))
+                    break
+
+        if priorityMove is not None:
+            if poisoned is None or not poisoned[priorityMove[0]] >> priorityMove[1] & 1:
+                front.append(priorityMove)
+
+        for killer in self.killers[ply]:
+            if board.isEmpty(killer[0]) and killer[1] in nextPieces:
+                if poisoned is None or not poisoned[killer[0]] >> killer[1] & 1:
+                    front.append(killer)
+
+        seen = set(front)
+        if poisoned is None:
+            rest = (
+                (position, piece) for piece, position in itertools.product(nextPieces, positions)
+            )
+        else:
+            rest = (
+                (position, piece)
+                for piece, position in itertools.product(nextPieces, positions)
+                if not poisoned[position] >> piece & 1
+            )
+        if self.useHistory and depth >= self.historyMinDepth:
+            history = self.history
+            rest = sorted(rest, key=lambda move: history[move[0]][move[1]], reverse=True)
+        if seen:
+            rest = (move for move in rest if move not in seen)
+            front = list(dict.fromkeys(front))
+        return itertools.islice(itertools.chain(front, rest), searchWindow)
+
+    def recordCutoff(self, move, ply, depth, moveIndex):
+        self.cutoffs += 1
+        self.cutoffIndexSum += moveIndex
+        if moveIndex == 0:
+            self.firstMoveCutoffs += 1
+
+        if self.useHistory:
+            self.history[move[0]][move[1]] += depth * depth
+
+        killers = self.killers[ply]
+        if self.numKillers > 0 and move not in killers:
+            killers.insert(0, move)
+            del killers[self.numKillers :]
@@ -1,171 +1,828 @@
 from quarto_agents.generic_quarto_agent import GenericQuartoAgent
 import numpy as np
 import itertools
-import pandas as pd
+import multiprocessing as mp
+import os
+import time
 import quarto_util as qutil
+from quarto_agents.endgame_solver import EndgameSolver, WIN, LOSS
+from quarto_agents.move_ordering import MoveOrderer
+from quarto_agents.transposition_table import (
+    TranspositionTable,
+    MappedTranspositionTable,
+    createMappedTable,
+    EXACT,
+    LOWER_BOUND,
+    UPPER_BOUND,
+    PROVEN_DEPTH,
+)
+
+
+# raised inside the search when the time or node budget of a move runs out
+class SearchBudgetExceeded(Exception):
+    pass
+
+
+# agent of each pool worker of the parallel root search
+searchWorker = None
+
+
+def initSearchWorker(agent):
+    global searchWorker
+    searchWorker = agent
+    searchWorker.workers = 1
+
+
+# searches a share of the root moves in a pool worker, returns (score, move) or None if the budget ran out
+# together with the number of nodes searched, the number of inexact nodes among them and the table entries
+# along the best line
+def searchRootMoves(key, moves, depth, deadline, nodeLimit):
+    agent = searchWorker
+    agent.nodeLimit = nodeLimit
+    agent.startSearch()
+    agent.deadline = deadline
+    if deadline is not None:
+        agent.nextBudgetCheck = min(agent.nextBudgetCheck, 1024)
+    board = qutil.QuartoBoard.fromKey(key)
+    # the killers of the worker's last search move up with the game, as in NegamaxAgent.continueGame
+    if agent.moveOrderer is not None and agent.pvKey is not None:
+        plies = board.occupied.bit_count() - qutil.QuartoBoard.fromKey(agent.pvKey).occupied.bit_count()
+        if plies > 0:
+            agent.moveOrderer.advance(plies)
+    agent.pvKey = key
+    inexactNodes = agent.inexactNodes
+    try:
+        result = agent.searchMoves(board.copy(), depth, moves)
+    except SearchBudgetExceeded:
+        return None, agent.nodes, agent.inexactNodes - inexactNodes, []
+    # the table entries along the worker's best line, for the agent's own table
+    line = [(lineKey, entry) for lineKey, entry, _ in agent.followTable(board, result[1], depth)]
+    return result, agent.nodes, agent.inexactNodes - inexactNodes, line
+
+
+# Pondering worker - searches without a budget until the agent sets stopEvent
+def initPonderWorker(agent, stopEvent):
+    global searchWorker
+    searchWorker = agent
+    searchWorker.workers = 1
+    searchWorker.timeLimitMs = None
+    searchWorker.nodeLimit = None
+    searchWorker.stopEvent = stopEvent
+
+
+# Deepens the search of the given positions together, one depth at a time over all of them, until stopped.
+# Returns the deepest completed (score, move, depth) of every position searched.
+def ponderPositions(keys, newGame):
+    agent = searchWorker
+    if newGame:
+        agent.onGameStart()
+    boards = [qutil.QuartoBoard.fromKey(key) for key in keys]
+    results = dict()
+    agent.startSearch()
+    agent.nextBudgetCheck = 1024
+    try:
+        for depth in range(1, agent.depth + 1):
+            for key, board in zip(keys, boards):
+                if depth <= board.numEmptyCells():
+                    previous = results.get(key)
+                    score, move = agent.searchRoot(board.copy(), depth, previous[1] if previous else None)
+                    results[key] = (score, move, depth)
+    except SearchBudgetExceeded:
+        pass
+    return results
+
+
+# Iterative deepening of a pondered position in the pondering worker, continued after the pondered depth.
+# Returns the result, the search info and the principal variation.
+def searchPondered(key, pondered, timeLimitMs, nodeLimit):
+    agent = searchWorker
+    agent.timeLimitMs, agent.nodeLimit = timeLimitMs, nodeLimit
+    board = qutil.QuartoBoard.fromKey(key)
+    result = agent.iterativeDeepening(board, pondered)
+    agent.recordPrincipalVariation(board, result[1], agent.searchInfo["depth"])
+    agent.timeLimitMs, agent.nodeLimit = None, None
+    return result, agent.searchInfo, agent.principalVariation
 
 
 # NegaMax
-# Depth-limited search, move ordering, Alpha-Beta pruning, transposition table
+# Depth-limited search, move ordering, Alpha-Beta pruning, transposition table, iterative deepening
 class NegamaxAgent(GenericQuartoAgent):
-    def __init__(self, depth, transposition=None, searchWindow=256) -> None:
+    def __init__(
+        self,
+        depth,
+        transposition=None,
+        searchWindow=256,
+        tableSize=2**18,
+        replacement="depth",
+        symmetry=True,
+        symmetryMinDepth=2,
+        timeLimitMs=None,
+        nodeLimit=None,
+        moveOrdering=True,
+        endgameThreshold=8,
+        tablebase=None,
+        openingBook=None,
+        workers=1,
+        ponderWidth=4,
+    ) -> None:
         super().__init__()
         super().setName(f"Negamax-{depth}-{searchWindow}")
         self.depth = depth
         self.searchWindow = searchWindow
 
+        # positions are stored under their symmetry-canonical key - canonicalization costs more than searching
+        # the shallowest subtrees, so nodes with less than symmetryMinDepth plies left use the plain key
+        self.symmetry = symmetry
+        self.symmetryMinDepth = symmetryMinDepth
+
+        # with a time or node budget the search deepens 1, 2, 3... up to depth until the budget runs out
+        self.timeLimitMs = timeLimitMs
+        self.nodeLimit = nodeLimit
+        self.nodes = 0
+        self.nextBudgetCheck = np.inf
+        self.searchInfo = dict()
+        # counts the nodes whose result depends on the search depth or window (a heuristic score at the depth
+        # limit, a truncated move list, a table entry of a depth-limited search) - a win, loss or draw is only
+        # proven if none were met below it
+        self.inexactNodes = 0
+
+        # True uses the default MoveOrderer, False keeps the natural (nextPiece, position) order and any object
+        # with orderMoves/recordCutoff methods can be plugged in
+        if moveOrdering is True:
+            self.moveOrderer = MoveOrderer()
+        elif moveOrdering:
+            self.moveOrderer = moveOrdering
+        else:
+            self.moveOrderer = None
+
+        # positions with at most endgameThreshold empty cells are solved exactly instead of searched
+        # (EndgameSolver.calibrateThreshold finds the largest threshold that fits a time budget)
+        # tablebase is the path of a tablebase file (quarto_tablebase.py) probed by the search and the solver
+        self.endgameThreshold = endgameThreshold
+        self.tablebase = qutil.Tablebase(tablebase) if tablebase is not None else None
+        self.endgameSolver = EndgameSolver(tablebase=tablebase) if endgameThreshold else None
+
+        # openingBook is the path of an opening book file (quarto_book.py), read on the first lookup
+        self.openingBook = qutil.OpeningBook(openingBook) if openingBook is not None else None
+
+        # with workers > 1 the root moves are split over a process pool, each worker keeping its own tables
+        # (a transposition file is shared by all of them). Inside daemonic processes such as the mpBatchRun
+        # workers, which cannot start a pool, the search stays serial.
+        self.workers = workers
+        self.pool = None
+
+        # pondering (QuartoGame(ponder=True)) searches the positions after the ponderWidth most likely replies in a
+        # background process while the opponent thinks - a reply searched deep enough is then played right away,
+        # a shallower one is where iterative deepening continues from
+        self.ponderWidth = ponderWidth
+        self.ponderPool = None
+        self.ponderJob = None
+        self.ponderStop = None
+        self.ponderResults = dict()
+        self.ponderNewGame = True
+        self.stopEvent = None
+
+        # game-scoped search state, cleared by onGameStart: the principal variation of the last search (as moves
+        # from the position with key pvKey) and the positions of its continuation after the opponent's reply,
+        # mapped to the move searched first there
+        self.principalVariation = []
+        self.pvKey = None
+        self.pvMoves = dict()
+
+        # tableSize=None switches the transposition table off
+        # transposition names a table file in tables/ that is memory-mapped and shared with other processes
+        self.table = None
+        self.tableFileName = None
         self.transposition = transposition
         if transposition is not None:
-            self.initTransposition(transposition)
+            self.initTransposition(transposition, tableSize, replacement)
+        elif tableSize is not None:
+            self.table = TranspositionTable(tableSize, replacement)
 
     # Only used in debugging
     def makeFirstMove(self, quartoGameState, gui_mode=False):
         nextPiece = int(input("Pick your opponent's first piece: "))
         return nextPiece
 
+    # Everything learned during a game is kept until the next one starts - the in-memory transposition table,
+    # the killer moves and history scores, the endgame solver's table and the principal variation.
+    # A transposition file is meant to outlive the game and is left as it is.
+    def onGameStart(self):
+        if self.table is not None and not isinstance(self.table, MappedTranspositionTable):
+            self.table.clear()
+        if self.moveOrderer is not None:
+            self.moveOrderer.clear()
+        if self.endgameSolver is not None:
+            self.endgameSolver.table.clear()
+        self.principalVariation = []
+        self.pvKey = None
+        self.pvMoves = dict()
+        self.ponderResults = dict()
+        self.ponderNewGame = True
+        # the search workers hold copies of the tables, fresh ones are started with the first search of the game
+        self.closeSearchPool()
+
     def makeMove(self, quartoGameState, gui_mode=False):
-        maxScore, (position, nextPiece) = self.alphaBeta(quartoGameState, self.depth, -1000, 1000)
+        # search works on a private copy of the board that is updated in place and restored after each move
+        board = quartoGameState[0].copy()
+        bookEntry = self.openingBook.lookup(board) if self.openingBook is not None else None
+        if bookEntry is not None:
+            maxScore, (position, nextPiece) = bookEntry
+            self.searchInfo = {"depth": 0, "nodes": 0, "timeMs": 0.0}
+        elif self.endgameSolver is not None and board.numEmptyCells() <= self.endgameThreshold:
+            maxScore, (position, nextPiece) = self.solveEndgame(board)
+        elif board.key() in self.ponderResults:
+            self.continueGame(board)
+            maxScore, (position, nextPiece) = self.continuePondering(board)
+        elif self.timeLimitMs is None and self.nodeLimit is None:
+            self.continueGame(board)
+            self.startSearch()
+            maxScore, (position, nextPiece) = self.searchRoot(board, self.depth, self.pvMoves.get(board.key()))
+            self.finishSearch(self.depth)
+            self.recordPrincipalVariation(board, (position, nextPiece), self.depth)
+        else:
+            self.continueGame(board)
+            maxScore, (position, nextPiece) = self.iterativeDeepening(board)
+            self.recordPrincipalVariation(board, (position, nextPiece), self.searchInfo["depth"])
+        self.ponderResults = dict()
+
         if gui_mode:
             print(
                 f"Negamax agent placed piece at cell {position} and nextPiece is {nextPiece}\n",
-                f"maxEval:  {maxScore}",
+                f"maxEval:  {maxScore}\n",
+                f"depth: {self.searchInfo['depth']}  nodes: {self.searchInfo['nodes']}",
             )
         return position, nextPiece
 
-    def alphaBeta(self, quartoGameState, depth, alpha, beta):
-        encoding, availableNextPieces, availablePositions = quartoGameState
-        if self.transposition is not None:
-            self.total += 1
+    # Lines the search state up with the new root. When the opponent answered with the reply the last search
+    # expected, the rest of its principal variation is searched first at every position along it.
+    def continueGame(self, board):
+        self.pvMoves = dict()
+        if self.pvKey is None:
+            return
+        line = qutil.QuartoBoard.fromKey(self.pvKey)
+        if self.moveOrderer is not None:
+            self.moveOrderer.advance(board.occupied.bit_count() - line.occupied.bit_count())
+        if len(self.principalVariation) > 2:
+            for position, nextPiece in self.principalVariation[:2]:
+                line.makeMove(position, nextPiece)
+            if line.key() == board.key():
+                for position, nextPiece in self.principalVariation[2:]:
+                    self.pvMoves[line.key()] = (position, nextPiece)
+                    line.makeMove(position, nextPiece)
 
-        if qutil.isGameOverEncoding(encoding):
-            return -np.inf, (16, 16)
-        if depth == 0 or len(availablePositions) == 0:
-            return self.evaluation(encoding), (16, 16)
+    # The principal variation - the best move followed by the best moves stored in the transposition table
+    def recordPrincipalVariation(self, board, bestMove, depth):
+        self.pvKey = board.key()
+        self.principalVariation = [bestMove] + [move for _, _, move in self.followTable(board, bestMove, depth)]
 
-        # check transposition table
-        if self.transposition is not None:
-            if encoding in self.table.encoding.values:
-                self.hit += 1
-                row = self.table[self.table["encoding"] == encoding].values[0]
-                return row[1], (row[2], row[3])
+    # Follows the best moves stored in the transposition table after bestMove, up to depth moves in all.
+    # Yields the key and the entry each move was read from together with the move.
+    def followTable(self, board, bestMove, depth):
+        if self.table is None:
+            return
+        line = board.copy()
+        line.makeMove(*bestMove)
+        lastMove = bestMove
+        for remainingDepth in range(depth - 1, 0, -1):
+            if line.current == qutil.NULL_PIECE or qutil.isWinningPlacement(line, lastMove[0]):
+                return
+            # stored under the canonical key where the search canonicalizes, see alphaBeta
+            transform = None
+            if self.symmetry and remainingDepth >= self.symmetryMinDepth:
+                canonical, transform = qutil.canonicalizeBoard(line)
+                key = canonical.key()
+            else:
+                key = line.key()
+            entry = self.table.probe(key)
+            if entry is None:
+                return
+            move = entry[3] if transform is None else qutil.untransformMove(entry[3], transform)
+            if move[0] >= 16 or not line.isEmpty(move[0]):
+                return
+            if not (line.available >> move[1] & 1 or line.available == 0):
+                return
+            yield key, entry, move
+            line.makeMove(*move)
+            lastMove = move
 
-        if len(availableNextPieces) == 0:
-            availableNextPieces.add(16)
+    def solveEndgame(self, board):
+        value, move = self.endgameSolver.solve(board)
+        self.searchInfo = {
+            "depth": board.numEmptyCells(),
+            "nodes": self.endgameSolver.nodes,
+            "timeMs": self.endgameSolver.timeMs,
+        }
+        return self.getProvenScore(value), move
+
+    # proven wins and losses are reported with the infinite scores of the search, draws as 0
+    def getProvenScore(self, value):
+        if value == WIN:
+            return np.inf
+        if value == LOSS:
+            return -np.inf
+        return 0
+
+    def startSearch(self):
+        self.nodes = 0
+        self.startTime = time.time()
+        self.deadline = None
+        if self.timeLimitMs is not None:
+            self.deadline = self.startTime + self.timeLimitMs / 1000
+        # the budget is only checked every 1024 nodes
+        self.nextBudgetCheck = np.inf
+        if self.timeLimitMs is not None or self.nodeLimit is not None:
+            self.nextBudgetCheck = min(1024, self.nodeLimit or 1024)
+
+    def checkBudget(self):
+        self.nextBudgetCheck = self.nodes + 1024
+        if self.stopEvent is not None and self.stopEvent.is_set():
+            raise SearchBudgetExceeded()
+        if self.nodeLimit is not None and self.nodes >= self.nodeLimit:
+            raise SearchBudgetExceeded()
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise SearchBudgetExceeded()
+
+    def finishSearch(self, depthReached):
+        self.searchInfo = {
+            "depth": depthReached,
+            "nodes": self.nodes,
+            "timeMs": round((time.time() - self.startTime) * 1000, 2),
+        }
+
+    # Deepens the search one ply at a time, searching the previous iteration's best move first.
+    # Returns the result of the deepest completed iteration when the budget runs out.
+    # pondered is a (score, move, depth) result of pondering the position, deepening continues after its depth.
+    def iterativeDeepening(self, board, pondered=None):
+        self.startSearch()
+        result = None
+        depthReached = 0
+        proven = False
+        if pondered is not None:
+            result, depthReached = pondered[:2], pondered[2]
+        for depth in range(depthReached + 1, min(self.depth, board.numEmptyCells()) + 1):
+            # a proven win, loss or draw will not change with more depth
+            if proven:
+                break
+            inexactNodes = self.inexactNodes
+            try:
+                # an interrupted iteration leaves moves on the board, so each one searches its own copy
+                iterationResult = self.searchRoot(
+                    board.copy(), depth, result[1] if result is not None else None
+                )
+            except SearchBudgetExceeded:
+                break
+            result = iterationResult
+            depthReached = depth
+            proven = (abs(result[0]) == np.inf or result[0] == 0) and self.inexactNodes == inexactNodes
 
+        if result is None:
+            # not even one ply fit into the budget - play the first legal move
+            nextPieces = qutil.getMaskIndices(board.available) or (16,)
+            positions = qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK)
+            result = (0, (positions[0], nextPieces[0]))
+        self.finishSearch(depthReached)
+        return result
+
+    def searchRoot(self, board, depth, priorityMove=None):
+        if self.workers > 1 and not mp.current_process().daemon:
+            return self.parallelAlphaBeta(board, depth, priorityMove)
+        return self.alphaBeta(board, depth, -1000, 1000, priorityMove)
+
+    # Root splitting - the cells of the ordered root moves are dealt round-robin to the workers, which search the
+    # moves onto their cells with a full window. Moves onto the same cell lead to the same positions in different
+    # orders, which only the table of the worker searching both can share. Without the bounds of the other shares
+    # the workers still search more nodes than a serial search (see measureParallelSpeedup).
+    def parallelAlphaBeta(self, board, depth, priorityMove=None):
+        self.threats = qutil.ThreatIndex(board)
+        moves = None
+        if not self.threats.isWinningPiece(board.current):
+            moves = self.getMoves(board, depth, priorityMove)
+        if moves is None or depth == 1:
+            # immediate wins, forced losses and one ply searches are not worth sending to the pool
+            return self.alphaBeta(board, depth, -1000, 1000, priorityMove)
+
+        moves = list(moves)
+        inexactOriginal = self.inexactNodes
+        # a full window may have cut off further moves
+        if len(moves) == self.searchWindow:
+            self.inexactNodes += 1
+        cells = list(dict.fromkeys(position for position, _ in moves))
+        shareOf = {position: i % self.workers for i, position in enumerate(cells)}
+        shares = [[move for move in moves if shareOf[move[0]] == i] for i in range(min(self.workers, len(cells)))]
+        nodeLimit = None
+        if self.nodeLimit is not None:
+            nodeLimit = max(1, (self.nodeLimit - self.nodes) // len(shares))
+        results = self.getPool().starmap(
+            searchRootMoves,
+            [(board.key(), share, depth, self.deadline, nodeLimit) for share in shares],
+        )
+        self.nodes += sum(result[1] for result in results)
+        self.inexactNodes += sum(result[2] for result in results)
+        if any(result[0] is None for result in results):
+            raise SearchBudgetExceeded()
+
+        maxScore, bestMove = results[0][0]
+        for (score, move), _, _, _ in results[1:]:
+            if score > maxScore:
+                maxScore, bestMove = score, move
+
+        # the root and the best line go into the agent's own table like those of a serial search, so the
+        # principal variation can be followed and the next search starts from them
+        if self.table is not None:
+            for (score, move), _, _, line in results:
+                if move == bestMove:
+                    for key, entry in line:
+                        self.table.store(key, *entry)
+            if maxScore <= -1000:
+                flag = UPPER_BOUND
+            elif maxScore >= 1000:
+                flag = LOWER_BOUND
+            else:
+                flag = EXACT
+            storedDepth = depth
+            if self.inexactNodes == inexactOriginal and (
+                (maxScore == np.inf and flag != UPPER_BOUND)
+                or (maxScore == -np.inf and flag != LOWER_BOUND)
+                or (maxScore == 0 and flag == EXACT)
+            ):
+                storedDepth = PROVEN_DEPTH
+            if self.symmetry and depth >= self.symmetryMinDepth:
+                canonical, transform = qutil.canonicalizeBoard(board)
+                self.table.store(canonical.key(), maxScore, flag, storedDepth, qutil.transformMove(bestMove, transform))
+            else:
+                self.table.store(board.key(), maxScore, flag, storedDepth, bestMove)
+        return maxScore, bestMove
+
+    # Searches the given root moves with a full window - the share of the root moves of a parallel worker
+    def searchMoves(self, board, depth, moves):
+        threats = self.threats = qutil.ThreatIndex(board)
+        alpha, beta = -1000, 1000
         maxScore = -np.inf
-        bestMove = (16, 16)
+        bestMove = moves[0]
+        for position, nextPiece in moves:
+            self.nodes += 1
+            if self.nodes >= self.nextBudgetCheck:
+                self.checkBudget()
+
+            board.makeMove(position, nextPiece)
+            if qutil.isWinningPlacement(board, position):
+                curr = np.inf
+            elif depth == 1 or board.occupied == qutil.FULL_MASK:
+                curr = -self.evaluation(board)
+            else:
+                threats.update(position)
+                curr = -self.alphaBeta(board, depth - 1, -beta, -alpha, None, 1)[0]
+            board.undoMove(position)
+            threats.update(position)
+
+            if curr >= maxScore:
+                maxScore = curr
+                bestMove = (position, nextPiece)
+            alpha = max(alpha, maxScore)
+            if alpha > beta:
+                break
+        return maxScore, bestMove
+
+    # Ponders the positions after the most likely replies of the opponent: the reply the principal variation
+    # expects, then the opponent's moves in search order. Replies into the endgame region are left to the solver.
+    def startPondering(self, quartoGameState):
+        if mp.current_process().daemon or self.ponderWidth == 0:
+            return
+        board = quartoGameState[0].copy()
+        if board.current == qutil.NULL_PIECE or board.numEmptyCells() - 1 <= (self.endgameThreshold or 0):
+            return
+        self.threats = qutil.ThreatIndex(board)
+        if self.threats.isWinningPiece(board.current):
+            return
+
+        expected = None
+        if self.pvKey is not None and len(self.principalVariation) > 1:
+            line = qutil.QuartoBoard.fromKey(self.pvKey)
+            line.makeMove(*self.principalVariation[0])
+            if line.key() == board.key():
+                expected = self.principalVariation[1]
+        moves = self.getMoves(board, self.depth, expected, 1)
+        if moves is None:
+            return
+        keys = []
+        for position, nextPiece in itertools.islice(moves, self.ponderWidth):
+            board.makeMove(position, nextPiece)
+            keys.append(board.key())
+            board.undoMove(position)
+
+        if self.ponderPool is None:
+            self.ponderStop = mp.Event()
+            self.ponderPool = mp.Pool(1, initializer=initPonderWorker, initargs=(self, self.ponderStop))
+        self.ponderStop.clear()
+        self.ponderJob = self.ponderPool.apply_async(ponderPositions, (keys, self.ponderNewGame))
+        self.ponderNewGame = False
+
+    def stopPondering(self):
+        if self.ponderJob is None:
+            return
+        self.ponderStop.set()
+        self.ponderResults = self.ponderJob.get()
+        self.ponderJob = None
+
+    # The opponent played a pondered reply - the pondering worker, whose tables hold that work, deepens from
+    # where pondering stopped within the move's budget (to the full depth without one)
+    def continuePondering(self, board):
+        key = board.key()
+        self.ponderStop.clear()
+        result, self.searchInfo, self.principalVariation = self.ponderPool.apply(
+            searchPondered, (key, self.ponderResults[key], self.timeLimitMs, self.nodeLimit)
+        )
+        self.pvKey = key
+        return result
+
+    def getPool(self):
+        if self.pool is None:
+            self.pool = mp.Pool(self.workers, initializer=initSearchWorker, initargs=(self,))
+        return self.pool
+
+    def closeSearchPool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def closePool(self):
+        self.closeSearchPool()
+        if self.ponderPool is not None:
+            self.stopPondering()
+            self.ponderPool.close()
+            self.ponderPool.join()
+            self.ponderPool = None
+
+    # the pools are not sent along when the agent is pickled (pool initializers, mpBatchRun workers)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = None
+        state["ponderPool"] = None
+        state["ponderJob"] = None
+        state["ponderStop"] = None
+        state["stopEvent"] = None
+        return state
+
+    # Searches the position serially and in parallel and compares the two. The overhead is the share of
+    # nodes the parallel search needs on top of the serial one. Both searches start from empty in-memory tables.
+    def measureParallelSpeedup(self, board):
+        workers = self.workers
+
+        self.workers = 1
+        self.onGameStart()
+        self.startSearch()
+        serialResult = self.searchRoot(board.copy(), self.depth)
+        self.finishSearch(self.depth)
+        serialInfo = self.searchInfo
+
+        self.workers = workers
+        self.onGameStart()
+        self.getPool()
+        self.startSearch()
+        parallelResult = self.searchRoot(board.copy(), self.depth)
+        self.finishSearch(self.depth)
+        parallelInfo = self.searchInfo
+
+        return {
+            "workers": workers,
+            "serialMs": serialInfo["timeMs"],
+            "parallelMs": parallelInfo["timeMs"],
+            "speedup": serialInfo["timeMs"] / max(parallelInfo["timeMs"], 0.01),
+            "serialNodes": serialInfo["nodes"],
+            "parallelNodes": parallelInfo["nodes"],
+            "overhead": parallelInfo["nodes"] / max(serialInfo["nodes"], 1) - 1,
+            "sameScore": serialResult[0] == parallelResult[0],
+        }
+
+    # Legal moves of a node in search order, limited to the search window. Unless the current piece wins right
+    # away, moves handing over a poisoned piece are left out - None is returned when that leaves no move.
+    def getMoves(self, board, depth, priorityMove=None, ply=0):
+        availableNextPieces = qutil.getMaskIndices(board.available) or (16,)
+        availablePositions = qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK)
+
+        threats = self.threats
+        poisoned = None
+        if not threats.isWinningPiece(board.current):
+            poisoned = {position: threats.getPoisonedPieces(position) for position in availablePositions}
+            if board.available != 0 and all(
+                mask == board.available for mask in poisoned.values()
+            ):
+                return None
 
         """
-        The move ordering for the search window is as follows - We cycle through all available positions for a single next piece before considering
+        The move ordering for the search window is as follows - winning placements, the transposition table move, killer moves and then the rest by
+        history score (see MoveOrderer). Without a move orderer we cycle through all available positions for a single next piece before considering
         another next piece. This way all positions are prioritized and explored first over exploring all next pieces for a single position.
         """
-        searchWindowCounter = 0
-        for move in itertools.product(availableNextPieces, availablePositions):
-            searchWindowCounter += 1
-            if searchWindowCounter > self.searchWindow:
-                break
+        if self.moveOrderer is not None:
+            return self.moveOrderer.orderMoves(
+                board,
+                ply,
+                depth,
+                availableNextPieces,
+                availablePositions,
+                priorityMove,
+                self.searchWindow,
+                poisoned,
+            )
+
+        moves = (
+            (position, nextPiece)
+            for nextPiece, position in itertools.product(availableNextPieces, availablePositions)
+            if poisoned is None or not poisoned[position] >> nextPiece & 1
+        )
+        if priorityMove is not None and (
+            poisoned is None or not poisoned[priorityMove[0]] >> priorityMove[1] & 1
+        ):
+            moves = itertools.chain((priorityMove,), (move for move in moves if move != priorityMove))
+        return itertools.islice(moves, self.searchWindow)
+
+    def alphaBeta(self, board, depth, alpha, beta, priorityMove=None, ply=0):
+        # the threat index follows the board through the whole search and is rebuilt for every root call
+        if ply == 0:
+            self.threats = qutil.ThreatIndex(board)
 
-            # switch move indices to match format: (position, nextPiece)
-            move = (move[1], move[0])
+        # a full board without a winning line is a draw, scored 0 like a draw of the tablebase or the solver
+        if depth == 0 or board.occupied == qutil.FULL_MASK:
+            if board.occupied != qutil.FULL_MASK:
+                self.inexactNodes += 1
+            return self.evaluation(board), (16, 16)
 
-            # simulate move
-            nextEncoding = qutil.getEncodingAfterMove(encoding, move[0], move[1])
-            availablePositions.remove(move[0])
-            availableNextPieces.remove(move[1])
-            nextGameState = (nextEncoding, availableNextPieces, availablePositions)
+        # positions in the tablebase region are looked up - the value is exact whatever depth is left, so the
+        # position counts as proven, which tells a drawn position apart from a heuristic score of 0
+        if self.tablebase is not None and board.numEmptyCells() <= self.tablebase.maxEmpty:
+            entry = self.tablebase.probe(board)
+            if entry is not None:
+                return self.getProvenScore(entry[0]), entry[1]
+
+        # check transposition table - evaluation is not relative to the side to move,
+        # so only entries searched to the same depth parity are comparable
+        alphaOriginal = alpha
+        inexactOriginal = self.inexactNodes
+        table = self.table
+        if table is not None:
+            transform = None
+            if self.symmetry and depth >= self.symmetryMinDepth:
+                canonical, transform = qutil.canonicalizeBoard(board)
+                key = canonical.key()
+            else:
+                key = board.key()
+            if priorityMove is None and self.pvMoves:
+                priorityMove = self.pvMoves.get(board.key())
+            entry = table.probe(key)
+            if entry is not None:
+                score, flag, entryDepth, move = entry
+                if transform is not None:
+                    move = qutil.untransformMove(move, transform)
+                # the stored best move is searched first even when the entry is too shallow to use
+                if priorityMove is None:
+                    priorityMove = move
+                # a proven win, loss or draw holds whatever depth is left, so it carries over from shallower
+                # searches (e.g. those of earlier moves in the game)
+                proven = entryDepth == PROVEN_DEPTH
+                if proven or (entryDepth >= depth and (entryDepth - depth) % 2 == 0):
+                    if not proven:
+                        self.inexactNodes += 1
+                    if flag == EXACT:
+                        return score, move
+                    elif flag == LOWER_BOUND:
+                        alpha = max(alpha, score)
+                    else:
+                        beta = min(beta, score)
+                    if alpha > beta:
+                        return score, move
+
+        availableNextPieces = qutil.getMaskIndices(board.available)
+        if len(availableNextPieces) == 0:
+            availableNextPieces = (16,)
+        availablePositions = qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK)
+
+        maxScore = -np.inf
+        bestMove = (16, 16)
+
+        # handing over a poisoned piece loses on the opponent's next placement - those moves are skipped,
+        # and when every move hands one over the position is lost
+        threats = self.threats
+        moves = self.getMoves(board, depth, priorityMove, ply)
+        if moves is None:
+            return -np.inf, (availablePositions[0], availableNextPieces[0])
+        # moves outside the search window are never searched, so a loss found here is not proven
+        if len(availablePositions) * len(availableNextPieces) > self.searchWindow:
+            self.inexactNodes += 1
+
+        # children at the depth limit are scored incrementally - only the lines through the placed cell change
+        if depth == 1:
+            parentLines = self.evaluation(board)
+            linesBefore = {p: qutil.countThreeLinesThrough(board, p) for p in availablePositions}
+
+        provenWin = False
+        for moveIndex, (position, nextPiece) in enumerate(moves):
+            self.nodes += 1
+            if self.nodes >= self.nextBudgetCheck:
+                self.checkBudget()
+
+            # simulate move and call for next turn - wins and children at the depth limit are scored in place
+            board.makeMove(position, nextPiece)
+            if qutil.isWinningPlacement(board, position):
+                curr = np.inf
+                provenWin = True
+            elif depth == 1:
+                curr = -(
+                    parentLines
+                    - linesBefore[position]
+                    + qutil.countThreeLinesThrough(board, position)
+                )
+            elif board.occupied == qutil.FULL_MASK:
+                curr = -self.evaluation(board)
+            else:
+                threats.update(position)
+                inexactNodes = self.inexactNodes
+                curr = -self.alphaBeta(board, depth - 1, -beta, -alpha, None, ply + 1)[0]
+                if curr == np.inf and self.inexactNodes == inexactNodes:
+                    provenWin = True
+            board.undoMove(position)
+            if depth > 1:
+                threats.update(position)
 
-            # call for next turn
-            curr = -self.alphaBeta(nextGameState, depth - 1, -beta, -alpha)[0]
             if curr >= maxScore:
                 maxScore = curr
-                bestMove = move
-            alpha = max(alpha, maxScore)
-
-            # undo simulated move
-            availablePositions.add(move[0])
-            availableNextPieces.add(move[1])
+                bestMove = (position, nextPiece)
+            if maxScore > alpha:
+                alpha = maxScore
 
             if alpha > beta:
-                if self.transposition is not None and depth == self.depth:
-                    self.updateTable([encoding, maxScore, bestMove[0], bestMove[1]])
-                availableNextPieces.discard(16)
-                return alpha, bestMove
-
-        if self.transposition is not None and depth == self.depth:
-            self.updateTable([encoding, maxScore, bestMove[0], bestMove[1]])
-        availableNextPieces.discard(16)
+                if self.moveOrderer is not None:
+                    self.moveOrderer.recordCutoff(bestMove, ply, depth, moveIndex)
+                break
+
+        # a win only needs its own line to be proven, whatever the moves searched before it met
+        if provenWin:
+            self.inexactNodes = inexactOriginal
+        # children at the depth limit were scored by the heuristic unless they won or filled the board
+        elif depth == 1 and len(availablePositions) > 1:
+            self.inexactNodes += 1
+
+        if table is not None:
+            if maxScore <= alphaOriginal:
+                flag = UPPER_BOUND
+            elif maxScore >= beta:
+                flag = LOWER_BOUND
+            else:
+                flag = EXACT
+            storedDepth = depth
+            if self.inexactNodes == inexactOriginal and (
+                (maxScore == np.inf and flag != UPPER_BOUND)
+                or (maxScore == -np.inf and flag != LOWER_BOUND)
+                or (maxScore == 0 and flag == EXACT)
+            ):
+                storedDepth = PROVEN_DEPTH
+            if transform is not None:
+                table.store(key, maxScore, flag, storedDepth, qutil.transformMove(bestMove, transform))
+            else:
+                table.store(key, maxScore, flag, storedDepth, bestMove)
         return maxScore, bestMove
 
     # Counts how many lines of three pieces with an identical property
-    def evaluation(self, encoding):
-        board = [int(encoding[i] + encoding[i + 1]) for i in range(0, len(encoding) - 2, 2)]
-        tempLine = None
-        numLines = 0
-
-        for i in range(4):
-            # check horizontal lines
-            tempLine = board[4 * i : 4 * (i + 1)]
-            if tempLine.count(16) == 1:
-                tempLine.remove(16)
-                if qutil.matchingPropertyExists(tempLine):
-                    numLines += 1
-
-            tempLine = board[i : len(board) : 4]
-            # check vertical lines
-            if tempLine.count(16) == 1:
-                tempLine.remove(16)
-                if qutil.matchingPropertyExists(tempLine):
-                    numLines += 1
-
-        # check obtuse diagonal line
-        tempLine = board[0 : len(board) : 5]
-        if tempLine.count(16) == 1:
-            tempLine.remove(16)
-            if qutil.matchingPropertyExists(tempLine):
-                numLines += 1
-
-        # check acute diagonal line:
-        tempLine = board[3:-1:3]
-        if tempLine.count(16) == 1:
-            tempLine.remove(16)
-            if qutil.matchingPropertyExists(tempLine):
-                numLines += 1
-
-        # no winning line found
-        return numLines
-
-    def initTransposition(self, transposition):
-        self.hit = 0
-        self.total = 0
-        self.tableFileName = transposition
-        self.table = pd.read_pickle(f"tables/{transposition}.pkl")
-
-    def updateTable(self, record):
-        if record[1] == np.inf:
-            record[1] = 10
-        if record[1] == -np.inf:
-            record[1] = -10
-        row = {
-            "encoding": record[0],
-            "evaluation": record[1],
-            "movePos": record[2],
-            "movePiece": record[3],
-        }
-        self.table = self.table.append(row, ignore_index=True)
+    def evaluation(self, board):
+        return board.countThreeLines()
 
-        self.table["encoding"] = self.table["encoding"].astype("str")
-        self.table["evaluation"] = self.table["evaluation"].astype("int8")
-        self.table["movePos"] = self.table["movePos"].astype("int8")
-        self.table["movePiece"] = self.table["movePiece"].astype("int8")
+    def initTransposition(self, transposition, tableSize=2**18, replacement="depth"):
+        self.tableFileName = transposition
+        path = f"tables/{transposition}.qtt"
+        if not os.path.exists(path):
+            os.makedirs("tables", exist_ok=True)
+            createMappedTable(path, tableSize if tableSize is not None else 2**18)
+        self.table = MappedTranspositionTable(path, replacement)
 
+    # entries are written to the mapped file as they are stored - this only forces them to disk
     def saveTable(self):
-        self.table.to_pickle(f"tables/{self.tableFileName}.pkl")
+        if self.tableFileName is not None:
+            self.table.flush()
 
     def displayTranspositionMetrics(self):
-        if self.tableFileName is None:
-            print("No transposition table was loaded. Cannot display any transposition metrics.")
+        if self.table is None:
+            print("No transposition table is in use. Cannot display any transposition metrics.")
         else:
-            print("\nnum hits: ", self.hit, "\nnum total: ", self.total, "")
-            if self.total != 0:
-                print(f"hit rate: {round((self.hit/self.total)*100,2)} %\n")
-            print(self.table.info(), "\n")
+            metrics = self.table.getMetrics()
+            print("\nnum hits: ", metrics["hits"], "\nnum probes: ", metrics["probes"], "")
+            if metrics["probes"] != 0:
+                print(f"hit rate: {round(metrics['hitRate']*100,2)} %")
+            print(
+                f"entries: {metrics['entries']}/{metrics['capacity']}",
+                f"\ncollisions: {metrics['collisions']}",
+                f"\noverwrites: {metrics['overwrites']}",
+                f"\nrejected stores: {metrics['rejections']}\n",
+            )
+
+    def displayMoveOrderingMetrics(self):
+        if self.moveOrderer is None:
+            print("No move ordering is in use. Cannot display any move ordering metrics.")
+        else:
+            stats = self.moveOrderer.getStats()
+            print(
+                f"\ncutoffs: {stats['cutoffs']}",
+                f"\nfirst move cutoff rate: {round(stats['firstMoveCutoffRate']*100,2)} %",
+                f"\naverage cutoff move index: {round(stats['avgCutoffIndex'],2)}\n",
+            )
@@ -0,0 +1,319 @@
+import mmap
+import os
+import struct
+import numpy as np
+
+# bound types of a stored score
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+# depth stored with proven results (wins, losses and draws found by a full-width search), which hold at any depth
+PROVEN_DEPTH = 63
+
+# Replacement policies decide whether a new entry may overwrite a slot holding a different position.
+# They receive the depth of the stored entry and the depth of the new entry.
+# Module-level functions rather than lambdas, so agents holding a table can be pickled (mpBatchRun workers).
+def replaceAlways(storedDepth, newDepth):
+    return True
+
+
+def replaceByDepth(storedDepth, newDepth):
+    return newDepth >= storedDepth
+
+
+REPLACEMENT_POLICIES = {
+    "always": replaceAlways,
+    "depth": replaceByDepth,
+}
+
+
+# multiplier for Fibonacci hashing - spreads the folded position key over the index bits
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+HASH_MASK = 2**64 - 1
+
+
+# Fixed-capacity transposition table indexed by the hash of the position key.
+# Entries are kept in parallel arrays (one slot per index) holding the key, score, bound type, depth and best move.
+class TranspositionTable:
+    def __init__(self, capacity=2**20, replacement="depth") -> None:
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "Capacity should be a power of 2."
+        self.capacity = capacity
+        self.indexShift = 64 - (capacity.bit_length() - 1)
+        self.setReplacementPolicy(replacement)
+
+        self.keys = [None] * capacity
+        self.scores = [0.0] * capacity
+        self.flags = [EXACT] * capacity
+        self.depths = [0] * capacity
+        self.moves = [(16, 16)] * capacity
+        self.resetCounters()
+
+    def setReplacementPolicy(self, replacement):
+        # either the name of a built-in policy or a function (storedDepth, newDepth) -> bool
+        if callable(replacement):
+            self.replacement = replacement
+        else:
+            assert replacement in REPLACEMENT_POLICIES, f"Unknown replacement policy {replacement}."
+            self.replacement = REPLACEMENT_POLICIES[replacement]
+
+    def resetCounters(self):
+        self.probes = 0
+        self.hits = 0
+        self.collisions = 0  # probes that found a different position in the slot
+        self.stores = 0
+        self.overwrites = 0  # stores that evicted a different position
+        self.rejections = 0  # stores refused by the replacement policy
+
+    def clear(self):
+        self.keys = [None] * self.capacity
+        self.resetCounters()
+
+    def getIndex(self, key):
+        return (hash(key) * HASH_MULTIPLIER & HASH_MASK) >> self.indexShift
+
+    # returns (score, flag, depth, move) or None if the position is not stored
+    def probe(self, key):
+        self.probes += 1
+        index = self.getIndex(key)
+        storedKey = self.keys[index]
+        if storedKey == key:
+            self.hits += 1
+            return self.scores[index], self.flags[index], self.depths[index], self.moves[index]
+        if storedKey is not None:
+            self.collisions += 1
+        return None
+
+    def store(self, key, score, flag, depth, move):
+        index = self.getIndex(key)
+        storedKey = self.keys[index]
+        if storedKey is not None and storedKey != key:
+            if not self.replacement(self.depths[index], depth):
+                self.rejections += 1
+                return
+            self.overwrites += 1
+
+        self.stores += 1
+        self.keys[index] = key
+        self.scores[index] = score
+        self.flags[index] = flag
+        self.depths[index] = depth
+        self.moves[index] = move
+
+    def numEntries(self):
+        return self.capacity - self.keys.count(None)
+
+    def getMetrics(self):
+        return {
+            "capacity": self.capacity,
+            "entries": self.numEntries(),
+            "probes": self.probes,
+            "hits": self.hits,
+            "hitRate": self.hits / self.probes if self.probes != 0 else 0.0,
+            "collisions": self.collisions,
+            "stores": self.stores,
+            "overwrites": self.overwrites,
+            "rejections": self.rejections,
+        }
+
+
+# On-disk table format (little endian): a 64 byte header followed by capacity records of three 64-bit words
+# - word 0: packed cells of the key
+# - word 1: occupancy and current piece of the key (bits 0-20) and the entry data (bits 32-63)
+#   data bits: score + 128 (0-7), flag (8-9), depth (10-15), move position (16-20), move piece (21-25), valid (31)
+# - word 2: word 0 XOR word 1, so a record torn by concurrent writers is detected and treated as empty
+TABLE_MAGIC = b"QTTABLE1"
+HEADER = struct.Struct("<8sQ")
+HEADER_SIZE = 64
+RECORD = struct.Struct("<QQQ")
+RECORD_SIZE = RECORD.size
+KEY_STATE_MASK = 2**21 - 1
+VALID_BIT = 1 << 31
+# scores are stored as int8 with the infinite (won/lost) scores mapped to +-127
+MAX_STORED_SCORE = 127
+
+
+def packRecord(key, score, flag, depth, move):
+    if score == np.inf:
+        score = MAX_STORED_SCORE
+    elif score == -np.inf:
+        score = -MAX_STORED_SCORE
+    else:
+        score = max(-MAX_STORED_SCORE + 1, min(MAX_STORED_SCORE - 1, int(score)))
+    data = score + 128 | flag << 8 | depth << 10 | move[0] << 16 | move[1] << 21 | VALID_BIT
+    word0 = key & HASH_MASK
+    word1 = key >> 64 | data << 32
+    return word0, word1, word0 ^ word1
+
+
+# returns (key, score, flag, depth, move) or None for empty and torn records
+def unpackRecord(word0, word1, check):
+    if check != word0 ^ word1 or not word1 >> 63:
+        return None
+    data = word1 >> 32
+    score = (data & 255) - 128
+    if score == MAX_STORED_SCORE:
+        score = np.inf
+    elif score == -MAX_STORED_SCORE:
+        score = -np.inf
+    move = (data >> 16 & 31, data >> 21 & 31)
+    return word0 | (word1 & KEY_STATE_MASK) << 64, score, data >> 8 & 3, data >> 10 & 63, move
+
+
+# Transposition table stored in a memory-mapped file, with the same probe/store interface as TranspositionTable.
+# Nothing is loaded at startup - slots are read and written in place, so every process that maps the file
+# (e.g. the mpBatchRun pool workers) shares one table. Writes are lock-free: each record carries a checksum and a
+# record torn by two concurrent writers simply reads as an empty slot.
+class MappedTranspositionTable(TranspositionTable):
+    def __init__(self, path, replacement="depth") -> None:
+        self.path = path
+        self.replacementName = replacement
+        self.setReplacementPolicy(replacement)
+        self.open()
+        self.resetCounters()
+
+    def open(self):
+        self.file = open(self.path, "r+b")
+        self.buffer = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity = HEADER.unpack_from(self.buffer, 0)
+        assert magic == TABLE_MAGIC, f"{self.path} is not a transposition table file."
+        self.indexShift = 64 - (self.capacity.bit_length() - 1)
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    # the mapping is reopened by path when the table is sent to another process
+    def __getstate__(self):
+        return {"path": self.path, "replacementName": self.replacementName}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["replacementName"])
+
+    def clear(self):
+        self.buffer[HEADER_SIZE:] = bytes(self.capacity * RECORD_SIZE)
+        self.resetCounters()
+
+    def probe(self, key):
+        self.probes += 1
+        record = unpackRecord(
+            *RECORD.unpack_from(self.buffer, HEADER_SIZE + RECORD_SIZE * self.getIndex(key))
+        )
+        if record is None:
+            return None
+        if record[0] == key:
+            self.hits += 1
+            return record[1:]
+        self.collisions += 1
+        return None
+
+    def store(self, key, score, flag, depth, move):
+        offset = HEADER_SIZE + RECORD_SIZE * self.getIndex(key)
+        stored = unpackRecord(*RECORD.unpack_from(self.buffer, offset))
+        if stored is not None and stored[0] != key:
+            if not self.replacement(stored[3], depth):
+                self.rejections += 1
+                return
+            self.overwrites += 1
+
+        self.stores += 1
+        RECORD.pack_into(self.buffer, offset, *packRecord(key, score, flag, depth, move))
+
+    def flush(self):
+        self.buffer.flush()
+
+    # all valid records as (key, score, flag, depth, move) tuples
+    def getRecords(self):
+        words = np.frombuffer(self.buffer, dtype="<u8", offset=HEADER_SIZE).reshape(-1, 3)
+        valid = (words[:, 2] == words[:, 0] ^ words[:, 1]) & (words[:, 1] >> 63 == 1)
+        return [unpackRecord(*record) for record in words[valid].tolist()]
+
+    def numEntries(self):
+        return len(self.getRecords())
+
+
+def createMappedTable(path, capacity=2**20):
+    assert capacity > 0 and capacity & (capacity - 1) == 0, "Capacity should be a power of 2."
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(TABLE_MAGIC, capacity).ljust(HEADER_SIZE, b"\0"))
+        f.truncate(HEADER_SIZE + capacity * RECORD_SIZE)
+
+
+# summary of a table file: capacity, entries, records torn by concurrent writes and entries per depth and bound type
+def inspectMappedTable(path):
+    table = MappedTranspositionTable(path)
+    words = np.frombuffer(table.buffer, dtype="<u8", offset=HEADER_SIZE).reshape(-1, 3)
+    used = words.any(axis=1)
+    torn = used & (words[:, 2] != words[:, 0] ^ words[:, 1])
+    records = table.getRecords()
+    del words
+    table.close()
+
+    depths, flags = {}, {}
+    for record in records:
+        depths[record[3]] = depths.get(record[3], 0) + 1
+        flags[record[2]] = flags.get(record[2], 0) + 1
+    return {
+        "capacity": table.capacity,
+        "entries": len(records),
+        "load": len(records) / table.capacity,
+        "tornRecords": int(np.count_nonzero(torn)),
+        "depths": dict(sorted(depths.items())),
+        "flags": {
+            "exact": flags.get(EXACT, 0),
+            "lower": flags.get(LOWER_BOUND, 0),
+            "upper": flags.get(UPPER_BOUND, 0),
+        },
+        "fileSize": os.path.getsize(path),
+    }
+
+
+# copies every valid record of the source tables into the target table, following the target's replacement policy
+def mergeMappedTables(targetPath, sourcePaths, replacement="depth"):
+    target = MappedTranspositionTable(targetPath, replacement)
+    for sourcePath in sourcePaths:
+        source = MappedTranspositionTable(sourcePath)
+        # shallow entries first so that deeper ones win the slot under the depth policy
+        for record in sorted(source.getRecords(), key=lambda record: record[3]):
+            target.store(*record)
+        source.close()
+    target.flush()
+    metrics = target.getMetrics()
+    target.close()
+    return metrics
+
+
+# largest capacity compactMappedTable grows a table to by default, the capacity of a new table file
+MAX_COMPACT_CAPACITY = 2**20
+
+
+# number of records that share their slot with another record in a table of the given capacity
+def countSharedSlots(records, capacity):
+    indexShift = 64 - (capacity.bit_length() - 1)
+    slots = {(hash(record[0]) * HASH_MULTIPLIER & HASH_MASK) >> indexShift for record in records}
+    return len(records) - len(slots)
+
+
+# Rewrites a table into a new file without torn records. A position has a single slot, so by default the capacity
+# is doubled from half load until every record has a slot of its own, up to MAX_COMPACT_CAPACITY. Records still
+# sharing a slot after that (or at a given capacity) lose it to the deeper entry and are counted as dropped.
+def compactMappedTable(path, outputPath, capacity=None):
+    source = MappedTranspositionTable(path)
+    records = source.getRecords()
+    source.close()
+    if capacity is None:
+        capacity = 1024
+        while capacity < 2 * len(records):
+            capacity *= 2
+        while capacity < MAX_COMPACT_CAPACITY and countSharedSlots(records, capacity) > 0:
+            capacity *= 2
+
+    createMappedTable(outputPath, capacity)
+    target = MappedTranspositionTable(outputPath)
+    for record in sorted(records, key=lambda record: record[3]):
+        target.store(*record)
+    target.flush()
+    metrics = target.getMetrics()
+    target.close()
+    metrics["dropped"] = len(records) - metrics["entries"]
+    return metrics
@@ -0,0 +1,365 @@
+import argparse
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import pickle
+import time
+import random
+from collections import deque
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import quarto_agents as qagents
+import quarto_util as qutil
+from quarto import QuartoGame
+
+# Batch runner for experiments between two agents
+# e.g. python quarto_batch.py benchmark random negamax-2-16 --games 400 --workers 1 2 4
+#      python quarto_batch.py tournament random negamax-2-16 mcts-1000 --games 20
+#
+# The worker processes are started once and reused for every configuration (pair of agents) run through them.
+# The agents of a configuration are pickled once by the parent and sent to each worker with the first chunk it
+# plays of that configuration. The worker keeps them and their game, so the later chunks only carry the number of
+# games and a seed. Games are sent in chunks to whichever worker is free and played with QuartoGame.playHeadless,
+# each chunk coming back as the NumPy arrays it returns. The parent assembles them in game order and writes the
+# log file of the run in one go.
+#
+# A tournament queues the chunks of every pairing and seat at once, so workers move on to the next chunk of any
+# pairing as soon as they are free, and a slow pairing only keeps the workers playing its own chunks busy.
+
+# a worker keeps the games of the last MAX_WORKER_GAMES configurations it has played
+MAX_WORKER_GAMES = 16
+
+
+# Batch worker - plays the chunks received on connection, each as (configuration id, pickled agents or None,
+# number of games, seed). A configuration the worker no longer has is answered with None, and the parent sends
+# the chunk again with its agents.
+def runBatchWorker(connection):
+    games = dict()
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        configId, agents, numGames, seed = message
+        game = games.pop(configId, None)
+        if game is None:
+            if agents is None:
+                connection.send(None)
+                continue
+            agent1, agent2 = pickle.loads(agents)
+            game = QuartoGame(agent1, agent2, gui_mode=False, bin_mode=False)
+            if len(games) >= MAX_WORKER_GAMES:
+                del games[next(iter(games))]
+        games[configId] = game
+        # every chunk has its own seed, so forked workers do not play the same random games
+        np.random.seed(seed)
+        random.seed(seed)
+        startTime = time.perf_counter()
+        results, numMoves, agentTimes = game.playHeadless(numGames)
+        connection.send((results, numMoves, agentTimes, time.perf_counter() - startTime))
+    connection.close()
+
+
+class BatchRunner:
+    def __init__(self, workers=None, chunkSize=None, seed=None) -> None:
+        assert workers is None or workers <= mp.cpu_count(), f"Higher than available cpu_count {mp.cpu_count()}"
+        self.workers = workers or mp.cpu_count()
+        # games per chunk - by default every worker gets about four chunks of a run, which keeps them busy until
+        # the end of the run without a round trip per game
+        self.chunkSize = chunkSize
+        self.seeds = np.random.SeedSequence(seed)
+        self.numConfigs = 0
+        self.processes = None
+        # chunks waiting for a worker as (run, chunk index), the chunk each busy worker (by connection) plays
+        # and the configurations sent to each worker
+        self.pending = deque()
+        self.busy = dict()
+        self.sentConfigs = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # daemonic like pool workers, so agents inside them search serially
+    def getWorkers(self):
+        if self.processes is None:
+            self.processes = []
+            for _ in range(self.workers):
+                connection, workerConnection = mp.Pipe()
+                process = mp.Process(target=runBatchWorker, args=(workerConnection,), daemon=True)
+                process.start()
+                self.processes.append((process, connection))
+                self.sentConfigs[connection] = set()
+        return self.processes
+
+    def close(self):
+        if self.processes is not None:
+            for process, connection in self.processes:
+                connection.send(None)
+                process.join()
+            self.processes = None
+            self.pending.clear()
+            self.busy.clear()
+            self.sentConfigs.clear()
+
+    # Plays numGames games of agent1 (player 1) against agent2 and returns the per-game results, number of moves
+    # and move times as in QuartoGame.playHeadless, plus the summed time the workers spent playing. With a
+    # filename the games are written to it as a run file (quarto_util.readRunFile), whose directory is created
+    # before any game is played.
+    def run(self, agent1, agent2, numGames, filename=None):
+        if filename is not None:
+            createRunDirectory(filename)
+        return self.collect(self.submit(agent1, agent2, numGames), filename)
+
+    # queues the chunks of numGames games of agent1 against agent2 without waiting for them
+    def submit(self, agent1, agent2, numGames):
+        self.numConfigs += 1
+        chunkSize = self.chunkSize or max(1, -(-numGames // (4 * self.workers)))
+        starts = list(range(0, numGames, chunkSize))
+        seeds = [int(s.generate_state(1)[0]) for s in self.seeds.spawn(len(starts))]
+        run = {
+            "configId": self.numConfigs,
+            "agents": pickle.dumps((agent1, agent2)),
+            "agent1": agent1,
+            "agent2": agent2,
+            "numGames": numGames,
+            "chunks": [(start, min(chunkSize, numGames - start), seed) for start, seed in zip(starts, seeds)],
+            "results": [None] * len(starts),
+        }
+        self.pending.extend((run, i) for i in range(len(starts)))
+        self.dispatch()
+        return run
+
+    # sends pending chunks to the idle workers, with the agents if the worker has not had them yet
+    def dispatch(self):
+        for _, connection in self.getWorkers():
+            if not self.pending:
+                return
+            if connection not in self.busy:
+                self.sendChunk(connection, *self.pending.popleft())
+
+    def sendChunk(self, connection, run, index, withAgents=False):
+        _, numGames, seed = run["chunks"][index]
+        withAgents = withAgents or run["configId"] not in self.sentConfigs[connection]
+        connection.send((run["configId"], run["agents"] if withAgents else None, numGames, seed))
+        self.sentConfigs[connection].add(run["configId"])
+        self.busy[connection] = (run, index)
+
+    # waits for the replies of the busy workers until every chunk of run is back, handing out pending chunks
+    def waitFor(self, run):
+        while any(result is None for result in run["results"]):
+            for connection in mp.connection.wait(list(self.busy)):
+                reply = connection.recv()
+                chunkRun, index = self.busy.pop(connection)
+                if reply is None:
+                    self.sendChunk(connection, chunkRun, index, withAgents=True)
+                else:
+                    chunkRun["results"][index] = reply
+            self.dispatch()
+
+    # waits for the chunks of a submitted run and assembles them as returned by run
+    def collect(self, run, filename=None):
+        self.waitFor(run)
+        agent1, agent2, numGames = run["agent1"], run["agent2"], run["numGames"]
+        results = np.zeros(numGames, dtype=np.int8)
+        numMoves = np.zeros((numGames, 2), dtype=np.int16)
+        agentTimes = np.zeros((numGames, 2))
+        busyTime = 0.0
+        for (start, _, _), (chunkResults, chunkMoves, chunkTimes, chunkTime) in zip(run["chunks"], run["results"]):
+            games = slice(start, start + len(chunkResults))
+            results[games], numMoves[games], agentTimes[games] = chunkResults, chunkMoves, chunkTimes
+            busyTime += chunkTime
+        run["agents"] = None
+
+        if filename is not None:
+            writeRunFile(filename, agent1.name, agent2.name, results, numMoves, agentTimes)
+        return results, numMoves, agentTimes, busyTime
+
+    # Round robin of agents - every pairing is played gamesPerSeat times with each agent as player 1. With
+    # opponents, the agents only play the opponents (e.g. a sweep of configurations against a control agent).
+    # The games of a pairing and seat go to directory/"player 1_player 2.txt", and pairings whose file already
+    # holds gamesPerSeat games are read back instead of played. Returns the crosstable of all pairings.
+    def runTournament(self, agents, gamesPerSeat, directory, opponents=None):
+        if opponents is None:
+            pairings = [(a, b) for i, a in enumerate(agents) for b in agents[i + 1 :]]
+        else:
+            pairings = [(a, b) for a in agents for b in opponents]
+        names = [agent.name for agent in agents + (opponents or [])]
+        assert len(set(names)) == len(set(map(id, agents + (opponents or [])))), "Agent names must be unique."
+        os.makedirs(directory, exist_ok=True)
+
+        games = dict()
+        submitted = []
+        for agentA, agentB in pairings:
+            for agent1, agent2 in ((agentA, agentB), (agentB, agentA)):
+                filename = f"{directory}/{agent1.name}_{agent2.name}.txt"
+                if os.path.exists(filename):
+                    _, df = qutil.readRunFile(filename)
+                    if len(df) >= gamesPerSeat:
+                        games[agent1.name, agent2.name] = df.result.to_numpy()
+                        continue
+                submitted.append((filename, self.submit(agent1, agent2, gamesPerSeat)))
+        print(f"{len(submitted)} of {2 * len(pairings)} pairings and seats to play")
+
+        startTime = time.time()
+        for filename, run in submitted:
+            agent1, agent2 = run["agent1"], run["agent2"]
+            results, _, _, _ = self.collect(run, filename)
+            games[agent1.name, agent2.name] = results
+            print(
+                f"{agent1.name} vs {agent2.name}: {np.count_nonzero(results == 1)}-{np.count_nonzero(results == 2)}",
+                f"{np.count_nonzero(results == 0)} draws, {round(time.time() - startTime, 2)}s",
+            )
+        return crosstable(games)
+
+
+# Score of every agent (rows) against every opponent (columns) over both seats - a win is 1 and a draw 0.5 - as a
+# fraction of the games between them, then the total score and number of games of each agent. A forfeit (too many
+# illegal moves, result -1 or -2) is a loss of the player that made it.
+def crosstable(games):
+    names = sorted({name for pairing in games for name in pairing})
+    scores = pd.DataFrame(0.0, index=names, columns=names)
+    numGames = pd.DataFrame(0, index=names, columns=names)
+    for (player1, player2), results in games.items():
+        player1Score = np.count_nonzero((results == 1) | (results == -2)) + 0.5 * np.count_nonzero(results == 0)
+        scores.loc[player1, player2] += player1Score
+        scores.loc[player2, player1] += len(results) - player1Score
+        numGames.loc[player1, player2] += len(results)
+        numGames.loc[player2, player1] += len(results)
+
+    table = (scores / numGames.where(numGames > 0)).round(3)
+    table["score"] = scores.sum(axis=1)
+    table["games"] = numGames.sum(axis=1)
+    table["scoreRate"] = (table["score"] / table["games"]).round(3)
+    return table.sort_values("scoreRate", ascending=False)
+
+
+# the log file format of the experiments - the agent names and number of games, then one line per game
+def writeRunFile(filename, agent1Name, agent2Name, results, numMoves, agentTimes):
+    lines = [
+        f"{agent1Name},{agent2Name},{len(results)}",
+        "result,player1cumulativeTime,player2cumulativeTime,player1numMoves,player2numMoves",
+    ]
+    lines.extend(
+        f"{result},{round(time1, 4)},{round(time2, 4)},{moves1},{moves2}"
+        for result, (time1, time2), (moves1, moves2) in zip(
+            results.tolist(), agentTimes.tolist(), numMoves.tolist()
+        )
+    )
+    createRunDirectory(filename)
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+# creates the directory of a run file if it does not exist yet
+def createRunDirectory(filename):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+
+
+# log file name of a run started now
+def getRunFilename(agent1Name, agent2Name, directory="experiment_results/final"):
+    today = datetime.now()
+    return f"{directory}/{today.date()} {today.hour}_{today.minute}_{today.second} {agent1Name}_{agent2Name}.txt"
+
+
+# agents from the command line - random, negamax-DEPTH-WINDOW, genetic-DEPTH-GENERATIONS-INITIAL-MAX or mcts-ITERATIONS
+def createAgent(spec):
+    kind, *params = spec.split("-")
+    params = [int(p) for p in params]
+    if kind == "random":
+        return qagents.RandomAgent()
+    if kind == "negamax":
+        return qagents.NegamaxAgent(params[0], searchWindow=params[1] if len(params) > 1 else 256)
+    if kind == "genetic":
+        depth, generations, initialPopulationSize, maxPopulationSize = params
+        return qagents.GeneticMinmaxAgent(
+            depth, generations, initialPopulationSize=initialPopulationSize, maxPopulationSize=maxPopulationSize
+        )
+    if kind == "mcts":
+        return qagents.MCTSAgent(iterations=params[0])
+    raise ValueError(f"Unknown agent {spec}")
+
+
+# Games per second for every worker count. Each count gets its own runner, warmed up with one chunk per worker
+# before numGames games are timed. The efficiency is the time the workers spent playing over workers times the
+# wall time, the rest being scheduling and result transfer.
+def benchmarkThroughput(agent1, agent2, numGames, workerCounts, chunkSize=None):
+    rows = []
+    for workers in workerCounts:
+        with BatchRunner(workers, chunkSize) as runner:
+            runner.run(agent1, agent2, workers)
+            startTime = time.time()
+            _, _, _, busyTime = runner.run(agent1, agent2, numGames)
+            wallTime = time.time() - startTime
+        rows.append(
+            {
+                "workers": workers,
+                "games": numGames,
+                "timeS": round(wallTime, 3),
+                "gamesPerSecond": round(numGames / wallTime, 1),
+                "efficiency": round(busyTime / (workers * wallTime), 3),
+            }
+        )
+    for row in rows:
+        row["speedup"] = round(row["gamesPerSecond"] / rows[0]["gamesPerSecond"], 2)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play batches of games between two agents on all cores.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="play games and write them to a run file")
+    run.add_argument("agent1", help="random, negamax-DEPTH-WINDOW, genetic-DEPTH-GENS-INITIAL-MAX or mcts-ITERATIONS")
+    run.add_argument("agent2")
+    run.add_argument("--games", type=int, default=100)
+    run.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    run.add_argument("--chunk", type=int, default=None, help="games per chunk")
+    run.add_argument("--seed", type=int, default=None)
+
+    tournament = commands.add_parser("tournament", help="play a round robin and print the crosstable")
+    tournament.add_argument("agents", nargs="+")
+    tournament.add_argument("--games", type=int, default=20, help="games per pairing and seat")
+    tournament.add_argument("--dir", default="experiment_results/tournament", help="run files of the pairings")
+    tournament.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    tournament.add_argument("--chunk", type=int, default=None, help="games per chunk")
+    tournament.add_argument("--seed", type=int, default=None)
+
+    benchmark = commands.add_parser("benchmark", help="games per second for each number of workers")
+    benchmark.add_argument("agent1")
+    benchmark.add_argument("agent2")
+    benchmark.add_argument("--games", type=int, default=400)
+    benchmark.add_argument(
+        "--workers", type=int, nargs="+", default=None, help="worker counts (default: 1 to all cores)"
+    )
+    benchmark.add_argument("--chunk", type=int, default=None, help="games per chunk")
+
+    args = parser.parse_args()
+    if args.command == "tournament":
+        with BatchRunner(args.workers, args.chunk, args.seed) as runner:
+            table = runner.runTournament([createAgent(spec) for spec in args.agents], args.games, args.dir)
+        table.to_csv(f"{args.dir}/crosstable.csv")
+        print(table.to_string())
+        return
+
+    agent1, agent2 = createAgent(args.agent1), createAgent(args.agent2)
+    if args.command == "run":
+        filename = getRunFilename(agent1.name, agent2.name)
+        startTime = time.time()
+        with BatchRunner(args.workers, args.chunk, args.seed) as runner:
+            results, _, _, _ = runner.run(agent1, agent2, args.games, filename)
+        print(
+            f"{filename}: player 1 won {np.count_nonzero(results == 1)},",
+            f"player 2 won {np.count_nonzero(results == 2)}, {np.count_nonzero(results == 0)} draws,",
+            f"{round(time.time() - startTime, 2)}s",
+        )
+    elif args.command == "benchmark":
+        workerCounts = args.workers or range(1, mp.cpu_count() + 1)
+        for row in benchmarkThroughput(agent1, agent2, args.games, workerCounts, args.chunk):
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
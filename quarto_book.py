@@ -0,0 +1,101 @@
+import argparse
+import multiprocessing as mp
+import os
+import time
+import quarto_util as qutil
+from quarto_agents.negamax_agent import NegamaxAgent
+
+# Command line tool to build and inspect opening book files (quarto_util.OpeningBook)
+# e.g. python quarto_book.py build tables/opening.qbk --plies 3 --depth 4 --window 32
+#
+# Every first piece is equivalent under the piece symmetries, so the early game only has a handful of canonical
+# positions: 1 before the first placement, 8 after it, 148 after the second and 3382 after the third. Each one is
+# searched once, deeper than an agent can afford during a game, and the best move is stored.
+
+# search agent of each pool worker
+agent = None
+
+
+def initWorker(depth, searchWindow):
+    global agent
+    agent = NegamaxAgent(depth, searchWindow=searchWindow, endgameThreshold=None)
+
+
+def searchPosition(key):
+    board = qutil.QuartoBoard.fromKey(key)
+    score, move = agent.alphaBeta(board, agent.depth, -1000, 1000)
+    return key, (score, move)
+
+
+# canonical positions with fewer than plies pieces placed, the current piece being selected
+def enumerateOpenings(plies):
+    board = qutil.QuartoBoard()
+    board.selectPiece(0)
+    board, _ = qutil.canonicalizeBoard(board)
+    level = {board.key(): board}
+    positions = dict(level)
+    for _ in range(plies - 1):
+        nextLevel = dict()
+        for board in level.values():
+            for position in qutil.getMaskIndices(~board.occupied & qutil.FULL_MASK):
+                for nextPiece in qutil.getMaskIndices(board.available):
+                    board.makeMove(position, nextPiece)
+                    if not qutil.isWinningPlacement(board, position):
+                        canonical, _ = qutil.canonicalizeBoard(board)
+                        nextLevel.setdefault(canonical.key(), canonical)
+                    board.undoMove(position)
+        positions.update(nextLevel)
+        level = nextLevel
+    return list(positions)
+
+
+def buildOpeningBook(path, plies, depth, searchWindow, workers=None):
+    startTime = time.time()
+    keys = enumerateOpenings(plies)
+    entries = dict()
+    with mp.Pool(workers, initializer=initWorker, initargs=(depth, searchWindow)) as pool:
+        for key, entry in pool.imap_unordered(searchPosition, keys):
+            entries[key] = entry
+    qutil.writeOpeningBook(path, entries)
+    print(f"{len(entries)} positions searched, {round(time.time() - startTime, 2)}s")
+
+
+# number of entries per number of placed pieces
+def inspectOpeningBook(path):
+    book = qutil.OpeningBook(path)
+    book.load()
+    plies = dict()
+    for key in book.entries:
+        placed = (key >> 64 & qutil.FULL_MASK).bit_count()
+        plies[placed] = plies.get(placed, 0) + 1
+    return {
+        "entries": len(book.entries),
+        "placedPieces": dict(sorted(plies.items())),
+        "fileSize": os.path.getsize(path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect opening book files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="search the early positions and write the book")
+    build.add_argument("path")
+    build.add_argument("--plies", type=int, default=3, help="positions with fewer placed pieces are searched")
+    build.add_argument("--depth", type=int, default=4)
+    build.add_argument("--window", type=int, default=32, help="search window of the negamax agent")
+    build.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+
+    inspect = commands.add_parser("inspect", help="show opening book statistics")
+    inspect.add_argument("path")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        buildOpeningBook(args.path, args.plies, args.depth, args.window, args.workers)
+    elif args.command == "inspect":
+        for name, value in inspectOpeningBook(args.path).items():
+            print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
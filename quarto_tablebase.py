@@ -0,0 +1,139 @@
+import argparse
+import multiprocessing as mp
+import os
+import random
+import time
+import quarto_util as qutil
+from quarto_agents.endgame_solver import EndgameSolver, randomPosition
+from quarto_agents.transposition_table import EXACT
+
+# Command line tool to build and inspect endgame tablebase files (quarto_util.Tablebase)
+# e.g. python quarto_tablebase.py build tables/endgame.qtb --max-empty 8 --positions 2000
+#
+# Every position with up to 8 empty cells is far too many to enumerate (over 10^11 canonical positions with only
+# 4 empty cells), so the tablebase covers the positions reachable in play: for each empty cell count, starting
+# from the smallest, positions are sampled by random play and solved in parallel. The workers probe the levels
+# built so far and every position their solvers prove on the way is kept as well. Positions of logged games
+# (experiment_results/logs) can be added as seeds, so the tablebase covers the endgames the agents actually reach.
+
+# solved positions with fewer empty cells are cheaper to search than to canonicalize and store
+MIN_HARVEST_EMPTY = 3
+
+# solver of each pool worker
+solver = None
+
+
+def initWorker(tablebasePath):
+    global solver
+    solver = EndgameSolver(tablebase=tablebasePath)
+
+
+# solves a chunk of canonical position keys, returns the canonical entries of everything proven
+def solvePositions(keys):
+    entries = {key: solver.solve(qutil.QuartoBoard.fromKey(key)) for key in keys}
+
+    table = solver.table
+    for i, storedKey in enumerate(table.keys):
+        if storedKey is None or table.flags[i] != EXACT or table.depths[i] < MIN_HARVEST_EMPTY:
+            continue
+        # entries with few empty cells are stored under the plain key, so everything is canonicalized again
+        canonical, transform = qutil.canonicalizeBoard(qutil.QuartoBoard.fromKey(storedKey))
+        entries.setdefault(
+            canonical.key(), (table.scores[i], qutil.transformMove(table.moves[i], transform))
+        )
+    table.clear()
+    return entries
+
+
+# positions of the games in the detailed log files, by number of empty cells
+def readLogPositions(logFiles):
+    positions = dict()
+    for logFile in logFiles:
+        _, games, _ = qutil.readLogFile(logFile)
+        for game in games:
+            for row in game:
+                board = qutil.QuartoBoard.fromEncoding(row[0])
+                if board.current != qutil.NULL_PIECE and not board.isGameOver():
+                    positions.setdefault(board.numEmptyCells(), []).append(board)
+    return positions
+
+
+def buildTablebase(path, maxEmpty, numPositions, workers=None, chunkSize=16, seed=None, logFiles=()):
+    rng = random.Random(seed)
+    logPositions = readLogPositions(logFiles)
+    entries = dict()
+    maxBuilt = 0
+    if os.path.exists(path):
+        tablebase = qutil.Tablebase(path)
+        entries = tablebase.getEntries()
+        maxBuilt = tablebase.maxEmpty
+
+    for numEmpty in range(2, maxEmpty + 1):
+        startTime = time.time()
+        seeds = set()
+        boards = [randomPosition(numEmpty, rng) for _ in range(numPositions)]
+        for board in boards + logPositions.get(numEmpty, []):
+            canonical, _ = qutil.canonicalizeBoard(board)
+            if canonical.key() not in entries:
+                seeds.add(canonical.key())
+        seeds = list(seeds)
+        chunks = [seeds[i : i + chunkSize] for i in range(0, len(seeds), chunkSize)]
+
+        tablebasePath = path if os.path.exists(path) else None
+        with mp.Pool(workers, initializer=initWorker, initargs=(tablebasePath,)) as pool:
+            for chunkEntries in pool.imap_unordered(solvePositions, chunks):
+                entries.update(chunkEntries)
+
+        # written next to the old file and swapped in, so open mappings keep reading the previous level
+        maxBuilt = max(maxBuilt, numEmpty)
+        qutil.writeTablebase(path + ".tmp", entries, maxBuilt)
+        os.replace(path + ".tmp", path)
+        print(
+            f"{numEmpty} empty cells: {len(seeds)} positions solved, {len(entries)} entries,",
+            f"{round(time.time() - startTime, 2)}s",
+        )
+
+
+# number of entries per empty cell count and value
+def inspectTablebase(path):
+    tablebase = qutil.Tablebase(path)
+    levels = dict()
+    for key, (value, _) in tablebase.getEntries().items():
+        numEmpty = 16 - (key >> 64 & qutil.FULL_MASK).bit_count()
+        level = levels.setdefault(numEmpty, {"win": 0, "draw": 0, "loss": 0})
+        level[("loss", "draw", "win")[value + 1]] += 1
+    return {
+        "entries": tablebase.numEntries,
+        "maxEmpty": tablebase.maxEmpty,
+        "levels": dict(sorted(levels.items())),
+        "fileSize": os.path.getsize(path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect endgame tablebase files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="build a tablebase or extend an existing one")
+    build.add_argument("path")
+    build.add_argument("--max-empty", type=int, default=8, help="largest number of empty cells")
+    build.add_argument("--positions", type=int, default=1000, help="sampled positions per empty cell count")
+    build.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    build.add_argument("--seed", type=int, default=None)
+    build.add_argument("--logs", nargs="*", default=[], help="detailed game logs whose positions are added")
+
+    inspect = commands.add_parser("inspect", help="show tablebase statistics")
+    inspect.add_argument("path")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        buildTablebase(
+            args.path, args.max_empty, args.positions, args.workers, seed=args.seed, logFiles=args.logs
+        )
+    elif args.command == "inspect":
+        for name, value in inspectTablebase(args.path).items():
+            print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
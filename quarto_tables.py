@@ -0,0 +1,54 @@
+import argparse
+from quarto_agents.transposition_table import (
+    REPLACEMENT_POLICIES,
+    createMappedTable,
+    inspectMappedTable,
+    mergeMappedTables,
+    compactMappedTable,
+)
+
+# Command line tool for the memory-mapped transposition table files used by NegamaxAgent(transposition=...)
+# e.g. python quarto_tables.py inspect tables/negamax.qtt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create, inspect, merge and compact transposition table files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create = commands.add_parser("create", help="create an empty table file")
+    create.add_argument("path")
+    create.add_argument("--capacity", type=int, default=2**20, help="number of slots (power of 2)")
+
+    inspect = commands.add_parser("inspect", help="show table statistics")
+    inspect.add_argument("path")
+
+    merge = commands.add_parser("merge", help="merge source tables into a target table")
+    merge.add_argument("target")
+    merge.add_argument("sources", nargs="+")
+    merge.add_argument("--replacement", default="depth", choices=list(REPLACEMENT_POLICIES))
+
+    compact = commands.add_parser("compact", help="rewrite a table without torn records")
+    compact.add_argument("path")
+    compact.add_argument("output")
+    compact.add_argument("--capacity", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == "create":
+        createMappedTable(args.path, args.capacity)
+    elif args.command == "inspect":
+        for name, value in inspectMappedTable(args.path).items():
+            print(f"{name}: {value}")
+    elif args.command == "merge":
+        print(mergeMappedTables(args.target, args.sources, args.replacement))
+    elif args.command == "compact":
+        metrics = compactMappedTable(args.path, args.output, args.capacity)
+        print(metrics)
+        if metrics["dropped"] > 0:
+            print(
+                f"{metrics['dropped']} of {metrics['entries'] + metrics['dropped']} entries shared a slot and were",
+                f"dropped at capacity {metrics['capacity']}, a larger --capacity keeps more of them",
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import itertools
+import struct
 import numpy as np
 import pandas as pd
 
@@ -120,16 +122,702 @@ def isGameOverEncoding(encoding):
     return False
 
 
-# transposition table functions
-def createTable(file_name: str):
-    df = pd.DataFrame(columns=["encoding", "evaluation", "movePos", "movePiece"])
+# packed bitboard representation
+NULL_PIECE = 16
+FULL_MASK = 0xFFFF
+
+# the 10 lines of the board in row-wise linear indexing: 4 rows, 4 columns, obtuse and acute diagonal
+LINES = (
+    tuple(tuple(range(4 * i, 4 * i + 4)) for i in range(4))
+    + tuple(tuple(range(i, 16, 4)) for i in range(4))
+    + ((0, 5, 10, 15), (3, 6, 9, 12))
+)
+LINE_MASKS = tuple(sum(1 << cell for cell in line) for line in LINES)
+LINE_SHIFTS = tuple(tuple(4 * cell for cell in line) for line in LINES)
+LINE_DATA = tuple(zip(LINE_MASKS, LINE_SHIFTS))
+
+# lines through each cell - its row, its column and any diagonal it lies on
+CELL_LINES = tuple(
+    tuple(data for line, data in zip(LINES, LINE_DATA) if cell in line) for cell in range(16)
+)
+
+# set bits of a byte, used to turn 16-bit masks into index lists without looping over every bit
+_LOW_BITS = tuple(tuple(i for i in range(8) if b >> i & 1) for b in range(256))
+_HIGH_BITS = tuple(tuple(i + 8 for i in range(8) if b >> i & 1) for b in range(256))
+
+# spreads each bit of a byte into a full nibble - used to fill empty cells with 1111
+_NIBBLE_SPREAD = tuple(sum(15 << 4 * i for i in range(8) if b >> i & 1) for b in range(256))
+
+
+def getMaskIndices(mask):
+    return _LOW_BITS[mask & 255] + _HIGH_BITS[mask >> 8]
+
+
+def spreadMaskToNibbles(mask):
+    return _NIBBLE_SPREAD[mask & 255] | _NIBBLE_SPREAD[mask >> 8] << 32
+
+
+# Compact game state used by the simulator and the search agents. The 16 cells are packed as nibbles of a single
+# integer (cell i occupies bits 4i to 4i+3), so placing a piece or checking a line only needs shifts and masks.
+# Empty cells always hold 0000 and are told apart from piece 0 by the occupancy mask.
+# - pieces: packed cells
+# - occupied: 16-bit mask of filled cells
+# - available: 16-bit mask of pieces that can still be handed to the opponent (not placed and not the current piece)
+# - current: the piece to place next, 16 when there isn't one
+# The string encoding is only used to import and export states (logs, transposition table files).
+class QuartoBoard:
+    __slots__ = ("pieces", "occupied", "available", "current")
+
+    def __init__(self, pieces=0, occupied=0, available=FULL_MASK, current=NULL_PIECE):
+        self.pieces = pieces
+        self.occupied = occupied
+        self.available = available
+        self.current = current
+
+    @staticmethod
+    def fromArray(boardArray, currentPiece):
+        board = QuartoBoard()
+        for position, piece in enumerate(np.ravel(boardArray)):
+            piece = int(piece)
+            if piece != NULL_PIECE:
+                board.pieces |= piece << 4 * position
+                board.occupied |= 1 << position
+                board.available &= ~(1 << piece)
+        board.current = int(currentPiece)
+        if board.current != NULL_PIECE:
+            board.available &= ~(1 << board.current)
+        return board
+
+    @staticmethod
+    def fromEncoding(encoding):
+        return QuartoBoard.fromArray(
+            [int(encoding[i] + encoding[i + 1]) for i in range(0, len(encoding) - 2, 2)],
+            int(encoding[-2:]),
+        )
+
+    # inverse of key() - the available pieces are the ones neither placed nor current
+    @staticmethod
+    def fromKey(key):
+        board = QuartoBoard(key & (2**64 - 1), key >> 64 & FULL_MASK, FULL_MASK, key >> 80)
+        for position in getMaskIndices(board.occupied):
+            board.available &= ~(1 << board.getPiece(position))
+        if board.current != NULL_PIECE:
+            board.available &= ~(1 << board.current)
+        return board
+
+    def toArray(self):
+        return np.reshape([self.getPiece(i) for i in range(16)], (4, 4))
+
+    def toEncoding(self):
+        return encodeBoard(self.toArray(), self.current)
+
+    # cells as a (16,) uint8 array with 16 for empty cells - the row format of the batched kernels
+    def toCells(self):
+        return np.array([self.getPiece(i) for i in range(16)], dtype=np.uint8)
+
+    def copy(self):
+        return QuartoBoard(self.pieces, self.occupied, self.available, self.current)
+
+    # exact integer key of the position - the available pieces follow from the cells and the current piece
+    def key(self):
+        return self.pieces | self.occupied << 64 | self.current << 80
+
+    def getPiece(self, position):
+        if self.occupied >> position & 1:
+            return self.pieces >> 4 * position & 15
+        return NULL_PIECE
+
+    def isEmpty(self, position):
+        return not self.occupied >> position & 1
+
+    def numEmptyCells(self):
+        return 16 - self.occupied.bit_count()
+
+    def getAvailablePositions(self):
+        return set(getMaskIndices(~self.occupied & FULL_MASK))
+
+    def getAvailablePieces(self):
+        return set(getMaskIndices(self.available))
+
+    # place the current piece on an empty cell
+    def placePiece(self, position):
+        self.pieces |= self.current << 4 * position
+        self.occupied |= 1 << position
+        self.current = NULL_PIECE
+
+    # select the piece the opponent has to place next
+    def selectPiece(self, piece):
+        self.current = piece
+        if piece != NULL_PIECE:
+            self.available &= ~(1 << piece)
+
+    def makeMove(self, position, nextPiece):
+        self.pieces |= self.current << 4 * position
+        self.occupied |= 1 << position
+        self.current = nextPiece
+        if nextPiece != NULL_PIECE:
+            self.available &= ~(1 << nextPiece)
+
+    # reverts makeMove - the placed piece becomes the current piece again and the next piece is made available
+    def undoMove(self, position):
+        if self.current != NULL_PIECE:
+            self.available |= 1 << self.current
+        shift = 4 * position
+        self.current = self.pieces >> shift & 15
+        self.pieces &= ~(15 << shift)
+        self.occupied &= ~(1 << position)
+
+    def isGameOver(self):
+        pieces, occupied = self.pieces, self.occupied
+        for mask, (a, b, c, d) in LINE_DATA:
+            if occupied & mask == mask:
+                w, x, y, z = pieces >> a, pieces >> b, pieces >> c, pieces >> d
+                if (w & x & y & z | ~(w | x | y | z)) & 15:
+                    return True
+        return False
+
+    # Counts how many lines of three pieces with an identical property
+    def countThreeLines(self):
+        pieces, occupied = self.pieces, self.occupied
+        # empty cells are filled with 1111 for the conjunction so that only the three placed pieces count
+        filled = pieces | spreadMaskToNibbles(~occupied & FULL_MASK)
+        numLines = 0
+        for mask, (a, b, c, d) in LINE_DATA:
+            if (occupied & mask).bit_count() == 3:
+                if (
+                    filled >> a & filled >> b & filled >> c & filled >> d
+                    | ~(pieces >> a | pieces >> b | pieces >> c | pieces >> d)
+                ) & 15:
+                    numLines += 1
+        return numLines
+
+
+# Determines if the piece just placed at position completes a line with a matching property.
+# Only the 2-3 lines through that cell are checked, so the board must not have had a winning line before the placement.
+# QuartoBoard.isGameOver remains the full-board reference check.
+def isWinningPlacement(board, position):
+    pieces, occupied = board.pieces, board.occupied
+    for mask, (a, b, c, d) in CELL_LINES[position]:
+        if occupied & mask == mask:
+            w, x, y, z = pieces >> a, pieces >> b, pieces >> c, pieces >> d
+            if (w & x & y & z | ~(w | x | y | z)) & 15:
+                return True
+    return False
 
-    df["encoding"] = df["encoding"].astype("str")
-    df["evaluation"] = df["evaluation"].astype("int8")
-    df["movePos"] = df["movePos"].astype("int8")
-    df["movePiece"] = df["movePiece"].astype("int8")
 
-    df.to_pickle(f"tables/{file_name}.pkl")
+# Determines if placing piece on the empty cell position would complete a line with a matching property
+def isWinningMove(board, position, piece):
+    pieces = board.pieces | piece << 4 * position
+    occupied = board.occupied | 1 << position
+    for mask, (a, b, c, d) in CELL_LINES[position]:
+        if occupied & mask == mask:
+            w, x, y, z = pieces >> a, pieces >> b, pieces >> c, pieces >> d
+            if (w & x & y & z | ~(w | x | y | z)) & 15:
+                return True
+    return False
+
+
+# Counts the lines through position that hold three pieces with an identical property and one empty cell.
+# Used to update QuartoBoard.countThreeLines incrementally when a piece is placed at position.
+def countThreeLinesThrough(board, position):
+    pieces, occupied = board.pieces, board.occupied
+    filled = None
+    numLines = 0
+    for mask, (a, b, c, d) in CELL_LINES[position]:
+        if (occupied & mask).bit_count() == 3:
+            if filled is None:
+                filled = pieces | spreadMaskToNibbles(~occupied & FULL_MASK)
+            if (
+                filled >> a & filled >> b & filled >> c & filled >> d
+                | ~(pieces >> a | pieces >> b | pieces >> c | pieces >> d)
+            ) & 15:
+                numLines += 1
+    return numLines
+
+
+# threats
+# Each piece has 8 attribute values - its 4 set bits and its 4 clear bits - packed as (piece | ~piece << 4).
+# A line holding three pieces and one empty cell is won by any piece sharing one of the attribute values common
+# to the three pieces. THREAT_PIECES maps the common attribute values to the 16-bit mask of those pieces.
+PIECE_ATTRIBUTES = tuple(piece | (~piece & 15) << 4 for piece in range(16))
+THREAT_PIECES = tuple(
+    sum(1 << piece for piece in range(16) if PIECE_ATTRIBUTES[piece] & common) for common in range(256)
+)
+
+# line numbers through each cell and line numbers not through it
+_CELL_LINE_IDS = tuple(
+    tuple(line for line in range(len(LINES)) if cell in LINES[line]) for cell in range(16)
+)
+_OTHER_LINE_IDS = tuple(
+    tuple(line for line in range(len(LINES)) if cell not in LINES[line]) for cell in range(16)
+)
+
+# nibble shifts of the filled cells of a line, by the occupancy of the line
+_FILLED_SHIFTS = tuple(
+    {
+        sum(1 << cell for cell in filled): tuple(4 * cell for cell in filled)
+        for size in range(5)
+        for filled in itertools.combinations(line, size)
+    }
+    for line in LINES
+)
+
+
+# mask of the pieces that complete the line when placed on its only empty cell, 0 if the line does not hold three pieces
+def getLineThreat(pieces, occupied, line):
+    shifts = _FILLED_SHIFTS[line][occupied & LINE_MASKS[line]]
+    if len(shifts) != 3:
+        return 0
+    a, b, c = shifts
+    return THREAT_PIECES[
+        PIECE_ATTRIBUTES[pieces >> a & 15]
+        & PIECE_ATTRIBUTES[pieces >> b & 15]
+        & PIECE_ATTRIBUTES[pieces >> c & 15]
+    ]
+
+
+# Threat index of a board - the winning piece mask of every line, kept up to date incrementally.
+# update(position) has to be called after every makeMove/undoMove at position; only the lines through the cell
+# are recomputed. A piece is "poisoned" when handing it to the opponent lets them win on their next placement.
+class ThreatIndex:
+    __slots__ = ("board", "lineThreats")
+
+    def __init__(self, board):
+        self.board = board
+        self.lineThreats = [
+            getLineThreat(board.pieces, board.occupied, line) for line in range(len(LINES))
+        ]
+
+    def update(self, position):
+        pieces, occupied = self.board.pieces, self.board.occupied
+        for line in _CELL_LINE_IDS[position]:
+            self.lineThreats[line] = getLineThreat(pieces, occupied, line)
+
+    # pieces that win when placed on the board as it is
+    def getThreatenedPieces(self):
+        threats = 0
+        for lineThreat in self.lineThreats:
+            threats |= lineThreat
+        return threats
+
+    def isWinningPiece(self, piece):
+        return piece != NULL_PIECE and self.getThreatenedPieces() >> piece & 1
+
+    # available pieces the opponent could win with after the current piece is placed at position
+    def getPoisonedPieces(self, position):
+        board, lineThreats = self.board, self.lineThreats
+        poisoned = 0
+        for line in _OTHER_LINE_IDS[position]:
+            poisoned |= lineThreats[line]
+        # a line through position becomes a threat when it already holds two pieces
+        pieces, occupied = board.pieces, board.occupied
+        placed = PIECE_ATTRIBUTES[board.current]
+        for line in _CELL_LINE_IDS[position]:
+            shifts = _FILLED_SHIFTS[line][occupied & LINE_MASKS[line]]
+            if len(shifts) == 2:
+                a, b = shifts
+                poisoned |= THREAT_PIECES[
+                    placed & PIECE_ATTRIBUTES[pieces >> a & 15] & PIECE_ATTRIBUTES[pieces >> b & 15]
+                ]
+        return poisoned & board.available
+
+
+# symmetries of a position
+# Board symmetries are cell permutations that map lines onto lines. They are generated by the transpose,
+# the row reversal, the middle swap (rows and columns 1 and 2) and the inner/outer swap (rows and columns 0<->1
+# and 2<->3), giving a group of 32 transforms. Piece symmetries permute the 4 attributes and complement any of
+# them (24 x 16 transforms). Both keep every line property, so the evaluation of a position is invariant.
+def _permuteCells(rowMap, colMap, transpose=False):
+    cells = []
+    for cell in range(16):
+        row, col = rowMap[cell // 4], colMap[cell % 4]
+        cells.append(4 * col + row if transpose else 4 * row + col)
+    return tuple(cells)
+
+
+def _generateBoardTransforms():
+    identity = tuple(range(16))
+    generators = [
+        _permuteCells((0, 1, 2, 3), (0, 1, 2, 3), transpose=True),
+        _permuteCells((3, 2, 1, 0), (0, 1, 2, 3)),
+        _permuteCells((0, 2, 1, 3), (0, 2, 1, 3)),
+        _permuteCells((1, 0, 3, 2), (1, 0, 3, 2)),
+    ]
+    transforms = [identity]
+    seen = {identity}
+    for transform in transforms:
+        for generator in generators:
+            composed = tuple(generator[transform[cell]] for cell in range(16))
+            if composed not in seen:
+                seen.add(composed)
+                transforms.append(composed)
+    return transforms
+
+
+# BOARD_TRANSFORMS[t][cell] is the image of cell under board symmetry t, index 16 maps the null position to itself
+BOARD_TRANSFORMS = tuple(transform + (16,) for transform in _generateBoardTransforms())
+BOARD_INVERSES = tuple(
+    tuple(transform.index(cell) for cell in range(16)) + (16,) for transform in BOARD_TRANSFORMS
+)
+
+# occupancy mask images of every board symmetry, split into low and high byte lookups
+_OCCUPANCY_LOW = tuple(
+    tuple(sum(1 << t[i] for i in range(8) if b >> i & 1) for b in range(256)) for t in BOARD_TRANSFORMS
+)
+_OCCUPANCY_HIGH = tuple(
+    tuple(sum(1 << t[i + 8] for i in range(8) if b >> i & 1) for b in range(256)) for t in BOARD_TRANSFORMS
+)
+
+# PIECE_TRANSFORMS[16 * k + x][piece] is the image of piece after complementing the attributes in x and applying
+# the k-th attribute permutation, index 16 maps the null piece to itself
+PIECE_TRANSFORMS = tuple(
+    tuple(sum(((piece ^ x) >> i & 1) << permutation[i] for i in range(4)) for piece in range(16)) + (16,)
+    for permutation in itertools.permutations(range(4))
+    for x in range(16)
+)
+PIECE_INVERSES = tuple(
+    tuple(transform.index(piece) for piece in range(16)) + (16,) for transform in PIECE_TRANSFORMS
+)
+
+
+# Maps a position to its canonical representative - the symmetric variant with the smallest occupancy mask,
+# then the smallest pieces in cell order, then the smallest current piece.
+# Returns the canonical board and the transform (board symmetry, piece symmetry) that produces it.
+def canonicalizeBoard(board):
+    occupied = board.occupied
+    images = [
+        _OCCUPANCY_LOW[t][occupied & 255] | _OCCUPANCY_HIGH[t][occupied >> 8] for t in range(32)
+    ]
+    canonicalOccupied = min(images)
+    canonicalCells = getMaskIndices(canonicalOccupied)
+
+    # the first piece in cell order (or the current piece on an empty board) can always be complemented to 0000,
+    # which fixes the complement mask and leaves the 24 attribute permutations per board symmetry
+    candidates = []
+    for t in range(32):
+        if images[t] == canonicalOccupied:
+            inverse = BOARD_INVERSES[t]
+            pieces = [board.getPiece(inverse[cell]) for cell in canonicalCells] + [board.current]
+            x = pieces[0] if pieces[0] != NULL_PIECE else 0
+            candidates.extend((t, 16 * k + x, pieces) for k in range(24))
+
+    # keep the candidates with the smallest image one piece at a time
+    for i in range(1, len(canonicalCells) + 1):
+        if len(candidates) == 1:
+            break
+        values = [PIECE_TRANSFORMS[p][pieces[i]] for _, p, pieces in candidates]
+        smallest = min(values)
+        candidates = [c for c, value in zip(candidates, values) if value == smallest]
+
+    t, p, pieces = candidates[0]
+    pieceTransform = PIECE_TRANSFORMS[p]
+    canonical = QuartoBoard(occupied=canonicalOccupied, current=pieceTransform[board.current])
+    for cell, piece in zip(canonicalCells, pieces):
+        canonical.pieces |= pieceTransform[piece] << 4 * cell
+    canonical.available = _transformPieceMask(board.available, pieceTransform)
+    return canonical, (t, p)
+
+
+def _transformPieceMask(mask, pieceTransform):
+    result = 0
+    for piece in getMaskIndices(mask):
+        result |= 1 << pieceTransform[piece]
+    return result
+
+
+# maps a (position, nextPiece) move of the original position into the canonical frame
+def transformMove(move, transform):
+    return BOARD_TRANSFORMS[transform[0]][move[0]], PIECE_TRANSFORMS[transform[1]][move[1]]
+
+
+# maps a move of the canonical position back into the frame of the original position
+def untransformMove(move, transform):
+    return BOARD_INVERSES[transform[0]][move[0]], PIECE_INVERSES[transform[1]][move[1]]
+
+
+# (10,4) cell indices of every line, used to gather all lines of many boards at once
+LINE_INDICES = np.array(LINES, dtype=np.intp)
+
+
+# Batched terminal check and evaluation for an (N,16) uint8 array of boards with 16 denoting an empty cell.
+# Returns the win flag of every board and its number of lines of three pieces with an identical property.
+def batchEvaluateBoards(boards):
+    lines = boards[:, LINE_INDICES]  # (N,10,4)
+    empty = lines == NULL_PIECE
+    numEmpty = np.count_nonzero(empty, axis=2)
+
+    # same conjunction trick as matchingPropertyExists - empty cells are neutral (1111 for AND, 0000 for the negated OR)
+    bitwiseAnd = np.bitwise_and.reduce(np.where(empty, 15, lines), axis=2)
+    bitwiseNot = ~np.bitwise_or.reduce(np.where(empty, 0, lines), axis=2) & 15
+    matching = (bitwiseAnd | bitwiseNot) != 0
+
+    wins = np.any(matching & (numEmpty == 0), axis=1)
+    threeCounts = np.count_nonzero(matching & (numEmpty == 1), axis=1)
+    return wins, threeCounts
+
+
+# Ply ending each simulated game - the first ply completing a matching line, numPlies for a draw.
+# finalBoards are the filled (N,16) boards and placementPly the ply each cell is filled at, negative for the cells
+# filled on the start board (lines already full there are not wins of the simulated games).
+def _getEndPlies(finalBoards, placementPly, numPlies):
+    lines = finalBoards[:, LINE_INDICES]
+    matching = (np.bitwise_and.reduce(lines, axis=2) | ~np.bitwise_or.reduce(lines, axis=2) & 15) != 0
+    completedAt = placementPly[:, LINE_INDICES].max(axis=2)
+    return np.where(matching & (completedAt >= 0), completedAt, np.reshape(numPlies, (-1, 1))).min(axis=1)
+
+
+# Plays numGames uniformly random games from board (the empty board by default) in lockstep on NumPy arrays.
+# Choosing a random empty cell and a random available piece at every ply amounts to playing a random order of the
+# empty cells and a random order of the pieces (the current piece first), so each game is drawn as two permutations.
+# The final boards are filled at once and a game ends at the first ply completing a matching line, which is the
+# latest placement time of the line's cells. Games are simulated in chunks of batchSize to bound the memory use.
+# Outcomes are from the point of view of the player placing the first piece: 1 win, -1 loss, 0 draw.
+# With returnMoves the (position, nextPiece) of every ply is returned as well, -1 after the end of the game.
+def simulateRandomGames(numGames, board=None, returnMoves=False, batchSize=2**16, seed=None):
+    rng = np.random.default_rng(seed)
+    board = board if board is not None else QuartoBoard()
+    startCells = board.toCells()
+    emptyCells = np.array(getMaskIndices(~board.occupied & FULL_MASK), dtype=np.uint8)
+    pieces = np.array(getMaskIndices(board.available), dtype=np.uint8)
+    numPlies = len(emptyCells)
+
+    outcomes = np.empty(numGames, dtype=np.int8)
+    lengths = np.empty(numGames, dtype=np.int8)
+    if returnMoves:
+        positions = np.empty((numGames, numPlies), dtype=np.int8)
+        nextPieces = np.empty((numGames, numPlies), dtype=np.int8)
+
+    for start in range(0, numGames, batchSize):
+        size = min(batchSize, numGames - start)
+        rows = np.arange(size)[:, None]
+        cellOrder = rng.permuted(np.tile(emptyCells, (size, 1)), axis=1)
+        pieceOrder = rng.permuted(np.tile(pieces, (size, 1)), axis=1)
+        if board.current != NULL_PIECE:
+            pieceOrder = np.hstack((np.full((size, 1), board.current, dtype=np.uint8), pieceOrder))
+
+        finalBoards = np.tile(startCells, (size, 1))
+        finalBoards[rows, cellOrder] = pieceOrder
+        placementPly = np.full((size, 16), -1, dtype=np.int8)
+        placementPly[rows, cellOrder] = np.arange(numPlies, dtype=np.int8)
+
+        endPly = _getEndPlies(finalBoards, placementPly, numPlies)
+
+        batch = slice(start, start + size)
+        lengths[batch] = np.minimum(endPly + 1, numPlies)
+        outcomes[batch] = np.where(endPly == numPlies, 0, np.where(endPly % 2 == 0, 1, -1))
+        if returnMoves:
+            ended = np.arange(numPlies) > endPly[:, None]
+            positions[batch] = np.where(ended, -1, cellOrder)
+            following = np.hstack((pieceOrder[:, 1:], np.full((size, 1), NULL_PIECE, dtype=np.uint8)))
+            nextPieces[batch] = np.where(ended, -1, following)
+
+    stats = {
+        "games": numGames,
+        "wins": int(np.count_nonzero(outcomes == 1)),
+        "losses": int(np.count_nonzero(outcomes == -1)),
+        "draws": int(np.count_nonzero(outcomes == 0)),
+        "averageLength": float(lengths.mean()) if numGames != 0 else 0.0,
+        "outcomes": outcomes,
+        "lengths": lengths,
+    }
+    if returnMoves:
+        stats["positions"] = positions
+        stats["nextPieces"] = nextPieces
+    return stats
+
+
+# One random playout from each of a list of boards, the rollout step of tree searches. Every board is played out
+# like in simulateRandomGames, but with its own cells and pieces: occupied cells and placed pieces get sort keys
+# in front of the random keys of the rest (the current piece right after the placed ones), so one argsort per
+# array orders the cells and pieces of all boards. The boards must not be won already.
+# Returns the outcome of every playout for the player placing the board's current piece: 1 win, -1 loss, 0 draw.
+def batchRandomPlayouts(boards, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    size = len(boards)
+    rows = np.arange(size)[:, None]
+    cellIds = np.arange(16)
+    pieces = np.array([board.pieces for board in boards], dtype=np.uint64)
+    occupied = np.array([board.occupied for board in boards], dtype=np.int64)
+    current = np.array([board.current for board in boards], dtype=np.intp)
+
+    cells = (pieces[:, None] >> np.arange(0, 64, 4, dtype=np.uint64) & np.uint64(15)).astype(np.uint8)
+    filled = (occupied[:, None] >> cellIds & 1).astype(bool)
+    numFilled = np.count_nonzero(filled, axis=1)
+    cellKeys = rng.random((size, 16))
+    cellKeys[filled] = -1
+    cellOrder = np.argsort(cellKeys, axis=1)
+
+    pieceKeys = rng.random((size, 16))
+    pieceKeys[np.nonzero(filled)[0], cells[filled]] = -2
+    selected = current != NULL_PIECE
+    pieceKeys[selected, current[selected]] = -1
+    pieceOrder = np.argsort(pieceKeys, axis=1).astype(np.uint8)
+
+    # the k-th cell in order receives the k-th piece in order, the filled ones keep their piece
+    plies = cellIds - numFilled[:, None]
+    finalBoards = cells.copy()
+    finalBoards[rows, cellOrder] = np.where(plies >= 0, pieceOrder, np.take_along_axis(cells, cellOrder, axis=1))
+    placementPly = np.empty((size, 16), dtype=np.int8)
+    placementPly[rows, cellOrder] = plies
+    numPlies = 16 - numFilled
+    endPly = _getEndPlies(finalBoards, placementPly, numPlies)
+    return np.where(endPly == numPlies, 0, np.where(endPly % 2 == 0, 1, -1)).astype(np.int8)
+
+
+# endgame tablebase files
+# A 64 byte header (magic, number of entries, largest number of empty cells) followed by two uint64 arrays sorted
+# by cells then state, so positions are found by binary search on the memory-mapped file:
+# - cells: packed cells of the canonical position
+# - states: occupancy (bits 0-15) and current piece (bits 16-20) of the canonical position, the value for the
+#   player to move + 1 (bits 32-33) and the best move in the canonical frame - position (bits 40-44), piece (bits 48-52)
+TABLEBASE_MAGIC = b"QTBASE01"
+TABLEBASE_HEADER = struct.Struct("<8sQQ")
+TABLEBASE_HEADER_SIZE = 64
+TABLEBASE_STATE_MASK = 2**21 - 1
+
+
+def writeTablebase(path, entries, maxEmpty):
+    # entries maps canonical position keys to (value, move)
+    keys = list(entries)
+    cells = np.array([key & (2**64 - 1) for key in keys], dtype="<u8")
+    states = np.array(
+        [
+            key >> 64 | (value + 1) << 32 | move[0] << 40 | move[1] << 48
+            for key, (value, move) in zip(keys, entries.values())
+        ],
+        dtype="<u8",
+    )
+    order = np.lexsort((states & TABLEBASE_STATE_MASK, cells))
+    with open(path, "wb") as f:
+        f.write(TABLEBASE_HEADER.pack(TABLEBASE_MAGIC, len(keys), maxEmpty).ljust(TABLEBASE_HEADER_SIZE, b"\0"))
+        f.write(cells[order].tobytes())
+        f.write(states[order].tobytes())
+
+
+# Read-only view of a tablebase file. The arrays are memory-mapped, so processes probing the same file
+# (e.g. the mpBatchRun pool workers) share one copy through the page cache.
+class Tablebase:
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            magic, self.numEntries, self.maxEmpty = TABLEBASE_HEADER.unpack(f.read(TABLEBASE_HEADER.size))
+        assert magic == TABLEBASE_MAGIC, f"{path} is not a tablebase file."
+        if self.numEntries == 0:
+            self.cells = self.states = np.zeros(0, dtype="<u8")
+        else:
+            self.cells = np.memmap(path, "<u8", "r", TABLEBASE_HEADER_SIZE, (self.numEntries,))
+            self.states = np.memmap(
+                path, "<u8", "r", TABLEBASE_HEADER_SIZE + 8 * self.numEntries, (self.numEntries,)
+            )
+        self.probes = 0
+        self.hits = 0
+
+    # the mapping is reopened by path when the tablebase is sent to another process
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    # returns (value, (position, nextPiece)) for the player about to place board.current or None if the position
+    # is not in the tablebase - value is 1 for a win, 0 for a draw and -1 for a loss
+    def probe(self, board):
+        if board.numEmptyCells() > self.maxEmpty or self.numEntries == 0:
+            return None
+        self.probes += 1
+        canonical, transform = canonicalizeBoard(board)
+        cells = canonical.pieces
+        state = canonical.occupied | canonical.current << 16
+        i = int(np.searchsorted(self.cells, np.uint64(cells)))
+        while i < self.numEntries and int(self.cells[i]) == cells:
+            entry = int(self.states[i])
+            if entry & TABLEBASE_STATE_MASK == state:
+                self.hits += 1
+                move = (entry >> 40 & 31, entry >> 48 & 31)
+                return (entry >> 32 & 3) - 1, untransformMove(move, transform)
+            i += 1
+        return None
+
+    # all entries as a dict of canonical position keys to (value, move), the format of writeTablebase
+    def getEntries(self):
+        cells = self.cells.tolist()
+        states = self.states.tolist()
+        return {
+            c | (s & TABLEBASE_STATE_MASK) << 64: ((s >> 32 & 3) - 1, (s >> 40 & 31, s >> 48 & 31))
+            for c, s in zip(cells, states)
+        }
+
+
+# opening book files
+# A 64 byte header (magic, number of entries) followed by one record per canonical early position:
+# packed cells, occupancy | current piece << 16, the best move in the canonical frame and its score
+# (the infinite scores of a forced win or loss are stored as +-BOOK_MAX_SCORE).
+BOOK_MAGIC = b"QTBOOK01"
+BOOK_HEADER = struct.Struct("<8sQ")
+BOOK_HEADER_SIZE = 64
+BOOK_RECORD = struct.Struct("<QIBBh")
+BOOK_MAX_SCORE = 2**15 - 1
+
+
+def writeOpeningBook(path, entries):
+    # entries maps canonical position keys to (score, move)
+    with open(path, "wb") as f:
+        f.write(BOOK_HEADER.pack(BOOK_MAGIC, len(entries)).ljust(BOOK_HEADER_SIZE, b"\0"))
+        for key, (score, move) in sorted(entries.items()):
+            score = max(-BOOK_MAX_SCORE, min(BOOK_MAX_SCORE, score))
+            f.write(BOOK_RECORD.pack(key & (2**64 - 1), key >> 64, move[0], move[1], int(score)))
+
+
+# Opening book of searched early positions. The file is only read on the first lookup, so agents can be
+# created with a book without paying for it until a game reaches one of its positions.
+class OpeningBook:
+    def __init__(self, path) -> None:
+        self.path = path
+        self.entries = None
+        self.lookups = 0
+        self.hits = 0
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            magic, numEntries = BOOK_HEADER.unpack(f.read(BOOK_HEADER.size))
+            assert magic == BOOK_MAGIC, f"{self.path} is not an opening book file."
+            f.seek(BOOK_HEADER_SIZE)
+            data = f.read(numEntries * BOOK_RECORD.size)
+        self.entries = dict()
+        self.maxPlaced = 0
+        for cells, state, position, piece, score in BOOK_RECORD.iter_unpack(data):
+            if abs(score) == BOOK_MAX_SCORE:
+                score = np.inf if score > 0 else -np.inf
+            self.entries[cells | state << 64] = (score, (position, piece))
+            self.maxPlaced = max(self.maxPlaced, (state & FULL_MASK).bit_count())
+
+    # the book is loaded again by path when it is sent to another process
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    # returns (score, (position, nextPiece)) mapped into the frame of board or None if the position is not in the book
+    def lookup(self, board):
+        if self.entries is None:
+            self.load()
+        if board.occupied.bit_count() > self.maxPlaced:
+            return None
+        self.lookups += 1
+        canonical, transform = canonicalizeBoard(board)
+        entry = self.entries.get(canonical.key())
+        if entry is None:
+            return None
+        self.hits += 1
+        return entry[0], untransformMove(entry[1], transform)
+
+
+# transposition table functions
+def createTable(file_name: str, capacity=2**18):
+    from quarto_agents.transposition_table import createMappedTable
+
+    createMappedTable(f"tables/{file_name}.qtt", capacity)
 
 
 # Used to create a pandas dataframe to store results for agents - linked to the name of an agent